@@ -1,8 +1,17 @@
-from flask import Flask, request, send_file, abort
+from flask import Flask, request, send_file, abort, Response
 from werkzeug.utils import secure_filename
 import os
+import mmap
+import zlib
 import uuid
 import json
+import queue
+import logging
+import shutil
+import socket
+import threading
+import time
+import requests
 
 app = Flask(__name__)
 
@@ -12,6 +21,81 @@ current_folder = os.path.dirname(os.path.abspath(__file__))
 data_folder = os.path.join(current_folder, 'root')
 os.makedirs(data_folder, exist_ok=True)
 
+# Size of the blocks a chunk is read from the request, written to disk and
+# forwarded down the replica pipeline in
+write_block_size = int(os.getenv("WRITE_BLOCK_SIZE", 64 * 1024))
+
+# Number of blocks that may wait for the downstream DataNode before the
+# incoming stream is paused
+forward_queue_blocks = int(os.getenv("FORWARD_QUEUE_BLOCKS", 16))
+
+# Keep-alive session used to forward chunks to the next DataNode of a pipeline
+forward_session = requests.Session()
+forward_timeout = (float(os.getenv("FORWARD_CONNECT_TIMEOUT", 3)),
+                   float(os.getenv("FORWARD_READ_TIMEOUT", 60)))
+
+# Every chunk has a CRC32 of its whole content and one per checksum_block_size
+# bytes, kept in <chunk>.crc next to it. Range reads verify only the blocks they touch
+checksum_block_size = int(os.getenv("CHECKSUM_BLOCK_SIZE", 64 * 1024))
+
+# Chunks compressed by the NameNode or a client are stored as they arrive, with their
+# codec in the .crc file. Those whose codec is an HTTP Content-Encoding are served with
+# it to clients that accept it, so the bytes leave the disk still compressed
+content_encodings = {'zlib': 'deflate'}
+
+# The scrubber re-verifies the chunks that were not read or written for
+# scrub_cold_seconds, one pass every scrub_interval seconds, reading at most
+# scrub_bandwidth bytes per second so it does not compete with clients
+scrub_bandwidth = int(os.getenv("SCRUB_BYTES_PER_SECOND", 8 * 1024 * 1024))
+scrub_interval = float(os.getenv("SCRUB_INTERVAL", 3600))
+scrub_cold_seconds = float(os.getenv("SCRUB_COLD_SECONDS", 600))
+# Last read or write of each chunk, keyed by (data_id, chunk_id)
+chunk_last_access = {}
+scrub_stats = {'passes': 0, 'chunks_verified': 0, 'bytes_verified': 0, 'skipped_hot': 0,
+               'corrupt_found': 0, 'last_pass_started': None, 'last_pass_seconds': None}
+
+# When a written chunk is forced to disk: 'none' leaves it to the OS, 'chunk' fsyncs
+# every chunk before it is renamed into place, 'group' fsyncs the chunks finished
+# within fsync_group_interval together, one batch at a time
+fsync_policy = os.getenv("FSYNC_POLICY", "chunk")
+fsync_group_interval = float(os.getenv("FSYNC_GROUP_INTERVAL_MS", 10)) / 1000
+
+# Chunks waiting for the group commit, as (chunk_file, temp_location, file_location,
+# checksum_location, done)
+group_commit_queue = queue.Queue()
+
+# Totals of the chunks written, reported by /write_stats
+write_stats = {'chunks': 0, 'bytes': 0, 'write_seconds': 0.0, 'fsync_seconds': 0.0,
+               'failed': 0, 'last_bytes_per_s': None}
+# Lock for thread-safe operations on the write_stats dictionary
+write_stats_lock = threading.Lock()
+
+# How the DataNode serves requests. 'production' runs gunicorn with one threaded
+# worker when it is installed, and Werkzeug's threaded server otherwise, without a
+# log line per request. 'dev' is the Flask debug server
+server_mode = os.getenv("SERVER_MODE", "production")
+# Requests served at the same time in production mode
+server_threads = int(os.getenv("SERVER_THREADS", 64))
+
+# NameNode to send heartbeats to, and the address this DataNode is known by there
+namenode_url = os.getenv("NAMENODE_URL", "http://namenode:8090")
+datanode_address = os.getenv(
+    "DATANODE_ADDRESS", f"http://{socket.gethostname()}:{os.getenv('PORT')}")
+
+# Seconds between two heartbeats, and between two full block reports
+heartbeat_interval = float(os.getenv("HEARTBEAT_INTERVAL", 3))
+full_report_interval = float(os.getenv("FULL_BLOCK_REPORT_INTERVAL", 600))
+
+# Chunks stored, removed or found corrupt since the last heartbeat, keyed by
+# (data_id, chunk_id). added maps to the chunk size
+block_changes = {'added': {}, 'removed': set(), 'corrupt': set()}
+# Bytes held in chunk files, kept up to date by record_block_added/removed
+stored_bytes = 0
+# Number of requests being served right now
+in_flight_requests = 0
+# Lock for thread-safe operations on block_changes, stored_bytes and in_flight_requests
+block_state_lock = threading.Lock()
+
 # Initialize DataNode status with a unique identifier and active status
 
 
@@ -36,6 +120,137 @@ def init_data_node_status():
 # Initialize DataNode status
 data_node_status = init_data_node_status()
 
+
+def scan_blocks():
+    # Returns {(data_id, chunk_id): size} for every chunk stored on this DataNode
+    blocks = {}
+    for data_id in os.listdir(data_folder):
+        data_directory = os.path.join(data_folder, data_id)
+        if not os.path.isdir(data_directory):
+            continue
+        for chunk_id in os.listdir(data_directory):
+            if not is_chunk_file(chunk_id):
+                continue
+            try:
+                blocks[(data_id, chunk_id)] = os.path.getsize(
+                    os.path.join(data_directory, chunk_id))
+            except OSError:
+                # Removed while scanning
+                pass
+    return blocks
+
+
+def is_temp_chunk(file_name):
+    # Chunks being written live under a temporary name until they are complete
+    return '.tmp-' in file_name
+
+
+def is_chunk_file(file_name):
+    # Chunks, as opposed to chunks being written, checksum files and quarantined chunks
+    return not (is_temp_chunk(file_name) or file_name.endswith(('.crc', '.corrupt')))
+
+
+def remove_stale_temp_chunks():
+    # Chunks that were being written when the DataNode stopped are incomplete
+    for data_id in os.listdir(data_folder):
+        data_directory = os.path.join(data_folder, data_id)
+        if os.path.isdir(data_directory):
+            for file_name in os.listdir(data_directory):
+                if is_temp_chunk(file_name):
+                    os.remove(os.path.join(data_directory, file_name))
+
+
+def record_block_added(data_id, chunk_id, size, previous_size=0):
+    global stored_bytes
+    with block_state_lock:
+        block_changes['removed'].discard((data_id, chunk_id))
+        block_changes['added'][(data_id, chunk_id)] = size
+        stored_bytes += size - previous_size
+
+
+def record_block_removed(data_id, chunk_id, size):
+    global stored_bytes
+    with block_state_lock:
+        block_changes['added'].pop((data_id, chunk_id), None)
+        block_changes['removed'].add((data_id, chunk_id))
+        stored_bytes -= size
+
+
+@app.before_request
+def count_request_started():
+    global in_flight_requests
+    with block_state_lock:
+        in_flight_requests += 1
+
+
+@app.teardown_request
+def count_request_finished(exception=None):
+    global in_flight_requests
+    with block_state_lock:
+        in_flight_requests -= 1
+
+
+def send_heartbeats():
+    # Pushes a heartbeat to the NameNode every heartbeat_interval seconds. It carries
+    # the disk capacity and load of this DataNode, the chunks added and removed since
+    # the previous heartbeat, and every full_report_interval seconds (or when the
+    # NameNode asks for it) the complete list of stored chunks
+    global stored_bytes
+
+    last_full_report = None
+    full_report_requested = True
+
+    while True:
+        with block_state_lock:
+            added, removed = block_changes['added'], block_changes['removed']
+            corrupt = block_changes['corrupt']
+            block_changes['added'], block_changes['removed'] = {}, set()
+            block_changes['corrupt'] = set()
+            in_flight = in_flight_requests
+
+        full_report = None
+        if full_report_requested or last_full_report is None or \
+                time.monotonic() - last_full_report >= full_report_interval:
+            blocks = scan_blocks()
+            full_report = [[data_id, chunk_id, size]
+                           for (data_id, chunk_id), size in blocks.items()]
+            with block_state_lock:
+                stored_bytes = sum(blocks.values())
+
+        disk = shutil.disk_usage(data_folder)
+        heartbeat = {
+            'address': datanode_address,
+            'uuid': data_node_status['uuid'],
+            'capacity': {'total': disk.total, 'used': disk.used, 'free': disk.free},
+            'stored_bytes': stored_bytes,
+            'in_flight': in_flight,
+            'added': [[data_id, chunk_id, size] for (data_id, chunk_id), size in added.items()],
+            'removed': [[data_id, chunk_id] for data_id, chunk_id in removed],
+            'corrupt': [[data_id, chunk_id] for data_id, chunk_id in corrupt],
+            'full_report': full_report
+        }
+
+        try:
+            response = forward_session.post(
+                f"{namenode_url}/heartbeat", json=heartbeat, timeout=forward_timeout)
+            if response.status_code == 403:
+                # DATANODE_ADDRESS is not one of the NameNode's DataNodes
+                print(f"Heartbeat refused by the NameNode: {response.text}", flush=True)
+            response.raise_for_status()
+            full_report_requested = response.json().get('full_report_requested', False)
+            if full_report is not None:
+                last_full_report = time.monotonic()
+        except (requests.exceptions.RequestException, ValueError):
+            # The changes of this heartbeat are lost, a full report puts the
+            # NameNode back in sync once it is reachable again. Corrupt chunks are
+            # gone from the full report, but are reported again to get them repaired
+            full_report_requested = True
+            with block_state_lock:
+                block_changes['corrupt'].update(corrupt)
+
+        time.sleep(heartbeat_interval)
+
+
 # Endpoint to check if the DataNode is active and retrieve its UUID
 
 
@@ -46,20 +261,390 @@ def is_active():
     else:
         return {"status": "DataNode is not active"}, 503
 
-# Endpoint to receive and store files on the DataNode
+def forward_chunk(blocks, data_id, chunk_id, downstream, pipeline, codec=None):
+    # arguments blocks(queue.Queue of bytes), data_id(str), chunk_id(str), downstream(list), pipeline(list),
+    # codec(str or None)
+    # Streams the blocks put on the queue to the next DataNode of the pipeline, which
+    # in turn forwards them to the rest of the downstream list. A None block marks the
+    # end of the chunk, an exception aborts the transfer. The outcome for every
+    # downstream node is appended to pipeline as {'address', 'status', 'checksum'}
+
+    next_node, rest = downstream[0], downstream[1:]
+    finished = False
+
+    def body():
+        nonlocal finished
+        while True:
+            block = blocks.get()
+            if block is None:
+                finished = True
+                return
+            if isinstance(block, Exception):
+                finished = True
+                raise block
+            yield block
+
+    try:
+        response = forward_session.post(
+            f"{next_node}/write_file/",
+            data=body(),
+            timeout=forward_timeout,
+            params={'data_id': data_id, 'chunk_id': chunk_id, 'downstream': rest,
+                    'codec': codec},
+            headers={'Content-Type': 'application/octet-stream'})
+
+        if response.status_code == 200:
+            result = response.json()
+            pipeline.append({'address': next_node, 'status': 'success',
+                             'checksum': result.get('checksum')})
+            pipeline.extend(result.get('pipeline', []))
+            return
+        print(f"Failed to forward chunk {chunk_id} to {next_node}")
+    except Exception:
+        print(f"Failed to connect to {next_node}")
+    finally:
+        # Keep consuming so the writer never blocks on a dead pipeline
+        while not finished:
+            block = blocks.get()
+            finished = block is None or isinstance(block, Exception)
+
+    pipeline.extend({'address': address, 'status': 'failure'}
+                    for address in downstream)
+
+
+def new_checksums():
+    return {'crc': 0, 'blocks': [], 'block_crc': 0, 'block_fill': 0}
+
+
+def update_checksums(checksums, data):
+    # Adds data to the running CRC32 of the chunk and of its checksum blocks
+    checksums['crc'] = zlib.crc32(data, checksums['crc'])
+    view = memoryview(data)
+    while len(view):
+        take = min(len(view), checksum_block_size - checksums['block_fill'])
+        checksums['block_crc'] = zlib.crc32(view[:take], checksums['block_crc'])
+        checksums['block_fill'] += take
+        view = view[take:]
+        if checksums['block_fill'] == checksum_block_size:
+            checksums['blocks'].append(checksums['block_crc'])
+            checksums['block_crc'], checksums['block_fill'] = 0, 0
+
+
+def finish_checksums(checksums, size):
+    # The contents of a <chunk>.crc file
+    if checksums['block_fill']:
+        checksums['blocks'].append(checksums['block_crc'])
+    return {'algorithm': 'crc32', 'block_size': checksum_block_size, 'size': size,
+            'crc': checksums['crc'], 'blocks': checksums['blocks']}
+
+
+def write_checksums(file_location, checksums):
+    # Writes the checksum file of a chunk under a temporary name, commit_chunk puts it
+    # in place along with the chunk. Returns the temporary name
+    temp_location = f"{file_location}.crc.tmp-{uuid.uuid4().hex}"
+    with open(temp_location, 'w') as checksum_file:
+        json.dump(checksums, checksum_file)
+    return temp_location
+
+
+def load_checksums(file_location, inode=None):
+    # The checksums of a chunk, None for chunks written before they were kept. The
+    # checksum file is put in place before the chunk it describes and names the inode
+    # of that chunk, so a checksum file that belongs to a chunk still being committed
+    # (or lost to a crash in between) counts as absent. inode is the chunk's, if the
+    # caller has it open already
+    try:
+        with open(f"{file_location}.crc") as checksum_file:
+            checksums = json.load(checksum_file)
+        if 'inode' in checksums:
+            if inode is None:
+                inode = os.stat(file_location).st_ino
+            if checksums['inode'] != inode:
+                return None
+        return checksums
+    except (OSError, ValueError):
+        return None
+
+
+def verify_chunk(file_location, start=0, stop=None, throttle=False):
+    # arguments file_location(str), start(int), stop(int), throttle(bool)
+    # Checks the checksum blocks covering bytes start to stop - 1 of a chunk, all of
+    # it by default. Returns True or False, or None if the chunk has no checksums.
+    # With throttle it reads no faster than scrub_bandwidth
+
+    with open(file_location, 'rb') as chunk_file:
+        stat = os.fstat(chunk_file.fileno())
+        checksums = load_checksums(file_location, stat.st_ino)
+        if checksums is None:
+            return None
+
+        size = stat.st_size
+        if size != checksums['size']:
+            return False
+        if size == 0:
+            return True
+
+        chunk_view = mmap.mmap(chunk_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    block_size = checksums['block_size']
+    stop = size if stop is None else stop
+    with chunk_view:
+        for block in range(start // block_size, (stop - 1) // block_size + 1):
+            data = chunk_view[block * block_size:(block + 1) * block_size]
+            if zlib.crc32(data) != checksums['blocks'][block]:
+                return False
+            if throttle and scrub_bandwidth > 0:
+                time.sleep(len(data) / scrub_bandwidth)
+    return True
+
+
+def quarantine_chunk(data_id, chunk_id, file_location):
+    # Moves a corrupt chunk out of the way, so it is neither served nor reported as
+    # stored, and tells the NameNode with the next heartbeat so it gets repaired
+    print(f"Chunk {chunk_id} of {data_id} failed its checksum, quarantined", flush=True)
+    try:
+        size = os.path.getsize(file_location)
+        os.replace(file_location, f"{file_location}.corrupt")
+    except OSError:
+        return
+    record_block_removed(data_id, chunk_id, size)
+    with block_state_lock:
+        block_changes['corrupt'].add((data_id, chunk_id))
+
+
+def chunk_is_corrupt(data_id, chunk_id, file_location, start=0, stop=None, throttle=False):
+    # Verifies a chunk and quarantines it if it is corrupt. A rewrite of the chunk can
+    # swap the chunk and its checksum file in between, so a mismatch is checked twice
+    if verify_chunk(file_location, start, stop, throttle) is not False:
+        return False
+    if verify_chunk(file_location, start, stop) is not False:
+        return False
+    quarantine_chunk(data_id, chunk_id, file_location)
+    return True
+
+
+def scrub_chunks():
+    # Re-verifies every cold chunk against its checksums, once every scrub_interval
+    # seconds and at no more than scrub_bandwidth bytes per second
+
+    while True:
+        time.sleep(scrub_interval)
+        started = time.monotonic()
+        scrub_stats['last_pass_started'] = time.time()
+
+        for (data_id, chunk_id), size in scan_blocks().items():
+            if time.monotonic() - chunk_last_access.get((data_id, chunk_id), 0) < scrub_cold_seconds:
+                # Hot chunks are checked by their readers
+                scrub_stats['skipped_hot'] += 1
+                continue
 
+            file_location = os.path.join(data_folder, data_id, chunk_id)
+            try:
+                if chunk_is_corrupt(data_id, chunk_id, file_location, throttle=True):
+                    scrub_stats['corrupt_found'] += 1
+            except OSError:
+                # Deleted while scrubbing
+                continue
+            scrub_stats['chunks_verified'] += 1
+            scrub_stats['bytes_verified'] += size
 
+        scrub_stats['passes'] += 1
+        scrub_stats['last_pass_seconds'] = round(time.monotonic() - started, 2)
+
+
+@app.route("/scrub_stats", methods=['GET'])
+def get_scrub_stats():
+    return dict(scrub_stats, interval=scrub_interval, bandwidth=scrub_bandwidth,
+                cold_seconds=scrub_cold_seconds)
+
+
+def fsync_path(path):
+    # Forces a file to disk by name. For a directory, makes the renames in it durable
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def group_committer():
+    # Collects the chunks finished within fsync_group_interval, fsyncs them with their
+    # checksum files, renames both into place and fsyncs each of their directories
+    # once for the whole batch
+
+    while True:
+        batch = [group_commit_queue.get()]
+        time.sleep(fsync_group_interval)
+        while not group_commit_queue.empty():
+            batch.append(group_commit_queue.get_nowait())
+
+        directories = set()
+        for chunk_file, temp_location, file_location, checksum_location, done in batch:
+            try:
+                fsync_path(checksum_location)
+                os.fdatasync(chunk_file.fileno())
+                os.replace(checksum_location, f"{file_location}.crc")
+                os.replace(temp_location, file_location)
+                directories.add(os.path.dirname(file_location))
+            except OSError as e:
+                done['error'] = e
+
+        for directory in directories:
+            try:
+                fsync_path(directory)
+            except OSError as e:
+                for _, _, file_location, _, done in batch:
+                    if os.path.dirname(file_location) == directory:
+                        done['error'] = e
+
+        for _, _, _, _, done in batch:
+            done['event'].set()
+
+
+def commit_chunk(chunk_file, temp_location, file_location, checksum_location):
+    # Moves a fully written chunk and its checksum file, written by write_checksums, to
+    # their final names, durably as fsync_policy asks. The checksum file goes first.
+    # Until then readers cannot see the chunk, so a crash never leaves a partial one
+    chunk_file.flush()
+
+    if fsync_policy == 'group':
+        done = {'event': threading.Event()}
+        group_commit_queue.put((chunk_file, temp_location, file_location, checksum_location, done))
+        done['event'].wait()
+        if 'error' in done:
+            raise done['error']
+        return
+
+    if fsync_policy == 'chunk':
+        fsync_path(checksum_location)
+        os.fsync(chunk_file.fileno())
+    os.replace(checksum_location, f"{file_location}.crc")
+    os.replace(temp_location, file_location)
+    if fsync_policy == 'chunk':
+        fsync_path(os.path.dirname(file_location))
+
+
+@app.route("/write_stats", methods=['GET'])
+def get_write_stats():
+    with write_stats_lock:
+        seconds = write_stats['write_seconds'] + write_stats['fsync_seconds']
+        return dict(write_stats, fsync_policy=fsync_policy,
+                    bytes_per_s=round(write_stats['bytes'] / seconds) if seconds else None)
+
+
+# Endpoint to receive and store files on the DataNode. The chunk is either a
+# multipart file part, or the raw request body with data_id, chunk_id and
+# downstream in the query string. Every DataNode listed in downstream receives
+# a copy: this node forwards each block to the next one while it is still
+# receiving the chunk, so replicas are written as a pipeline
 @app.route("/write_file/", methods=['POST'])
 def write_file():
-    data_id = request.form['data_id']
-    chunk_id = request.form['chunk_id']
-    file = request.files['file']
-    data_directory = os.path.join('root', secure_filename(data_id))
+    # The raw body is streamed to disk block by block. A multipart part has already
+    # been spooled by Werkzeug, it is only kept for older clients
+    if request.mimetype == 'multipart/form-data':
+        data_id = request.form['data_id']
+        chunk_id = request.form['chunk_id']
+        downstream = request.form.getlist('downstream')
+        codec = request.form.get('codec')
+        body = request.files['file'].stream
+    else:
+        data_id = request.args['data_id']
+        chunk_id = request.args['chunk_id']
+        downstream = request.args.getlist('downstream')
+        codec = request.args.get('codec')
+        body = request.stream
+
+    data_directory = os.path.join(data_folder, secure_filename(data_id))
     os.makedirs(data_directory, exist_ok=True)
     file_location = os.path.join(data_directory, secure_filename(chunk_id))
-    file.save(file_location)
+    previous_size = os.path.getsize(
+        file_location) if os.path.exists(file_location) else 0
+
+    pipeline = []
+    blocks = None
+    if downstream:
+        blocks = queue.Queue(maxsize=forward_queue_blocks)
+        forwarder = threading.Thread(
+            target=forward_chunk,
+            args=(blocks, data_id, chunk_id, downstream, pipeline, codec))
+        forwarder.start()
+
+    # The chunk is written under a temporary name and renamed once complete
+    temp_location = f"{file_location}.tmp-{uuid.uuid4().hex}"
+    checksum_location = None
+    size = 0
+    checksums = new_checksums()
+    started = time.monotonic()
+
+    forwarded = False
+
+    try:
+        with open(temp_location, 'wb') as chunk_file:
+            while True:
+                block = body.read(write_block_size)
+                if not block:
+                    break
+                chunk_file.write(block)
+                update_checksums(checksums, block)
+                size += len(block)
+                if blocks is not None:
+                    blocks.put(block)
+
+            # Some servers end the body early instead of failing when the client goes away
+            if body is request.stream and request.content_length is not None \
+                    and size != request.content_length:
+                raise IOError(f"Chunk {chunk_id} of {data_id} is truncated, got {
+                              size} of {request.content_length} bytes")
 
-    return {"data_id": data_id, "chunk_id": chunk_id, "file_location": file_location}
+            written = time.monotonic()
+            if blocks is not None:
+                # The downstream nodes commit their copies while this one does
+                blocks.put(None)
+                forwarded = True
+            checksums = finish_checksums(checksums, size)
+            if codec:
+                checksums['codec'] = codec
+            # The checksum file goes first, readers ignore it until the chunk with
+            # this inode is renamed into place
+            checksums['inode'] = os.fstat(chunk_file.fileno()).st_ino
+            checksum_location = write_checksums(file_location, checksums)
+            commit_chunk(chunk_file, temp_location, file_location, checksum_location)
+    except Exception as e:
+        if blocks is not None:
+            if not forwarded:
+                # Abort the downstream transfer so it does not store a truncated chunk
+                blocks.put(e)
+            forwarder.join()
+        for location in (temp_location, checksum_location):
+            if location and os.path.exists(location):
+                os.remove(location)
+        with write_stats_lock:
+            write_stats['failed'] += 1
+        raise
+
+    finished = time.monotonic()
+    bytes_per_s = round(size / (finished - started)) if finished > started else None
+    with write_stats_lock:
+        write_stats['chunks'] += 1
+        write_stats['bytes'] += size
+        write_stats['write_seconds'] += written - started
+        write_stats['fsync_seconds'] += finished - written
+        write_stats['last_bytes_per_s'] = bytes_per_s
+
+    if blocks is not None:
+        forwarder.join()
+
+    record_block_added(secure_filename(data_id), secure_filename(chunk_id),
+                       size, previous_size)
+    chunk_last_access[(secure_filename(data_id), secure_filename(chunk_id))] = time.monotonic()
+
+    # A good copy replaces a chunk quarantined earlier
+    if os.path.exists(f"{file_location}.corrupt"):
+        os.remove(f"{file_location}.corrupt")
+
+    return {"data_id": data_id, "chunk_id": chunk_id, "file_location": file_location,
+            "size": size, "checksum": checksums['crc'], "bytes_per_s": bytes_per_s,
+            "pipeline": pipeline}
 
 # Endpoint to read and retrieve a specific file chunk
 
@@ -69,37 +654,176 @@ def read_file(data_id, chunk_id):
     if not data_node_status["is_active"]:
         return {"status": "DataNode is not active"}, 503
 
-    data_directory = os.path.join(data_folder, secure_filename(data_id))
-    file_location = os.path.join(data_directory, secure_filename(chunk_id))
-
-    print(f"Reading file - data_id: {data_id}, chunk_id: {
-          chunk_id}, file_location: {file_location}")
+    data_id, chunk_id = secure_filename(data_id), secure_filename(chunk_id)
+    data_directory = os.path.join(data_folder, data_id)
+    file_location = os.path.join(data_directory, chunk_id)
 
-    if os.path.exists(file_location):
-        return send_file(file_location)
-    else:
-        print("File not found.")
+    if not is_chunk_file(chunk_id) or not os.path.exists(file_location):
         return abort(404, "File chunk not found")
 
+    chunk_last_access[(data_id, chunk_id)] = time.monotonic()
+
+    # "Range: bytes=start-end" gets a 206 with only those bytes, sliced from a memory
+    # map of the chunk so nothing else is read. Several ranges get the whole chunk
+    if request.range and len(request.range.ranges) == 1:
+        size = os.path.getsize(file_location)
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            return Response(status=416, headers={'Content-Range': f"bytes */{size}"})
+
+        start, stop = byte_range
+        # Only the checksum blocks the range touches are verified
+        if chunk_is_corrupt(data_id, chunk_id, file_location, start, stop):
+            return abort(500, "File chunk failed its checksum")
+        with open(file_location, 'rb') as chunk_file, \
+                mmap.mmap(chunk_file.fileno(), 0, access=mmap.ACCESS_READ) as chunk_view:
+            body = chunk_view[start:stop]
+        return Response(body, status=206, mimetype='application/octet-stream',
+                        headers={'Content-Range': f"bytes {start}-{stop - 1}/{size}"})
+
+    # Whole chunks go through the server's file wrapper, which gunicorn turns into
+    # a zero-copy sendfile from the page cache to the socket. The reader checks them
+    # against the chunk CRC32 kept by the NameNode
+    response = send_file(file_location, mimetype='application/octet-stream', conditional=False)
+
+    # The codec is only looked up for clients that accept one of its encodings, the
+    # NameNode asks for identity and decompresses itself
+    if any(request.accept_encodings[encoding] for encoding in content_encodings.values()):
+        codec = (load_checksums(file_location) or {}).get('codec')
+        encoding = content_encodings.get(codec)
+        if encoding and request.accept_encodings[encoding]:
+            response.headers['Content-Encoding'] = encoding
+            response.headers['X-Chunk-Codec'] = codec
+        response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
 
 # Endpoint to delete all chunks associated with a particular data_id
-@app.route("/delete_chunks/<data_id>", methods=['POST'])
-def delete_chunks(data_id):
+def remove_chunks(data_id):
+    # Deletes every chunk of a file. Returns False if there were none
     data_directory = os.path.join(data_folder, secure_filename(data_id))
-    if os.path.exists(data_directory):
-        for file_name in os.listdir(data_directory):
-            file_location = os.path.join(data_directory, file_name)
-            os.remove(file_location)
+    if not os.path.exists(data_directory):
+        return False
+
+    for file_name in os.listdir(data_directory):
+        file_location = os.path.join(data_directory, file_name)
+        size = os.path.getsize(file_location)
+        os.remove(file_location)
+        if is_chunk_file(file_name):
+            record_block_removed(secure_filename(data_id), file_name, size)
+            chunk_last_access.pop((secure_filename(data_id), file_name), None)
 
-        os.rmdir(data_directory)
+    os.rmdir(data_directory)
+    return True
+
+
+@app.route("/delete_chunks/<data_id>", methods=['POST'])
+def delete_chunks(data_id):
+    if remove_chunks(data_id):
         return {"message": f"Chunks for data_id {data_id} deleted successfully"}
     else:
         return abort(404, f"Chunks directory for data_id {data_id} not found")
 
 
+def remove_chunk(data_id, chunk_id):
+    # Deletes one chunk of a file, with its checksum file and a quarantined copy.
+    # Returns False if the chunk was not there
+    file_location = os.path.join(
+        data_folder, secure_filename(data_id), secure_filename(str(chunk_id)))
+    try:
+        size = os.path.getsize(file_location)
+        os.remove(file_location)
+    except FileNotFoundError:
+        found = False
+    else:
+        found = True
+        record_block_removed(secure_filename(data_id), secure_filename(str(chunk_id)), size)
+        chunk_last_access.pop((secure_filename(data_id), secure_filename(str(chunk_id))), None)
+
+    for location in (f"{file_location}.crc", f"{file_location}.corrupt"):
+        if os.path.exists(location):
+            os.remove(location)
+    return found
+
+
+# Bulk delete used by the NameNode's garbage collector, expects {"data_ids": [...]}
+# for whole files and {"chunks": [{"data_id", "chunk_id"}]} for single chunks of
+# files that other files still share chunks of
+@app.route("/delete_chunks", methods=['POST'])
+def bulk_delete_chunks():
+    body = request.get_json(silent=True) or {}
+    data_ids = body.get('data_ids', [])
+    chunks = body.get('chunks', [])
+    if not isinstance(data_ids, list) or not isinstance(chunks, list) or \
+            ('data_ids' not in body and 'chunks' not in body):
+        return abort(400, "data_ids or chunks is required")
+
+    deleted, not_found = [], []
+    for data_id in data_ids:
+        (deleted if remove_chunks(data_id) else not_found).append(data_id)
+
+    chunks_deleted, chunks_not_found = [], []
+    for chunk in chunks:
+        (chunks_deleted if remove_chunk(chunk['data_id'], chunk['chunk_id'])
+         else chunks_not_found).append(chunk)
+
+    return {"deleted": deleted, "not_found": not_found,
+            "chunks_deleted": chunks_deleted, "chunks_not_found": chunks_not_found}
+
+
+def start_background_threads():
+    heartbeat_thread = threading.Thread(target=send_heartbeats)
+    # This ensures the thread exits when the main process does
+    heartbeat_thread.daemon = True
+    heartbeat_thread.start()
+
+    if fsync_policy == 'group':
+        threading.Thread(target=group_committer, daemon=True).start()
+
+    threading.Thread(target=scrub_chunks, daemon=True).start()
+
+
+def run_gunicorn(port):
+    # A single gthread worker: the block changes and in-flight count reported in
+    # heartbeats live in this process, so all requests have to be served by it
+    from gunicorn.app.base import BaseApplication
+
+    class DataNodeApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"0.0.0.0:{port}")
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('workers', 1)
+            self.cfg.set('threads', server_threads)
+            self.cfg.set('timeout', 120)
+            self.cfg.set('keepalive', 30)
+            self.cfg.set('sendfile', True)
+            # Heartbeats run in the worker, which is where the requests are counted
+            self.cfg.set('post_worker_init',
+                         lambda worker: start_background_threads())
+
+        def load(self):
+            return app
+
+    DataNodeApplication().run()
+
+
 if __name__ == "__main__":
     # rerun
     port = int(os.getenv("PORT"))
 
-    # Run the Flask app on the specified port in debug mode
-    app.run(host='0.0.0.0', port=port, debug=True)
+    remove_stale_temp_chunks()
+
+    if server_mode == "dev":
+        start_background_threads()
+        # Run the Flask app on the specified port in debug mode. The reloader would
+        # start a second process sending its own heartbeats, so it stays off
+        app.run(host='0.0.0.0', port=port, debug=True, use_reloader=False)
+    else:
+        try:
+            run_gunicorn(port)
+        except ImportError:
+            print("gunicorn is not installed, serving with Werkzeug's threaded server")
+            # No log line per request on the hot path
+            logging.getLogger('werkzeug').setLevel(logging.WARNING)
+            start_background_threads()
+            app.run(host='0.0.0.0', port=port, threaded=True)
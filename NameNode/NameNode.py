@@ -1,15 +1,29 @@
 # importing all the libraries and modules required for the project
-from flask import Flask, request, jsonify, send_file, abort
-from collections import defaultdict
+from flask import Flask, request, jsonify, abort, Response, stream_with_context
+from collections import deque, OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 import os
-import io
+import re
+import json
+import base64
+import zlib
+import hashlib
+import lzma
+import bz2
 import uuid
+import random
+import heapq
+import bisect
+import itertools
 import threading
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from werkzeug.utils import secure_filename
 import time
 import pymongo
 import datetime
+import numpy as np
 from pymongo import MongoClient
 
 
@@ -42,19 +56,82 @@ active_datanodes_collection = db['active_datanodes']
 # Collection for failedNode_handled_status
 failedNode_handled_collection = db['failedNode_handled']
 
-# A dictionary to keep track of DataNode health status
-active_datanodes = {}
-# A dictionary to keep track of chunks and their locations on DataNodes
-chunks_location = {}
-# Lock for thread-safe operations on the chunks_location dictionary
-chunks_location_lock = threading.Lock()
+# Collection for tombstones of deleted files, one per (data_id, DataNode holding
+# chunks of it) with a chunk_id of None, or one per (data_id, chunk_id, DataNode) for
+# a single chunk freed while other chunks of its file are still referenced. Removed
+# once the garbage collector has deleted the chunks
+gc_collection = db['gc_tombstones']
+
+# Collection for the reference counts of stored chunks, one per chunk with the SHA-256
+# of its content. refs counts the chunks of files (copies included) whose bytes it
+# holds, the chunk is freed when it drops to 0
+chunk_refs_collection = db['chunk_refs']
+
+# Indexes the metadata queries rely on, as (collection, keys, options). Without them
+# every find_one on a file, chunk or replica is a collection scan
+metadata_indexes = [
+    (files_collection, [('directory_path', 1), ('name', 1)], {'unique': True}),
+    (files_collection, [('id', 1)], {}),
+    (chunks_collection, [('file_id', 1), ('chunk_id', 1)], {'unique': True}),
+    (chunks_collection, [('datanode_address', 1), ('file_id', 1)], {}),
+    (replication_collection, [('data_id', 1), ('chunk_id', 1), ('status', 1)], {}),
+    (replication_collection, [('datanode_address', 1),
+     ('data_id', 1), ('status', 1)], {}),
+    (directories_collection, [('path', 1)], {'unique': True}),
+    (active_datanodes_collection, [('address', 1)], {'unique': True}),
+    (failedNode_handled_collection, [('address', 1)], {}),
+    (gc_collection, [('datanode_address', 1),
+     ('data_id', 1), ('chunk_id', 1)], {'unique': True}),
+    (chunk_refs_collection, [('data_id', 1), ('chunk_id', 1)], {'unique': True}),
+    (chunk_refs_collection, [('digest', 1), ('refs', 1)], {}),
+]
+
+# Indexes replaced by one in metadata_indexes, dropped at startup, as (collection, name)
+retired_indexes = [
+    # Tombstones became per chunk, a second tombstone of the same file would collide
+    (gc_collection, 'datanode_address_1_data_id_1'),
+]
+
+# Outcome of the index check done at startup, reported by the query_plans endpoint
+index_status = {}
+
+# Whether the MongoDB deployment supports multi-document transactions, None until checked
+transactions_supported = None
 
-failed_node = []
+# In-memory namespace: directory path -> {'files': {file name: data_id}, 'folders': {folder name: None}}.
+# It holds every directory and file, and is the source for existence checks and listings
+namespace = {}
+# Number of namespace entries pointing at each data_id (copy_file shares data_ids)
+namespace_refs = {}
 
-# Keeps track of all paths which have to be deleted
-deletepaths = []
+# In-memory chunk map: data_id -> {'chunks': chunk documents sorted by chunk_id,
+# 'replicas': {chunk_id: [{'datanode_address', 'status'}]}}, least recently used first.
+# Only the metadata_cache_files most recently used files are kept
+chunk_map = OrderedDict()
+metadata_cache_files = int(os.getenv('METADATA_CACHE_FILES', 10000))
+metadata_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
 
-deletefolder_path = []
+# Lock for thread-safe operations on namespace and chunk_map. Writers update MongoDB
+# first and the in-memory copy second, so a failed write never shows up in memory
+metadata_lock = threading.RLock()
+
+# A dictionary to keep track of DataNode health status
+active_datanodes = {}
+
+# Probe statistics per DataNode address, filled by the health checker
+datanode_health = {}
+# Lock for thread-safe operations on the datanode_health dictionary
+datanode_health_lock = threading.Lock()
+
+# Latest heartbeat of each DataNode: disk capacity, load and when it arrived
+datanode_stats = {}
+# Chunks each DataNode reports holding, address -> {(data_id, chunk_id): size}
+datanode_blocks = {}
+# Bytes placed on each DataNode since its last heartbeat, which does not count
+# them yet. Keeps concurrent uploads from all picking the same emptiest node
+placement_pending_bytes = {}
+# Lock for thread-safe operations on datanode_stats and datanode_blocks
+datanode_stats_lock = threading.Lock()
 
 # # List of DataNode addresses - replace these with your actual DataNode addresses
 datanode_addresses = [
@@ -75,8 +152,218 @@ datanode_addresses = [
 # Replication factor
 replication_factor = 3
 
+# Chunk placement strategy, one of placement_strategies
+placement_strategy = os.getenv('PLACEMENT_STRATEGY', 'power_of_two')
+# Free space to leave on a DataNode's disk, nodes below it only get chunks when
+# every node is that full
+placement_min_free_bytes = int(
+    os.getenv('PLACEMENT_MIN_FREE_BYTES', 256 * 1024 * 1024))
+
 root_directory = "/"
 
+# Connection pool settings for NameNode -> DataNode traffic. Each DataNode gets its
+# own keep-alive session holding up to datanode_pool_size connections
+datanode_pool_size = int(os.getenv('DATANODE_POOL_SIZE', 32))
+datanode_connect_timeout = float(os.getenv('DATANODE_CONNECT_TIMEOUT', 3))
+datanode_read_timeout = float(os.getenv('DATANODE_READ_TIMEOUT', 60))
+# Retries on connection failures and 502/503/504 answers, with exponential backoff.
+# Every DataNode operation is idempotent (a chunk write overwrites the same file),
+# so writes and deletes are retried as well
+datanode_retries = int(os.getenv('DATANODE_RETRIES', 2))
+datanode_retry_backoff = float(os.getenv('DATANODE_RETRY_BACKOFF', 0.2))
+# Health probes fail fast and never retry, a missed probe is itself the signal
+health_probe_timeout = float(os.getenv('HEALTH_PROBE_TIMEOUT', 2))
+# Seconds between two rounds of health probes
+health_check_interval = float(os.getenv('HEALTH_CHECK_INTERVAL', 5))
+# Number of probes in a row a DataNode has to miss before it is declared dead
+health_failure_threshold = int(os.getenv('HEALTH_FAILURE_THRESHOLD', 3))
+# A DataNode that sent a heartbeat within this many seconds is alive and not probed
+heartbeat_timeout = float(os.getenv('HEARTBEAT_TIMEOUT', 10))
+
+# Sessions keyed by (DataNode address, purpose)
+datanode_sessions = {}
+# Lock for thread-safe operations on the datanode_sessions dictionary
+datanode_sessions_lock = threading.Lock()
+
+# Number of chunks get_file fetches from the DataNodes at the same time. This also
+# bounds the reorder buffer, so a download holds at most this many chunks in memory
+fetch_window = int(os.getenv('FETCH_WINDOW', 4))
+
+# Thread pool shared by all downloads for fetching chunks from the DataNodes
+fetch_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('FETCH_WORKERS', 16)))
+
+# Replica selection for chunk reads. Every read updates moving averages of the
+# latency and error rate of its DataNode, and reads go to the replica with the lowest
+# expected latency, where an error costs read_error_penalty_ms on top. A share of
+# read_explore_rate of the reads picks a random replica, so that a node that was slow
+# once gets measured again
+read_latency_alpha = float(os.getenv('READ_LATENCY_ALPHA', 0.2))
+read_error_penalty_ms = float(os.getenv('READ_ERROR_PENALTY_MS', 1000))
+read_explore_rate = float(os.getenv('READ_EXPLORE_RATE', 0.05))
+# Latencies of the latest reads kept per DataNode for its percentiles
+read_latency_window = int(os.getenv('READ_LATENCY_WINDOW', 200))
+
+# Hedged reads: a read that has not answered once it passes the hedge_percentile
+# latency of its DataNode gets a second request to the next replica, and the first
+# answer wins. HEDGED_READS=0 only fails over after an error. Until a DataNode has
+# hedge_min_samples reads, hedge_initial_delay (seconds) stands in for its percentile
+hedged_reads = int(os.getenv('HEDGED_READS', 1))
+hedge_percentile = float(os.getenv('HEDGE_PERCENTILE', 95))
+hedge_min_samples = int(os.getenv('HEDGE_MIN_SAMPLES', 20))
+hedge_initial_delay = float(os.getenv('HEDGE_INITIAL_DELAY', 0.5))
+# Never hedge sooner than this many seconds, fast reads are not worth a second request
+hedge_min_delay = float(os.getenv('HEDGE_MIN_DELAY', 0.01))
+
+# Per DataNode read statistics, and the totals of hedged reads. Reads run on many
+# threads at once, both are only updated with read_stats_lock held
+read_stats = {}
+read_stats_lock = threading.Lock()
+hedge_totals = {'reads': 0, 'hedged': 0, 'hedge_wins': 0, 'failovers': 0}
+
+# Thread pool for the replica requests of a read, which the fetching thread waits on
+# with a deadline. Separate from fetch_executor and ec_executor, whose threads wait on it
+hedge_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('HEDGE_WORKERS', 32)))
+
+# Hot chunk cache: chunks read by get_file and read_range are kept in memory,
+# uncompressed, up to chunk_cache_bytes, so popular files are not fetched from the
+# DataNodes on every download. CHUNK_CACHE_BYTES=0 turns it off. Chunks larger than
+# chunk_cache_max_item are never cached, one big file cannot flush all the others
+chunk_cache_bytes = int(os.getenv('CHUNK_CACHE_BYTES', 512 * 1024 * 1024))
+chunk_cache_max_item = int(os.getenv('CHUNK_CACHE_MAX_ITEM', chunk_cache_bytes // 4))
+# 'tinylfu' only admits a chunk into a full cache when it has been read more often
+# lately than every chunk it would evict, so a one-off scan cannot push out the hot
+# set. 'lru' admits every chunk and evicts the least recently used ones
+chunk_cache_admission = os.getenv('CHUNK_CACHE_ADMISSION', 'tinylfu')
+# Counters per row of the frequency sketch behind 'tinylfu'. All counts are halved
+# after 10 reads per counter, so that popularity fades
+chunk_cache_sketch_width = int(os.getenv('CHUNK_CACHE_SKETCH_WIDTH', 4096))
+
+# (data_id, chunk_id) -> chunk bytes, least recently used first, and the chunk_ids
+# cached per data_id for dropping a freed data_id
+chunk_cache = OrderedDict()
+chunk_cache_by_data_id = {}
+# Whole-chunk fetches in progress, (data_id, chunk_id) -> {'future', 'valid'}. Reads
+# of a chunk that is being fetched wait for that fetch instead of starting another
+chunk_cache_flights = {}
+# Count-min sketch of how often each chunk was read, 4 rows of saturating counters
+chunk_cache_sketch = [bytearray(chunk_cache_sketch_width) for _ in range(4)]
+chunk_cache_lock = threading.Lock()
+chunk_cache_totals = {'hits': 0, 'misses': 0, 'coalesced': 0, 'bytes_served': 0,
+                      'bytes_fetched': 0, 'bytes_cached': 0, 'evictions': 0,
+                      'rejected': 0, 'invalidated': 0, 'sketch_reads': 0}
+
+# Number of files get_info returns per page by default, and the most a client may ask for
+get_info_page_size = int(os.getenv('GET_INFO_PAGE_SIZE', 100))
+get_info_max_page_size = int(os.getenv('GET_INFO_MAX_PAGE_SIZE', 1000))
+
+# Chunk size used by upload_file_stream when the client does not pick one (64MB, as in GFS)
+default_chunk_size = int(os.getenv('CHUNK_SIZE', 64 * 1024 * 1024))
+
+# Chunk compression codecs by name, each a compress and a decompress function over
+# bytes. Another codec only needs an entry here (and in cli.py for the direct data path)
+compression_codecs = {
+    'zlib': {'compress': zlib.compress, 'decompress': zlib.decompress},
+    'lzma': {'compress': lzma.compress, 'decompress': lzma.decompress},
+    'bz2': {'compress': bz2.compress, 'decompress': bz2.decompress},
+}
+
+# Codec of files whose upload and directories do not pick one, 'none' stores them as they are
+default_compression = os.getenv('COMPRESSION', 'none')
+
+# Compression policies set on directories with /set_compression, path -> codec name.
+# A directory without one inherits the policy of its nearest ancestor
+directory_compression = {}
+
+# A chunk whose content is already stored is not sent to the DataNodes again, the new
+# file points at the stored copy instead. DEDUP=0 stores every chunk
+dedup_enabled = int(os.getenv('DEDUP', 1))
+# Updated by concurrent uploads and deletes with dedup_totals_lock held
+dedup_totals_lock = threading.Lock()
+dedup_totals = {'chunks_deduplicated': 0, 'bytes_deduplicated': 0, 'data_ids_freed': 0,
+                'chunks_freed': 0}
+
+# Erasure coding, the alternative to replication_factor full copies: every chunk of a
+# file with an erasure-coding policy is cut into k data shards plus m parity shards,
+# each stored once on a DataNode of its own, and any k of them rebuild the chunk.
+# Schemes are named 'rs-<k>-<m>', e.g. rs-6-3 stores 1.5 times the data and survives
+# the loss of any 3 DataNodes. ERASURE_CODING is the scheme of files whose upload and
+# directories do not pick one, 'none' replicates them
+default_erasure_coding = os.getenv('ERASURE_CODING', 'none')
+
+# Erasure-coding policies set on directories with /set_erasure_coding, path -> scheme,
+# inherited like directory_compression
+directory_erasure_coding = {}
+
+# Thread pool for shard reads and writes. The download, upload and re-replication
+# threads wait on it, so it is separate from their pools
+ec_executor = ThreadPoolExecutor(max_workers=int(os.getenv('EC_WORKERS', 32)))
+# Updated from the download, upload and re-replication threads with ec_totals_lock held
+ec_totals_lock = threading.Lock()
+ec_totals = {'chunks_encoded': 0, 'degraded_reads': 0, 'shards_reconstructed': 0}
+
+# Number of chunks of a streamed upload that may be on their way to the DataNodes
+# while the next one is read from the client
+upload_window = int(os.getenv('UPLOAD_WINDOW', 2))
+
+# Thread pool shared by all streamed uploads for writing chunks to the DataNodes
+upload_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('UPLOAD_WORKERS', 8)))
+
+# Uploads whose chunk placements were handed to a client by allocate_chunks but
+# which have not been committed yet, keyed by data_id
+pending_uploads = {}
+# Lock for thread-safe operations on the pending_uploads dictionary
+pending_uploads_lock = threading.Lock()
+
+# Seconds a client gets to write its chunks and commit the file after allocate_chunks
+pending_upload_ttl = int(os.getenv('PENDING_UPLOAD_TTL', 3600))
+
+# Number of chunks the re-replication daemon copies at the same time
+replication_workers = int(os.getenv('REPLICATION_WORKERS', 8))
+# Copies a single DataNode may take part in at once, as source or as target
+replication_node_concurrency = int(
+    os.getenv('REPLICATION_NODE_CONCURRENCY', 2))
+# Bytes per second of re-replication traffic a single DataNode may send or receive,
+# 0 for no limit
+replication_node_bandwidth = int(
+    os.getenv('REPLICATION_NODE_BANDWIDTH', 50 * 1024 * 1024))
+# Seconds between two full scans for under-replicated chunks, on top of the scan
+# done whenever a DataNode is declared dead
+replication_scan_interval = float(os.getenv('REPLICATION_SCAN_INTERVAL', 600))
+# Times a chunk is copied before the daemon gives up on it
+replication_max_attempts = int(os.getenv('REPLICATION_MAX_ATTEMPTS', 3))
+
+# Seconds between two garbage collection rounds, and the most data_ids sent to a
+# DataNode in one bulk delete
+gc_interval = float(os.getenv('GC_INTERVAL', 5))
+gc_batch_size = int(os.getenv('GC_BATCH_SIZE', 500))
+# Set by deletes to start a garbage collection round early
+gc_wakeup = threading.Event()
+# Updated by the per-DataNode collection threads with gc_totals_lock held
+gc_totals_lock = threading.Lock()
+gc_totals = {'rounds': 0, 'data_ids_deleted': 0, 'chunks_deleted': 0,
+             'requests': 0, 'failed_requests': 0, 'last_round': None}
+
+# Under-replicated chunks as a heap of (live replicas, sequence, data_id, chunk_id),
+# the chunks closest to being lost come first
+replication_queue = []
+# (data_id, chunk_id) of every chunk queued or being copied
+replication_queued = set()
+# Copies running right now, keyed by (data_id, chunk_id)
+replication_in_progress = {}
+# Copies each DataNode is taking part in right now
+replication_node_active = {}
+# Time from which each DataNode has bandwidth for more re-replication traffic
+replication_node_next_free = {}
+replication_sequence = itertools.count()
+replication_attempts = {}
+replication_totals = {'queued': 0, 'completed': 0, 'failed': 0, 'lost': 0, 'no_target': 0,
+                      'replicas_created': 0, 'bytes_copied': 0}
+# Guards every replication_* structure above, and wakes up the daemon
+replication_condition = threading.Condition()
+
 
 @app.route('/upload_file', methods=['POST'])
 def upload_file():
@@ -103,113 +390,1109 @@ def upload_file():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
 
-    split_file(request.files['file'].stream, number_of_chunks, data_id)
+    if file_exists(file.filename, directory_path):
+        return jsonify({'error': f"File '{file.filename}' already exists in {directory_path}"}), 409
+
+    # Optional codec for this file, overriding the directory's compression policy
+    compression = request.form.get('compression')
+    if unknown_codec(compression):
+        return jsonify({'error': f"Unknown compression codec '{compression}'"}), 400
+
+    # Optional erasure-coding scheme for this file, e.g. rs-6-3, or 'none' to replicate
+    # it whatever the directory's policy is
+    erasure_coding = request.form.get('erasure_coding')
+    if unknown_ec_scheme(erasure_coding):
+        return jsonify({'error': f"Unknown erasure-coding scheme '{erasure_coding}'"}), 400
+
+    scheme = erasure_coding_policy(directory_path, erasure_coding)
+    error = missing_ec_nodes(scheme)
+    if error:
+        return jsonify({'error': error}), 503
+
+    try:
+        chunk_records = split_file(
+            request.files['file'].stream, number_of_chunks, data_id,
+            compression_policy(directory_path, compression), scheme)
+    except Exception as e:
+        return jsonify({'error': f"Upload of {file.filename} failed: {e}"}), 500
+
+    # Refuse to record a file that has a chunk no DataNode managed to store
+    for record in chunk_records:
+        if not chunk_stored(record):
+            abandon_upload(data_id, chunk_records)
+            return jsonify({'error': f"Failed to store chunk {record['chunk_id']}"}), 500
 
     # now all the chunks have been distrubuted and the replication chunks have been distributed as well:
     # now to write the metadata in mongodb
+    try:
+        save_file_metadata(data_id, file.filename,
+                           directory_path, chunk_records)
+    except pymongo.errors.DuplicateKeyError:
+        # Another upload of the same name finished first
+        abandon_upload(data_id, chunk_records)
+        return jsonify({'error': f"File '{file.filename}' already exists in {directory_path}"}), 409
 
-    # Save file metadata in MongoDB -
+    return jsonify({"message": "File uploaded and split successfully", "data_id": data_id}), 200
+
+
+def save_file_metadata(data_id, file_name, directory_path, chunk_records):
+    # arguments data_id(str), file_name(str), directory_path(str), chunk_records(list)
+    # chunk_records hold one {'chunk_id', 'size', 'replicas'} record per chunk, where
+    # replicas lists {'address', 'status', 'checksum'} for every DataNode the chunk
+    # was sent to. checksum is the CRC32 the DataNode computed while storing it.
+    # A chunk stored compressed also has its 'codec' and 'stored_size', size is
+    # always the uncompressed size. 'digest' is the SHA-256 of the chunk, and a
+    # duplicate chunk has a 'ref' {'data_id', 'chunk_id'} to the stored copy instead
+    # of replicas. An erasure-coded chunk has an 'ec' layout instead, its shards get
+    # chunk documents of their own under the layout's data_id
+
+    # Build every document of the upload first, so they can be written in one batch
+    # per collection instead of one round trip per chunk
     file_data = {
         'id': data_id,
-        'name': file.filename,
-        'number_of_chunks': number_of_chunks,
+        'name': file_name,
+        'number_of_chunks': len(chunk_records),
+        'file_size': sum(record['size'] for record in chunk_records),
         'replication_factor': replication_factor,
         'directory_path': directory_path,
         'upload_time': datetime.datetime.now()
     }
-    files_collection.insert_one(file_data)
+    layout = next((record['ec'] for record in chunk_records if 'ec' in record), None)
+    if layout is not None:
+        file_data['erasure_coding'] = f"rs-{layout['k']}-{layout['m']}"
+
+    # The first DataNode holding the chunk is its primary, the rest of the pipeline
+    # are its replicas
+    chunk_documents = []
+    shard_documents = []
+    replication_entries = []
+    for record in chunk_records:
+        if 'ref' in record:
+            chunk_documents.append({
+                'file_id': data_id,
+                'chunk_id': record['chunk_id'],
+                'size': record['size'],
+                'digest': record['digest'],
+                'ref': record['ref']
+            })
+            continue
+
+        if 'ec' in record:
+            ec = record['ec']
+            chunk_document = {
+                'file_id': data_id,
+                'chunk_id': record['chunk_id'],
+                'size': record['size'],
+                'ec': {key: ec[key] for key in ('k', 'm', 'data_id', 'first', 'shard_size')}
+            }
+            # Every shard is stored once, 'shard' tells its place in the chunk
+            for index, shard in enumerate(ec['shards']):
+                shard_document = {
+                    'file_id': ec['data_id'],
+                    'chunk_id': ec['first'] + index,
+                    'datanode_address': shard['address'],
+                    'size': ec['shard_size'],
+                    'shard': {'k': ec['k'], 'm': ec['m'], 'first': ec['first'], 'index': index}
+                }
+                if shard.get('checksum') is not None:
+                    shard_document['checksum'] = shard['checksum']
+                shard_documents.append(shard_document)
+            replicas = []
+        else:
+            replicas = list(record['replicas'])
+            primary = next(
+                replica for replica in replicas if replica['status'] == 'success')
+            replicas.remove(primary)
 
-    # Save chunk locations in MongoDB
-    with chunks_location_lock:
-        for chunk_id, locations in chunks_location[data_id].items():
-            chunk_data = {
+            chunk_document = {
                 'file_id': data_id,
-                'chunk_id': chunk_id,
-                'datanode_address': locations[0]
+                'chunk_id': record['chunk_id'],
+                'datanode_address': primary['address'],
+                'size': record['size']
             }
-            chunks_collection.insert_one(chunk_data)
+            checksum = primary.get('checksum')
+            if checksum is not None:
+                chunk_document['checksum'] = checksum
+        if record.get('codec'):
+            chunk_document['codec'] = record['codec']
+            chunk_document['stored_size'] = record['stored_size']
+        if record.get('digest'):
+            chunk_document['digest'] = record['digest']
+        chunk_documents.append(chunk_document)
+
+        for replica in replicas:
+            status = replica['status']
+            # A replica that does not match the primary was damaged on its way
+            if status == 'success' and checksum is not None and \
+                    replica.get('checksum') not in (None, checksum):
+                status = 'corrupt'
+            replication_entries.append({
+                'data_id': data_id,
+                'chunk_id': record['chunk_id'],
+                'datanode_address': replica['address'],
+                'status': status
+            })
+
+    # The chunks this upload stored start with one reference each, plus one per
+    # duplicate of them in the same file. References to other files' chunks were
+    # already counted when the duplicates were found
+    inner_refs = Counter(record['ref']['chunk_id'] for record in chunk_records
+                         if record.get('ref', {}).get('data_id') == data_id)
+    chunk_refs = [{
+        'data_id': data_id,
+        'chunk_id': record['chunk_id'],
+        'digest': record['digest'],
+        'size': record['size'],
+        'refs': 1 + inner_refs[record['chunk_id']]
+    } for record in chunk_records if record.get('digest') and 'ref' not in record]
+
+    def write(session):
+        files_collection.insert_one(file_data, session=session)
+        if chunk_documents:
+            chunks_collection.insert_many(chunk_documents, session=session)
+        if shard_documents:
+            chunks_collection.insert_many(shard_documents, session=session)
+        if replication_entries:
+            replication_collection.insert_many(
+                replication_entries, session=session)
+        if chunk_refs:
+            chunk_refs_collection.insert_many(chunk_refs, session=session)
+
+        # Save directory information in MongoDB
+        directories_collection.update_one(
+            {'path': directory_path},
+            {'$addToSet': {'content': {'file_name': file_name}}},
+            session=session
+        )
 
-    # Save directory information in MongoDB
-    directories_collection.update_one(
-        {'path': directory_path},
-        {'$addToSet': {'content': {'file_name': file.filename}}}
-    )
+    run_metadata_transaction(write)
 
-    return jsonify({"message": "File uploaded and split successfully", "data_id": data_id}), 200
+    entry = {'chunks': [dict(chunk_document) for chunk_document in chunk_documents], 'replicas': {}}
+    for chunk_document in entry['chunks']:
+        chunk_document.pop('_id', None)
+    for replication_entry in replication_entries:
+        entry['replicas'].setdefault(replication_entry['chunk_id'], []).append(
+            {'datanode_address': replication_entry['datanode_address'], 'status': replication_entry['status']})
+    cache_add_file(file_name, directory_path, data_id, entry)
 
+    if shard_documents:
+        shard_entry = {'chunks': [dict(shard_document) for shard_document in shard_documents],
+                       'replicas': {}}
+        for shard_document in shard_entry['chunks']:
+            shard_document.pop('_id', None)
+        cache_chunk_map_entry(layout['data_id'], shard_entry)
 
-def directory_exists(directory_path):
-    # Check if the provided directory path exists
-    return directories_collection.find_one({'path': directory_path}) is not None
 
+def mongo_supports_transactions():
+    # Transactions need a replica set or a sharded cluster, a standalone mongod
+    # (the default docker-compose setup) rejects them. Checked once and remembered
+    global transactions_supported
 
-@app.route('/get_info', methods=['GET'])
-def get_info():
-    # Retrieve metadata from MongoDB for files, directories, and chunks
-    files_metadata = list(files_collection.find({}, {'_id': 0}))
-    directories_metadata = list(directories_collection.find({}, {'_id': 0}))
-    chunks_metadata = list(chunks_collection.find({}, {'_id': 0}))
-
-    print(directories_metadata, flush=True)
-
-    # Organize chunks by file name
-    file_chunks = defaultdict(list)
-    for chunk in chunks_metadata:
-        file_chunks[chunk['file_id']].append(chunk)
-
-    # Combine the retrieved metadata per file
-    files_with_chunks = {}
-    for file_info in files_metadata:
-        file_id = file_info['id']
-        if file_id in file_chunks:
-            # Retrieve chunks for the file_id directly
-            chunks_for_file = file_chunks[file_id]
-        else:
-            chunks_for_file = []  # If file_id not found, assign an empty list
+    if transactions_supported is None:
+        try:
+            hello = client.admin.command('hello')
+            transactions_supported = 'setName' in hello or hello.get(
+                'msg') == 'isdbgrid'
+        except pymongo.errors.PyMongoError:
+            transactions_supported = False
+
+    return transactions_supported
+
+
+def run_metadata_transaction(write):
+    # arguments write(function taking a pymongo session, or None)
+    # Runs a group of metadata writes atomically when MongoDB supports
+    # transactions, and as plain batched writes otherwise
+
+    if not mongo_supports_transactions():
+        return write(None)
+
+    with client.start_session() as session:
+        return session.with_transaction(write)
+
+
+@app.route('/allocate_chunks', methods=['POST'])
+def allocate_chunks():
+    # First step of a client-side upload: the NameNode only picks the DataNodes,
+    # the client writes the chunks to them directly and then calls commit_file.
+    # A client that sends the SHA-256 of every chunk (one 'digest' field per chunk, in
+    # order) gets a 'ref' instead of a pipeline for chunks that are already stored,
+    # and does not send them
+
+    file_name = request.form.get('file_name')
+    number_of_chunks = int(request.form.get('number_of_chunks', 0))
+    directory_path = request.form.get('directory_path', '/')
+    # Optional, lets the placement account for the real chunk sizes
+    file_size = int(request.form.get('file_size', 0))
+    compression = request.form.get('compression')
+    digests = request.form.getlist('digest')
 
-        files_with_chunks[file_id] = {
-            'file_info': file_info,
-            'chunks': chunks_for_file
+    if not directory_path.startswith('/'):
+        directory_path = '/' + directory_path
+
+    if not file_name or number_of_chunks < 1 or (digests and len(digests) != number_of_chunks):
+        return jsonify({'error': 'Invalid input parameters'}), 400
+
+    if unknown_codec(compression):
+        return jsonify({'error': f"Unknown compression codec '{compression}'"}), 400
+
+    if not directory_exists(directory_path) and directory_path != "/":
+        return jsonify({'error': 'Invalid directory path'}), 400
+
+    if file_exists(file_name, directory_path):
+        return jsonify({'error': f"File '{file_name}' already exists in {directory_path}"}), 409
+
+    # The parity is computed by the NameNode, which a client-side upload keeps out of
+    # the data path. erasure_coding 'none' replicates a file of an erasure-coded directory
+    erasure_coding = request.form.get('erasure_coding')
+    if unknown_ec_scheme(erasure_coding):
+        return jsonify({'error': f"Unknown erasure-coding scheme '{erasure_coding}'"}), 400
+    if erasure_coding_policy(directory_path, erasure_coding) is not None:
+        return jsonify({'error': 'Erasure-coded files are uploaded through upload_file '
+                        'or upload_file_stream'}), 400
+
+    active_nodes = get_active_nodes()
+    if not active_nodes:
+        return jsonify({'error': 'No active DataNodes'}), 503
+
+    data_id = str(uuid.uuid4())
+    chunk_size = (file_size // number_of_chunks +
+                  1) if file_size else default_chunk_size
+    load = placement_load(active_nodes)
+
+    placements = []
+    # Records of the duplicate chunks, by chunk_id, used as they are on commit
+    duplicates = {}
+    seen = {}
+    for i in range(number_of_chunks):
+        ref = find_duplicate(digests[i], seen, chunk_size) if digests else None
+        if ref is not None:
+            placements.append({'chunk_id': i+1, 'ref': ref})
+            duplicates[i+1] = {'chunk_id': i+1, 'digest': digests[i], 'ref': ref, 'replicas': []}
+            continue
+        placements.append({'chunk_id': i+1, 'pipeline': place_chunk(load, chunk_size)})
+        if digests:
+            seen[digests[i]] = {'data_id': data_id, 'chunk_id': i+1}
+
+    with pending_uploads_lock:
+        pending_uploads[data_id] = {
+            'file_name': file_name,
+            'directory_path': directory_path,
+            'number_of_chunks': number_of_chunks,
+            'duplicates': duplicates,
+            'allocated_at': time.time()
         }
 
-    directories_with_files = {}
+    expire_pending_uploads()
+
+    # The client compresses the chunks itself with this codec (None: it does not)
+    return jsonify({'data_id': data_id, 'chunks': placements,
+                    'compression': compression_policy(directory_path, compression)}), 200
+
+
+def expire_pending_uploads():
+    # Forgets allocations whose client never came back to commit them, and gives back
+    # the references they took on duplicate chunks. Run by allocate_chunks and by the
+    # garbage collector, so an idle NameNode reclaims them too
+
+    with pending_uploads_lock:
+        now = time.time()
+        expired = [pending_id for pending_id, pending in pending_uploads.items()
+                   if now - pending['allocated_at'] > pending_upload_ttl]
+        expired = [(pending_id, pending_uploads.pop(pending_id)) for pending_id in expired]
+
+    for expired_id, pending in expired:
+        abandon_upload(expired_id, list(pending['duplicates'].values()))
+
+
+@app.route('/commit_file', methods=['POST'])
+def commit_file():
+    # Second step of a client-side upload: records the chunks the client wrote.
+    # Expects a JSON body {'data_id', 'chunks': [{'chunk_id', 'size', 'replicas'}]},
+    # chunks the client compressed also carry their 'codec' and 'stored_size', and
+    # their 'digest' when the allocation was given digests. Chunks allocated with a
+    # 'ref' only need their chunk_id and size
+
+    commit = request.get_json(silent=True) or {}
+    data_id = commit.get('data_id')
+    chunk_records = commit.get('chunks', [])
+
+    with pending_uploads_lock:
+        pending = pending_uploads.get(data_id)
+
+    if pending is None:
+        return jsonify({'error': 'Unknown or expired data_id'}), 404
+
+    chunk_ids = sorted(record.get('chunk_id') for record in chunk_records)
+    if chunk_ids != list(range(1, pending['number_of_chunks'] + 1)):
+        return jsonify({'error': 'Chunk list does not match the allocation'}), 400
 
-    for directory_info in directories_metadata:
-        directory_name = directory_info['path']
-        file_names = [file_obj['file_name']
-                      for file_obj in directory_info['content']]
+    # Duplicates are recorded as allocated, whatever the client says about them, and
+    # only they can point at another chunk. Client-written chunks are never erasure coded
+    chunk_records = [dict(pending['duplicates'][record['chunk_id']], size=record.get('size'))
+                     if record['chunk_id'] in pending['duplicates'] else
+                     {key: value for key, value in record.items() if key not in ('ref', 'ec')}
+                     for record in chunk_records]
 
-        # Retrieve files_with_chunks information based on file_names
-        files_in_directory = {}
-        for file_name in file_names:
-            for file_id, file_data in files_with_chunks.items():
-                if file_data['file_info']['name'] == file_name:
-                    files_in_directory[file_id] = file_data
-                    break  # Stop searching once matched
+    for record in chunk_records:
+        if not isinstance(record.get('size'), int):
+            return jsonify({'error': f"Chunk {record['chunk_id']} has no size"}), 400
+        if not chunk_stored(record):
+            return jsonify({'error': f"Chunk {record['chunk_id']} was not stored on any DataNode"}), 400
+        if record.get('codec') and (record['codec'] not in compression_codecs or 'stored_size' not in record):
+            return jsonify({'error': f"Chunk {record['chunk_id']} has an unknown codec"}), 400
 
-        directories_with_files[directory_name] = {
-            'directory_info': directory_info,
-            'files_with_chunks': files_in_directory
+    with pending_uploads_lock:
+        # Only one commit per allocation
+        if pending_uploads.pop(data_id, None) is None:
+            return jsonify({'error': 'Unknown or expired data_id'}), 404
+
+    try:
+        save_file_metadata(data_id, pending['file_name'], pending['directory_path'],
+                           sorted(chunk_records, key=lambda record: record['chunk_id']))
+    except pymongo.errors.DuplicateKeyError:
+        abandon_upload(data_id, chunk_records)
+        return jsonify({'error': f"File '{pending['file_name']}' already exists in {pending['directory_path']}"}), 409
+
+    return jsonify({"message": "File committed successfully", "data_id": data_id}), 200
+
+
+@app.route('/chunk_locations', methods=['GET'])
+def chunk_locations():
+    # Tells a client where the chunks of a file live, so it can read them from
+    # the DataNodes itself. Every location is listed primary first
+
+    file_name = request.values.get('file_name')
+    directory_path = request.values.get('directory_path', '/')
+
+    data_id = lookup_file_id(file_name, directory_path)
+
+    if not data_id:
+        return jsonify({'error': 'File not found'}), 404
+
+    entry = get_chunk_map(data_id)
+    chunks = []
+    for chunk_info in entry['chunks']:
+        # A deduplicated chunk is read from the data_id and chunk_id it is stored under
+        stored_id, stored_info, stored_entry = resolve_chunk(data_id, entry, chunk_info)
+        if stored_info is None:
+            return jsonify({'error': f"Chunk {chunk_info['chunk_id']} is missing"}), 500
+        chunk = {
+            'chunk_id': chunk_info['chunk_id'],
+            'data_id': stored_id,
+            'stored_chunk_id': stored_info['chunk_id'],
+            'size': chunk_info.get('size'),
+            'checksum': stored_info.get('checksum'),
+            # The DataNodes serve a compressed chunk as it is stored, checksum covers
+            # those bytes
+            'codec': stored_info.get('codec'),
+            'stored_size': stored_info.get('stored_size', stored_info.get('size')),
+            'locations': []
         }
+        if 'ec' in stored_info:
+            # The data shards hold the stored bytes in order, the chunk is their
+            # concatenation cut to stored_size. Rebuilding it from the parity shards
+            # is left to the NameNode's read_range
+            ec = stored_info['ec']
+            shard_entry = get_chunk_map(ec['data_id'])
+            chunk['ec'] = {'k': ec['k'], 'm': ec['m'], 'shard_size': ec['shard_size'], 'data_shards': [{
+                'data_id': ec['data_id'],
+                'chunk_id': ec['first'] + index,
+                'checksum': shard_info.get('checksum'),
+                'locations': chunk_locations_of(shard_entry, shard_info)
+            } if shard_info else None for index, shard_info in enumerate(
+                stripe_shards(shard_entry, ec['first'], ec['k'] + ec['m'])[:ec['k']])]}
+        else:
+            chunk['locations'] = chunk_locations_of(stored_entry, stored_info)
+        chunks.append(chunk)
+
+    return jsonify({
+        'data_id': data_id,
+        'file_name': file_name,
+        'number_of_chunks': len(chunks),
+        'chunks': chunks
+    }), 200
+
+
+def read_fixed_size_chunks(stream, chunk_size):
+    # arguments stream(file like object), chunk_size(int)
+    # Generator which cuts a stream into chunk_size pieces as the bytes come in,
+    # the last piece holds whatever is left. An empty stream is one empty piece, so an
+    # empty file has a chunk just like one uploaded with /upload_file
+
+    first = True
+    while True:
+        chunk_data = bytearray()
+        while len(chunk_data) < chunk_size:
+            block = stream.read(min(chunk_size - len(chunk_data), 1024 * 1024))
+            if not block:
+                break
+            chunk_data += block
+
+        if not chunk_data and not first:
+            return
+        first = False
+        yield bytes(chunk_data)
+
+        if len(chunk_data) < chunk_size:
+            return
+
+
+@app.route('/upload_file_stream', methods=['POST'])
+def upload_file_stream():
+    # Uploads the raw request body in fixed-size chunks. Each chunk is sent to its
+    # DataNodes as soon as it has been received, so the upload size is unbounded and
+    # the chunk count is only known once the stream ends
+
+    file_name = request.args.get('file_name')
+    directory_path = request.args.get('directory_path', '/')
+    chunk_size = int(request.args.get('chunk_size', default_chunk_size))
+    compression = request.args.get('compression')
+    erasure_coding = request.args.get('erasure_coding')
+
+    if not directory_path.startswith('/'):
+        directory_path = '/' + directory_path
+
+    if not file_name or chunk_size < 1:
+        return jsonify({'error': 'Invalid input parameters'}), 400
+
+    if unknown_codec(compression):
+        return jsonify({'error': f"Unknown compression codec '{compression}'"}), 400
+
+    if unknown_ec_scheme(erasure_coding):
+        return jsonify({'error': f"Unknown erasure-coding scheme '{erasure_coding}'"}), 400
+
+    if not directory_exists(directory_path) and directory_path != "/":
+        return jsonify({'error': 'Invalid directory path'}), 400
+
+    if file_exists(file_name, directory_path):
+        return jsonify({'error': f"File '{file_name}' already exists in {directory_path}"}), 409
+
+    scheme = erasure_coding_policy(directory_path, erasure_coding)
+    error = missing_ec_nodes(scheme)
+    if error:
+        return jsonify({'error': error}), 503
+
+    load = placement_load(get_active_nodes())
+    data_id = str(uuid.uuid4())
+    codec = compression_policy(directory_path, compression)
+
+    # Bounds the chunks held in memory: one being read plus upload_window in flight
+    window = threading.BoundedSemaphore(max(1, upload_window))
+
+    def write_chunk(chunk_id, chunk_data, pipeline, digest):
+        # Chunks are compressed and erasure coded on the upload threads, next to the
+        # network writes
+        try:
+            return store_chunk(data_id, chunk_id, chunk_data, pipeline, codec, digest, scheme)
+        finally:
+            window.release()
+
+    futures = []
+    seen = {}
+    try:
+        for i, chunk_data in enumerate(read_fixed_size_chunks(request.stream, chunk_size)):
+            digest, record = dedup_chunk(i+1, chunk_data, seen)
+            if record is not None:
+                # Already stored, nothing to send
+                futures.append(Future())
+                futures[-1].set_result(record)
+                continue
+            seen[digest] = {'data_id': data_id, 'chunk_id': i+1}
+            window.acquire()
+            futures.append(upload_executor.submit(
+                write_chunk, i+1, chunk_data, place_for(load, len(chunk_data), scheme), digest))
+
+        chunk_records = [future.result() for future in futures]
+    except Exception as e:
+        # The client went away or a chunk write failed. The references taken on other
+        # files' chunks so far go back, otherwise they keep those chunks alive forever
+        wait(futures)
+        abandon_upload(data_id, [future.result() for future in futures
+                                 if future.exception() is None])
+        return jsonify({'error': f"Upload of {file_name} failed: {e}"}), 500
+
+    # Refuse to record a file that has a chunk no DataNode managed to store
+    for record in chunk_records:
+        if not chunk_stored(record):
+            abandon_upload(data_id, chunk_records)
+            return jsonify({'error': f"Failed to store chunk {record['chunk_id']}"}), 500
+
+    try:
+        save_file_metadata(data_id, file_name, directory_path, chunk_records)
+    except pymongo.errors.DuplicateKeyError:
+        abandon_upload(data_id, chunk_records)
+        return jsonify({'error': f"File '{file_name}' already exists in {directory_path}"}), 409
 
-    # Return the combined metadata per directory with files and chunks in a JSON response
     return jsonify({
-        'directories_with_files_and_chunks': directories_with_files
+        "message": "File uploaded and split successfully",
+        "data_id": data_id,
+        "number_of_chunks": len(chunk_records),
+        "file_size": sum(record['size'] for record in chunk_records)
+    }), 200
+
+
+def join_path(directory_path, name):
+    return directory_path.rstrip('/') + '/' + name
+
+
+def parent_path_of(directory_path):
+    # Returns (parent path, folder name) of a directory path
+    parent_path, folder_name = directory_path.rsplit('/', 1)
+    return parent_path or '/', folder_name
+
+
+def load_metadata_cache():
+    # Builds the namespace from MongoDB and warms the chunk map with the most
+    # recently uploaded files. Called once at startup
+
+    with metadata_lock:
+        namespace.clear()
+        namespace_refs.clear()
+        chunk_map.clear()
+        directory_compression.clear()
+        directory_erasure_coding.clear()
+        namespace[root_directory] = {'files': {}, 'folders': {}}
+
+        for directory in directories_collection.find(
+                {}, {'_id': 0, 'path': 1, 'compression': 1, 'erasure_coding': 1}):
+            namespace.setdefault(directory['path'], {
+                                 'files': {}, 'folders': {}})
+            if directory.get('compression'):
+                directory_compression[directory['path']] = directory['compression']
+            if directory.get('erasure_coding'):
+                directory_erasure_coding[directory['path']] = directory['erasure_coding']
+        for path in list(namespace):
+            if path != root_directory:
+                parent_path, folder_name = parent_path_of(path)
+                namespace.setdefault(parent_path, {'files': {}, 'folders': {}})[
+                    'folders'][folder_name] = None
+
+        for file_info in files_collection.find({}, {'_id': 0, 'id': 1, 'name': 1, 'directory_path': 1}):
+            cache_add_file(
+                file_info['name'], file_info['directory_path'], file_info['id'])
+
+    recent_ids = [file_info['id'] for file_info in files_collection.find(
+        {}, {'_id': 0, 'id': 1}).sort('upload_time', -1).limit(metadata_cache_files)]
+    for start in range(0, len(recent_ids), 500):
+        for data_id, entry in load_chunk_map_entries(recent_ids[start:start+500]).items():
+            cache_chunk_map_entry(data_id, entry)
+
+    print(f"Loaded {len(namespace)} directories and {
+          len(chunk_map)} chunk maps into memory", flush=True)
+
+
+def load_chunk_map_entries(data_ids):
+    # arguments data_ids(list of str)
+    # Reads the chunks and replicas of a batch of files from MongoDB
+
+    entries = {data_id: {'chunks': [], 'replicas': {}}
+               for data_id in data_ids}
+
+    for chunk_info in chunks_collection.find({'file_id': {'$in': data_ids}}, {'_id': 0}):
+        entries[chunk_info['file_id']]['chunks'].append(chunk_info)
+    for entry in entries.values():
+        entry['chunks'].sort(key=lambda chunk_info: chunk_info['chunk_id'])
+
+    for replica in replication_collection.find({'data_id': {'$in': data_ids}}, {'_id': 0}):
+        entries[replica['data_id']]['replicas'].setdefault(replica['chunk_id'], []).append(
+            {'datanode_address': replica['datanode_address'], 'status': replica['status']})
+
+    return entries
+
+
+def cache_chunk_map_entry(data_id, entry):
+    # Adds or refreshes a chunk map entry and evicts the coldest files over the bound
+    with metadata_lock:
+        chunk_map[data_id] = entry
+        chunk_map.move_to_end(data_id)
+        while len(chunk_map) > metadata_cache_files:
+            chunk_map.popitem(last=False)
+            metadata_cache_stats['evictions'] += 1
+
+
+def get_chunk_map(data_id):
+    # arguments data_id(str)
+    # Returns the chunk map entry of a file, loading it from MongoDB on a miss
+
+    with metadata_lock:
+        entry = chunk_map.get(data_id)
+        if entry is not None:
+            chunk_map.move_to_end(data_id)
+            metadata_cache_stats['hits'] += 1
+            return entry
+        metadata_cache_stats['misses'] += 1
+
+    entry = load_chunk_map_entries([data_id])[data_id]
+    cache_chunk_map_entry(data_id, entry)
+    return entry
+
+
+def chunk_locations_of(entry, chunk_info):
+    # Every DataNode holding a copy of the chunk, primary first. A primary is left out
+    # once it is found corrupt or missing
+    primary = [] if chunk_info.get('status') in ('corrupt', 'missing') else \
+        [chunk_info['datanode_address']]
+    return primary + [
+        replica['datanode_address'] for replica in entry['replicas'].get(chunk_info['chunk_id'], [])
+        if replica['status'] == 'success']
+
+
+def resolve_chunk(data_id, entry, chunk_info):
+    # arguments data_id(str), entry(dict) - the file's chunk map entry, chunk_info(dict)
+    # A deduplicated chunk is stored under the data_id and chunk_id of its ref. Returns
+    # (data_id, chunk_info, entry) of the chunk holding the bytes, with chunk_info None
+    # if it is missing
+
+    ref = chunk_info.get('ref')
+    if ref is None:
+        return data_id, chunk_info, entry
+
+    stored_entry = get_chunk_map(ref['data_id'])
+    stored_info = next((stored_info for stored_info in stored_entry['chunks']
+                        if stored_info['chunk_id'] == ref['chunk_id']), None)
+    return ref['data_id'], stored_info, stored_entry
+
+
+def stripe_shards(entry, first, width):
+    # arguments entry(dict) - chunk map entry of the shards, first(int) - chunk_id of
+    # shard 0, width(int) - k + m
+    # The shard documents of one erasure-coded chunk in shard order, None for a shard
+    # without one. Chunks are sorted by chunk_id, so this is a binary search
+    chunks = entry['chunks']
+    start = bisect.bisect_left(chunks, first, key=lambda chunk_info: chunk_info['chunk_id'])
+    shards = [None] * width
+    for chunk_info in chunks[start:start + width]:
+        if chunk_info['chunk_id'] < first + width:
+            shards[chunk_info['chunk_id'] - first] = chunk_info
+    return shards
+
+
+def lookup_file_id(file_name, directory_path):
+    # Returns the data_id of a file, or None if there is no such file
+    with metadata_lock:
+        directory = namespace.get(directory_path)
+        return directory['files'].get(file_name) if directory else None
+
+
+def directory_exists(directory_path):
+    # Check if the provided directory path exists
+    with metadata_lock:
+        return directory_path in namespace
+
+
+def file_exists(file_name, directory_path):
+    # Check if a file with this name is already stored in the directory
+    return lookup_file_id(file_name, directory_path) is not None
+
+
+def cache_add_directory(directory_path):
+    with metadata_lock:
+        namespace.setdefault(directory_path, {'files': {}, 'folders': {}})
+        parent_path, folder_name = parent_path_of(directory_path)
+        namespace.setdefault(parent_path, {'files': {}, 'folders': {}})[
+            'folders'][folder_name] = None
+
+
+def cache_remove_directory(directory_path):
+    with metadata_lock:
+        namespace.pop(directory_path, None)
+        directory_compression.pop(directory_path, None)
+        directory_erasure_coding.pop(directory_path, None)
+        parent_path, folder_name = parent_path_of(directory_path)
+        if parent_path in namespace:
+            namespace[parent_path]['folders'].pop(folder_name, None)
+
+
+def cache_add_file(file_name, directory_path, data_id, entry=None):
+    # Records a file in the namespace and, when given, its chunk map entry
+    with metadata_lock:
+        namespace.setdefault(directory_path, {'files': {}, 'folders': {}})[
+            'files'][file_name] = data_id
+        namespace_refs[data_id] = namespace_refs.get(data_id, 0) + 1
+    if entry is not None:
+        cache_chunk_map_entry(data_id, entry)
+
+
+def cache_remove_file(file_name, directory_path):
+    # Forgets a file. Its chunk map entry goes too, unless a copy still uses it
+    with metadata_lock:
+        directory = namespace.get(directory_path)
+        data_id = directory['files'].pop(
+            file_name, None) if directory else None
+        if data_id is not None:
+            namespace_refs[data_id] -= 1
+            if namespace_refs[data_id] == 0:
+                del namespace_refs[data_id]
+                chunk_map.pop(data_id, None)
+        return data_id
+
+
+def cache_add_replica(data_id, chunk_id, datanode_address, status):
+    # Records a new replica of a chunk, if the file's chunk map is in memory
+    with metadata_lock:
+        entry = chunk_map.get(data_id)
+        if entry is not None:
+            entry['replicas'].setdefault(chunk_id, []).append(
+                {'datanode_address': datanode_address, 'status': status})
+
+
+@app.route('/metadata_cache_stats', methods=['GET'])
+def get_metadata_cache_stats():
+    with metadata_lock:
+        return jsonify({
+            'directories': len(namespace),
+            'files': sum(len(directory['files']) for directory in namespace.values()),
+            'cached_chunk_maps': len(chunk_map),
+            'max_cached_chunk_maps': metadata_cache_files,
+            **metadata_cache_stats
+        })
+
+
+def ensure_indexes():
+    # Creates the indexes in metadata_indexes and checks that each one is really
+    # there, e.g. a unique index cannot be built over existing duplicates
+
+    for collection, name in retired_indexes:
+        if name in collection.index_information():
+            collection.drop_index(name)
+
+    for collection, keys, options in metadata_indexes:
+        name = '_'.join(f"{field}_{direction}" for field, direction in keys)
+        try:
+            collection.create_index(keys, name=name, **options)
+        except pymongo.errors.OperationFailure as e:
+            print(f"Failed to create index {name} on {
+                  collection.name}: {e}", flush=True)
+
+    for collection, keys, options in metadata_indexes:
+        existing = {tuple(tuple(key) for key in info['key']): info
+                    for info in collection.index_information().values()}
+        info = existing.get(tuple(keys))
+        present = info is not None and bool(info.get('unique')) == bool(
+            options.get('unique'))
+
+        index_status.setdefault(collection.name, {})[
+            '_'.join(f"{field}_{direction}" for field, direction in keys)] = 'ok' if present else 'missing'
+        if not present:
+            print(f"Index on {collection.name} {keys} is missing", flush=True)
+
+
+def summarize_query_plan(explain_output):
+    # arguments explain_output(dict) - the result of cursor.explain()
+    # Walks the winning plan and reports the stages used and the work done
+
+    winning_plan = explain_output['queryPlanner']['winningPlan']
+    # Plans from the slot based engine wrap the classic plan tree in 'queryPlan'
+    winning_plan = winning_plan.get('queryPlan', winning_plan)
+
+    stages = []
+    indexes = []
+    pending = [winning_plan]
+    while pending:
+        stage = pending.pop()
+        stages.append(stage.get('stage'))
+        if 'indexName' in stage:
+            indexes.append(stage['indexName'])
+        if 'inputStage' in stage:
+            pending.append(stage['inputStage'])
+        pending.extend(stage.get('inputStages', []))
+
+    execution_stats = explain_output.get('executionStats', {})
+    return {
+        'stages': stages,
+        'indexes': indexes,
+        'collection_scan': 'COLLSCAN' in stages,
+        'docs_examined': execution_stats.get('totalDocsExamined'),
+        'keys_examined': execution_stats.get('totalKeysExamined'),
+        'returned': execution_stats.get('nReturned'),
+        'time_ms': execution_stats.get('executionTimeMillis')
+    }
+
+
+@app.route('/query_plans', methods=['GET'])
+def query_plans():
+    # Diagnostic endpoint: explains the hot metadata queries against a real file
+    # (or placeholder values on an empty namespace) so that a schema change which
+    # turns one of them into a collection scan is easy to spot
+
+    sample_file = files_collection.find_one({}, {'_id': 0}) or {
+        'id': '', 'name': '', 'directory_path': '/'}
+    sample_chunk = chunks_collection.find_one(
+        {'file_id': sample_file['id']}, {'_id': 0}) or {'chunk_id': 1, 'datanode_address': ''}
+    # Deduplicated and erasure-coded chunks have no DataNode of their own
+    sample_chunk.setdefault('datanode_address', '')
+
+    hot_queries = {
+        'file_by_name': (files_collection, {'name': sample_file['name'], 'directory_path': sample_file['directory_path']}, None),
+        'file_by_id': (files_collection, {'id': sample_file['id']}, None),
+        'chunks_of_file': (chunks_collection, {'file_id': sample_file['id']}, [('chunk_id', 1)]),
+        'chunk_on_datanode': (chunks_collection, {'file_id': sample_file['id'], 'chunk_id': sample_chunk['chunk_id'], 'datanode_address': sample_chunk['datanode_address']}, None),
+        'chunks_on_datanode': (chunks_collection, {'datanode_address': sample_chunk['datanode_address'], 'file_id': sample_file['id']}, None),
+        'replicas_of_chunk': (replication_collection, {'data_id': sample_file['id'], 'chunk_id': sample_chunk['chunk_id'], 'status': 'success'}, None),
+        'replicas_on_datanode': (replication_collection, {'datanode_address': sample_chunk['datanode_address'], 'data_id': sample_file['id'], 'status': 'success'}, None),
+        'directory_by_path': (directories_collection, {'path': sample_file['directory_path']}, None),
+        'datanode_by_address': (active_datanodes_collection, {'address': sample_chunk['datanode_address']}, None),
+    }
+
+    plans = {}
+    for query_name, (collection, query_filter, sort) in hot_queries.items():
+        cursor = collection.find(query_filter)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = summarize_query_plan(cursor.explain())
+        plan['collection'] = collection.name
+        plans[query_name] = plan
+
+    return jsonify({
+        'indexes': index_status,
+        'queries': plans,
+        'collection_scans': [query_name for query_name, plan in plans.items() if plan['collection_scan']]
     })
 
 
-def fetch_chunk_from_datanode(datanode_address, data_id, chunk_id):
-    # arguments datanode_address(str), data_id(str), chunk_id(int)
+def encode_info_cursor(file_info):
+    # The cursor is the (directory_path, name) of the last file of a page, which is
+    # unique and matches the order get_info walks the files in
+    return base64.urlsafe_b64encode(json.dumps(
+        [file_info['directory_path'], file_info['name']]).encode()).decode()
+
+
+def decode_info_cursor(cursor):
+    directory_path, name = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return str(directory_path), str(name)
 
-    # Construct the endpoint to fetch the chunk from the DataNode
-    datanode_download_endpoint = f"{
-        datanode_address}/read_file/{data_id}/{chunk_id}"
+
+@app.route('/get_info', methods=['GET'])
+def get_info():
+    # Returns files with their chunks grouped per directory, one page at a time.
+    # Optional query parameters:
+    #   path       only files in this directory
+    #   recursive  with path, also files in its subdirectories
+    #   prefix     only files whose name starts with this
+    #   limit      files per page
+    #   cursor     next_cursor of the previous page
+    # The join and grouping run inside MongoDB and the response is streamed, so the
+    # NameNode never holds more than one page of documents. Directories without files
+    # are listed too, in path order between the others, unless a prefix is given
+
+    path = request.args.get('path')
+    recursive = request.args.get('recursive', '').lower() in ('1', 'true', 'yes')
+    prefix = request.args.get('prefix')
+    cursor = request.args.get('cursor')
 
     try:
-        response = requests.get(datanode_download_endpoint)
-        if response.status_code == 200:
-            # Return the content of the chunk if successfully fetched
+        limit = min(int(request.args.get('limit', get_info_page_size)),
+                    get_info_max_page_size)
+    except ValueError:
+        return jsonify({'error': 'Invalid limit'}), 400
+    if limit < 1:
+        return jsonify({'error': 'Invalid limit'}), 400
+
+    file_filter = []
+    directory_filter = []
+    if path:
+        if not path.startswith('/'):
+            path = '/' + path
+        if recursive:
+            path_pattern = f"^{re.escape(path.rstrip('/'))}(/|$)"
+            file_filter.append({'directory_path': {'$regex': path_pattern}})
+            directory_filter.append({'path': {'$regex': path_pattern}})
+        else:
+            file_filter.append({'directory_path': path})
+            directory_filter.append({'path': path})
+    if prefix:
+        file_filter.append({'name': {'$regex': f"^{re.escape(prefix)}"}})
+    if cursor:
+        try:
+            cursor_directory, cursor_name = decode_info_cursor(cursor)
+        except (ValueError, TypeError):
+            return jsonify({'error': 'Invalid cursor'}), 400
+        file_filter.append({'$or': [
+            {'directory_path': {'$gt': cursor_directory}},
+            {'directory_path': cursor_directory, 'name': {'$gt': cursor_name}}
+        ]})
+        # The cursor's directory was listed with its files on an earlier page
+        directory_filter.append({'path': {'$gt': cursor_directory}})
+
+    pipeline = [
+        {'$match': {'$and': file_filter} if file_filter else {}},
+        {'$sort': {'directory_path': 1, 'name': 1}},
+        {'$limit': limit},
+        {'$project': {'_id': 0}},
+        {'$replaceWith': {'file_info': '$$ROOT'}},
+        {'$lookup': {
+            'from': chunks_collection.name,
+            'localField': 'file_info.id',
+            'foreignField': 'file_id',
+            'pipeline': [{'$sort': {'chunk_id': 1}}, {'$project': {'_id': 0}}],
+            'as': 'chunks'
+        }},
+        # Files reach $group sorted by name, so $push keeps them in that order
+        {'$group': {
+            '_id': '$file_info.directory_path',
+            'files': {'$push': {'file_info': '$file_info', 'chunks': '$chunks'}}
+        }},
+        {'$sort': {'_id': 1}},
+        {'$lookup': {
+            'from': directories_collection.name,
+            'localField': '_id',
+            'foreignField': 'path',
+            'pipeline': [{'$project': {'_id': 0}}],
+            'as': 'directory_info'
+        }}
+    ]
+
+    directories = files_collection.aggregate(pipeline, batchSize=16)
+    # Directories without files never reach the aggregation above, walk the
+    # directories collection in the same order and merge them in. A prefix selects
+    # files, so with one only directories holding matching files are listed
+    if prefix:
+        all_directories = iter(())
+    else:
+        all_directories = directories_collection.find(
+            {'$and': directory_filter} if directory_filter else {},
+            {'_id': 0}).sort('path', 1).batch_size(16)
+
+    def generate():
+        last_file = None
+        returned = 0
+        listed = 0
+        pending = next(all_directories, None)
+
+        def empty_directory(directory_info):
+            return ('' if listed == 0 else ', ') + json.dumps(directory_info['path']) + ': ' + app.json.dumps({
+                'directory_info': directory_info,
+                'files_with_chunks': {}
+            })
+
+        yield '{"directories_with_files_and_chunks": {'
+        for directory in directories:
+            while pending is not None and pending['path'] <= directory['_id']:
+                if pending['path'] < directory['_id']:
+                    yield empty_directory(pending)
+                    listed += 1
+                pending = next(all_directories, None)
+
+            files_with_chunks = {}
+            for file_data in directory['files']:
+                files_with_chunks[file_data['file_info']['id']] = file_data
+                last_file = file_data['file_info']
+                returned += 1
+
+            directory_info = directory['directory_info'][0] if directory['directory_info'] else {
+                'path': directory['_id'], 'content': []}
+            yield ('' if listed == 0 else ', ') + json.dumps(directory['_id']) + ': ' + app.json.dumps({
+                'directory_info': directory_info,
+                'files_with_chunks': files_with_chunks
+            })
+            listed += 1
+
+        # On a full page the directories after the last file belong to the next one
+        if returned < limit:
+            while pending is not None:
+                yield empty_directory(pending)
+                listed += 1
+                pending = next(all_directories, None)
+
+        # A full page means there may be more files after the last one
+        next_cursor = encode_info_cursor(
+            last_file) if returned == limit else None
+        yield '}, "next_cursor": ' + json.dumps(next_cursor) + '}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+def get_datanode_session(datanode_address, purpose='data'):
+    # arguments datanode_address(str), purpose(str) - 'data' or 'probe'
+    # Returns the pooled keep-alive session used to talk to a DataNode
+
+    key = (datanode_address, purpose)
+    with datanode_sessions_lock:
+        session = datanode_sessions.get(key)
+        if session is None:
+            if purpose == 'probe':
+                retries = Retry(total=0, raise_on_status=False)
+            else:
+                retries = Retry(
+                    total=datanode_retries,
+                    read=0,
+                    backoff_factor=datanode_retry_backoff,
+                    status_forcelist=(502, 503, 504),
+                    allowed_methods=None,
+                    raise_on_status=False)
+
+            session = requests.Session()
+            session.mount(datanode_address, HTTPAdapter(
+                pool_connections=1, pool_maxsize=datanode_pool_size, max_retries=retries))
+            datanode_sessions[key] = session
+        return session
+
+
+def datanode_request(method, datanode_address, path, purpose='data', **kwargs):
+    # arguments method(str), datanode_address(str), path(str), purpose(str), kwargs passed to requests
+    # Every NameNode -> DataNode call goes through here, so that it reuses a pooled
+    # connection and can never hang without a timeout
+
+    if purpose == 'probe':
+        kwargs.setdefault('timeout', health_probe_timeout)
+    else:
+        kwargs.setdefault(
+            'timeout', (datanode_connect_timeout, datanode_read_timeout))
+
+    session = get_datanode_session(datanode_address, purpose)
+    return session.request(method, f"{datanode_address}{path}", **kwargs)
+
+
+@app.route('/datanode_pool_stats', methods=['GET'])
+def datanode_pool_stats():
+    # Reports connection reuse per DataNode: a hit is a request served on an
+    # existing keep-alive connection, a miss had to open a new one
+    stats = {}
+
+    with datanode_sessions_lock:
+        sessions = list(datanode_sessions.items())
+
+    for (address, purpose), session in sessions:
+        requests_sent = connections_opened = 0
+        pools = session.get_adapter(address).poolmanager.pools
+        for pool_key in pools.keys():
+            pool = pools.get(pool_key)
+            if pool is not None:
+                requests_sent += pool.num_requests
+                connections_opened += pool.num_connections
+
+        stats.setdefault(address, {})[purpose] = {
+            'requests': requests_sent,
+            'hits': requests_sent - connections_opened,
+            'misses': connections_opened,
+            'pool_size': datanode_pool_size
+        }
+
+    return jsonify(stats)
+
+
+def fetch_chunk_from_datanode(datanode_address, data_id, chunk_id, byte_range=None):
+    # arguments datanode_address(str), data_id(str), chunk_id(int), byte_range((start, stop) or None)
+    # Fetches the whole chunk, or only bytes start to stop - 1 of it, as stored on the
+    # DataNode: a compressed chunk comes back compressed
+
+    # identity keeps the DataNode from labelling a compressed chunk with a
+    # Content-Encoding, which requests would decode before the checksum is checked
+    headers = {'Accept-Encoding': 'identity'}
+    if byte_range:
+        headers['Range'] = f"bytes={byte_range[0]}-{byte_range[1] - 1}"
+
+    try:
+        # Fetch the chunk from the DataNode
+        response = datanode_request(
+            'GET', datanode_address, f"/read_file/{data_id}/{chunk_id}", headers=headers)
+        if byte_range and response.status_code == 206:
             return response.content
+        if response.status_code == 200:
+            # Return the content of the chunk if successfully fetched. A DataNode that
+            # ignored the Range header sent all of it
+            return response.content[byte_range[0]:byte_range[1]] if byte_range else response.content
         else:
             # Display an error message if fetching the chunk fails
             print(f"Failed to fetch chunk {chunk_id} from {datanode_address}")
@@ -220,152 +1503,1149 @@ def fetch_chunk_from_datanode(datanode_address, data_id, chunk_id):
         return None
 
 
+def node_read_stats(address):
+    # The read statistics of a DataNode, created on its first read. Must be called
+    # with read_stats_lock held
+    stats = read_stats.get(address)
+    if stats is None:
+        stats = read_stats[address] = {
+            'reads': 0, 'errors': 0, 'in_flight': 0, 'avg_latency_ms': None, 'error_rate': 0.0,
+            'recent': deque(maxlen=max(1, read_latency_window)), 'hedged_away': 0}
+    return stats
+
+
+def start_read(address):
+    with read_stats_lock:
+        node_read_stats(address)['in_flight'] += 1
+
+
+def record_read(address, latency, ok):
+    # arguments address(str), latency(float) - seconds, ok(bool)
+    # Folds one finished read into the moving averages of its DataNode
+
+    with read_stats_lock:
+        stats = node_read_stats(address)
+        latency_ms = latency * 1000
+        stats['in_flight'] -= 1
+        stats['reads'] += 1
+        stats['error_rate'] = (1 - read_latency_alpha) * stats['error_rate'] + \
+            read_latency_alpha * (0 if ok else 1)
+        if ok:
+            stats['avg_latency_ms'] = latency_ms if stats['avg_latency_ms'] is None else \
+                (1 - read_latency_alpha) * stats['avg_latency_ms'] + read_latency_alpha * latency_ms
+            stats['recent'].append(latency_ms)
+        else:
+            stats['errors'] += 1
+
+
+def read_percentile(stats, percentile):
+    # Latency percentile in ms of the recent reads of a DataNode, None without reads
+    recent = sorted(stats['recent'])
+    if not recent:
+        return None
+    return recent[min(len(recent) - 1, int(len(recent) * percentile / 100))]
+
+
+def rank_replicas(locations):
+    # arguments locations(list of DataNode addresses)
+    # Orders the DataNodes holding a chunk by expected read latency, best first: the
+    # average latency, once more for every read already waiting on the DataNode, plus
+    # the cost of its errors. DataNodes without reads yet come first so they get
+    # measured, dead ones last
+
+    def expected_latency(address):
+        stats = read_stats.get(address)
+        if stats is None:
+            return 0
+        latency_ms = stats['avg_latency_ms'] if stats['avg_latency_ms'] is not None else \
+            hedge_initial_delay * 1000
+        return latency_ms * (1 + stats['in_flight']) + stats['error_rate'] * read_error_penalty_ms
+
+    locations = list(dict.fromkeys(locations))
+    if random.random() < read_explore_rate:
+        random.shuffle(locations)
+    else:
+        with read_stats_lock:
+            # Random tie-breaks spread the reads over equally good replicas
+            locations.sort(key=lambda address: (expected_latency(address), random.random()))
+    return sorted(locations, key=lambda address: not is_datanode_live(address))
+
+
+def hedge_delay(address):
+    # Seconds to wait for a read from a DataNode before hedging it
+    with read_stats_lock:
+        stats = read_stats.get(address)
+        if stats is None or len(stats['recent']) < hedge_min_samples:
+            return hedge_initial_delay
+        return max(hedge_min_delay, read_percentile(stats, hedge_percentile) / 1000)
+
+
+def fetch_chunk_with_fallback(data_id, chunk_id, locations, byte_range=None, checksum=None,
+                              codec=None):
+    # arguments data_id(str), chunk_id(int), locations(list of DataNode addresses, primary first),
+    # byte_range((start, stop) or None), checksum(int or None) - CRC32 of the whole chunk,
+    # codec(str or None) - codec the chunk is stored with
+    # Reads from the replica rank_replicas expects to be fastest. When it has not
+    # answered by its hedge_delay, the next replica is asked as well and the first good
+    # answer wins; a failed read moves on to the next replica right away. Whole chunks
+    # are checked against checksum, ranges are checked by the DataNode, and a corrupt
+    # copy counts as a failed read. Returns uncompressed bytes
+
+    # A range of a compressed chunk is cut out after decompressing all of it
+    fetch_range = None if codec else byte_range
+
+    def read_from(datanode_address):
+        start_read(datanode_address)
+        started = time.monotonic()
+        file_chunk = fetch_chunk_from_datanode(
+            datanode_address, data_id, chunk_id, fetch_range)
+        if file_chunk is not None and fetch_range is None and checksum is not None \
+                and zlib.crc32(file_chunk) != checksum:
+            report_corrupt_replica(data_id, chunk_id, datanode_address)
+            file_chunk = None
+        record_read(datanode_address, time.monotonic() - started, file_chunk is not None)
+        return file_chunk
+
+    remaining = rank_replicas(locations)
+    with read_stats_lock:
+        hedge_totals['reads'] += 1
+    file_chunk = None
+
+    if len(remaining) == 1:
+        # Nothing to hedge with
+        file_chunk = read_from(remaining[0])
+    else:
+        in_flight = {}
+        first = None
+        while remaining or in_flight:
+            if not in_flight:
+                if first is not None:
+                    with read_stats_lock:
+                        hedge_totals['failovers'] += 1
+                address = remaining.pop(0)
+                in_flight[hedge_executor.submit(read_from, address)] = address
+                first = first or address
+
+            # The newest request sets the deadline for the next one
+            timeout = hedge_delay(address) if hedged_reads and remaining else None
+            done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                with read_stats_lock:
+                    hedge_totals['hedged'] += 1
+                    node_read_stats(address)['hedged_away'] += 1
+                address = remaining.pop(0)
+                in_flight[hedge_executor.submit(read_from, address)] = address
+                continue
+
+            for future in done:
+                winner = in_flight.pop(future)
+                file_chunk = future.result()
+                if file_chunk is not None:
+                    break
+            if file_chunk is not None:
+                if winner != first:
+                    with read_stats_lock:
+                        hedge_totals['hedge_wins'] += 1
+                # The slower requests finish in the background, their latency still counts
+                break
+
+    if file_chunk is None:
+        print(f"No replica available for chunk {chunk_id}")
+        return None
+
+    if codec:
+        file_chunk = decompress_chunk(file_chunk, codec)
+        if byte_range:
+            file_chunk = file_chunk[byte_range[0]:byte_range[1]]
+    return file_chunk
+
+
+@app.route('/replica_stats', methods=['GET'])
+def replica_stats():
+    # Read latency and error rate per DataNode as the replica selection sees them,
+    # and how often reads were hedged
+    with read_stats_lock:
+        nodes = {address: {
+            'reads': stats['reads'],
+            'errors': stats['errors'],
+            'in_flight': stats['in_flight'],
+            'avg_latency_ms': round(stats['avg_latency_ms'], 2) if stats['avg_latency_ms'] is not None else None,
+            'error_rate': round(stats['error_rate'], 4),
+            'p50_ms': read_percentile(stats, 50),
+            f"p{hedge_percentile:g}_ms": read_percentile(stats, hedge_percentile),
+            'hedged_away': stats['hedged_away'],
+            'hedge_delay_ms': None,
+            'live': is_datanode_live(address)
+        } for address, stats in read_stats.items()}
+        totals = dict(hedge_totals)
+    for address, node in nodes.items():
+        node['hedge_delay_ms'] = round(hedge_delay(address) * 1000, 2)
+    return jsonify({'datanodes': nodes, 'totals': totals, 'hedged_reads': bool(hedged_reads)})
+
+
+def fetch_ec_chunk(chunk_info, byte_range=None):
+    # arguments chunk_info(dict) - chunk document with an 'ec' layout, byte_range((start, stop) or None)
+    # Reads an erasure-coded chunk. The data shards are fetched first, all at once, and
+    # hold the chunk as it is stored. For every one that cannot be read (dead DataNode,
+    # corrupt copy) a parity shard is fetched instead and the missing bytes are rebuilt
+    # on the fly. Returns uncompressed bytes, or None with fewer than k shards left
+
+    ec = chunk_info['ec']
+    k, m, shard_size = ec['k'], ec['m'], ec['shard_size']
+    shard_entry = get_chunk_map(ec['data_id'])
+    shards = stripe_shards(shard_entry, ec['first'], k + m)
+    stored_size = chunk_info.get('stored_size', chunk_info['size'])
+    codec = chunk_info.get('codec')
+
+    def fetch_shard(index, shard_range=None):
+        shard_info = shards[index]
+        if shard_info is None:
+            return None
+        return fetch_chunk_with_fallback(
+            ec['data_id'], shard_info['chunk_id'], chunk_locations_of(shard_entry, shard_info),
+            shard_range, shard_info.get('checksum'))
+
+    if byte_range and not codec:
+        # A range of an uncompressed chunk only needs the data shards it falls in, and
+        # only their bytes within it
+        start, stop = byte_range
+        covered = range(start // shard_size, (stop - 1) // shard_size + 1)
+        pieces = list(ec_executor.map(lambda index: fetch_shard(index, (
+            max(start, index * shard_size) - index * shard_size,
+            min(stop, (index + 1) * shard_size) - index * shard_size)), covered))
+        if all(piece is not None for piece in pieces):
+            return b''.join(pieces)
+
+    available = {}
+    candidates = list(range(k + m))
+    while len(available) < k:
+        wanted, candidates = candidates[:k - len(available)], candidates[k - len(available):]
+        if not wanted:
+            print(f"Fewer than {k} shards left of chunk {chunk_info['chunk_id']}", flush=True)
+            return None
+        for index, shard in zip(wanted, ec_executor.map(fetch_shard, wanted)):
+            if shard is not None:
+                available[index] = shard
+
+    if any(index >= k for index in available):
+        with ec_totals_lock:
+            ec_totals['degraded_reads'] += 1
+    file_chunk = decompress_chunk(rs_decode(available, k, m, stored_size), codec)
+    return file_chunk[byte_range[0]:byte_range[1]] if byte_range else file_chunk
+
+
+def sketch_counters(key):
+    # The counter of a chunk in every row of the frequency sketch
+    return [(row, hash((row, key)) % chunk_cache_sketch_width) for row in range(len(chunk_cache_sketch))]
+
+
+def sketch_increment(key):
+    # Counts a read of a chunk. Must be called with chunk_cache_lock held
+    for row, counter in sketch_counters(key):
+        if chunk_cache_sketch[row][counter] < 255:
+            chunk_cache_sketch[row][counter] += 1
+
+    chunk_cache_totals['sketch_reads'] += 1
+    if chunk_cache_totals['sketch_reads'] >= chunk_cache_sketch_width * 10:
+        chunk_cache_totals['sketch_reads'] = 0
+        for row in chunk_cache_sketch:
+            row[:] = bytes(count >> 1 for count in row)
+
+
+def sketch_estimate(key):
+    # How often a chunk was read lately, possibly overcounted by collisions
+    return min(chunk_cache_sketch[row][counter] for row, counter in sketch_counters(key))
+
+
+def admit_cached_chunk(key, file_chunk):
+    # arguments key((data_id, chunk_id)), file_chunk(bytes)
+    # Adds a fetched chunk to the cache, evicting least recently used chunks to make
+    # room when the admission policy lets it in. Must be called with chunk_cache_lock held
+
+    size = len(file_chunk)
+    if size > min(chunk_cache_max_item, chunk_cache_bytes) or key in chunk_cache:
+        return
+
+    victims = []
+    free = chunk_cache_bytes - chunk_cache_totals['bytes_cached']
+    for victim, cached in chunk_cache.items():
+        if free >= size:
+            break
+        victims.append(victim)
+        free += len(cached)
+
+    if victims and chunk_cache_admission == 'tinylfu':
+        frequency = sketch_estimate(key)
+        if any(sketch_estimate(victim) >= frequency for victim in victims):
+            chunk_cache_totals['rejected'] += 1
+            return
+
+    for victim in victims:
+        drop_cached_chunk(victim)
+        chunk_cache_totals['evictions'] += 1
+
+    chunk_cache[key] = file_chunk
+    chunk_cache_by_data_id.setdefault(key[0], set()).add(key[1])
+    chunk_cache_totals['bytes_cached'] += size
+
+
+def drop_cached_chunk(key):
+    # Must be called with chunk_cache_lock held
+    file_chunk = chunk_cache.pop(key)
+    chunk_cache_totals['bytes_cached'] -= len(file_chunk)
+    chunk_ids = chunk_cache_by_data_id[key[0]]
+    chunk_ids.discard(key[1])
+    if not chunk_ids:
+        del chunk_cache_by_data_id[key[0]]
+
+
+def invalidate_cached_chunks(data_ids, chunks=()):
+    # arguments data_ids(iterable of str), chunks(iterable of (data_id, chunk_id))
+    # Drops the cached chunks of freed data_ids and the freed chunks, and keeps the
+    # fetches of them that are still in progress from adding them back
+
+    data_ids = set(data_ids)
+    chunks = set(chunks)
+    with chunk_cache_lock:
+        for data_id in data_ids:
+            for chunk_id in list(chunk_cache_by_data_id.get(data_id, ())):
+                drop_cached_chunk((data_id, chunk_id))
+                chunk_cache_totals['invalidated'] += 1
+        for key in chunks:
+            if key in chunk_cache:
+                drop_cached_chunk(key)
+                chunk_cache_totals['invalidated'] += 1
+        for key, flight in chunk_cache_flights.items():
+            if key[0] in data_ids or key in chunks:
+                flight['valid'] = False
+
+
+def piece_of(future, byte_range):
+    # A future of bytes start to stop - 1 of the chunk that future resolves to
+    if not byte_range:
+        return future
+
+    piece = Future()
+    # Running futures cannot be cancelled, the reads sharing a fetch must not cancel it
+    piece.set_running_or_notify_cancel()
+
+    def cut(done):
+        if done.exception() is not None:
+            piece.set_exception(done.exception())
+        else:
+            file_chunk = done.result()
+            piece.set_result(None if file_chunk is None else file_chunk[byte_range[0]:byte_range[1]])
+
+    future.add_done_callback(cut)
+    return piece
+
+
+def read_chunk_cached(stored_id, stored_info, byte_range, read):
+    # arguments stored_id(str), stored_info(dict) - chunk document the chunk is stored as,
+    # byte_range((start, stop) or None), read(function) - fetches the chunk, or a range
+    # of it, from the DataNodes
+    # Returns a future of the chunk, or of bytes start to stop - 1 of it. Cached chunks
+    # are answered right away, a chunk that another read is fetching is shared with
+    # it, and only a miss reaches the DataNodes. A range of an uncompressed chunk that
+    # is not cached is fetched on its own and not cached, the whole chunk is not needed
+
+    if chunk_cache_bytes <= 0:
+        return fetch_executor.submit(read, byte_range)
+
+    key = (stored_id, stored_info['chunk_id'])
+    with chunk_cache_lock:
+        sketch_increment(key)
+        file_chunk = chunk_cache.get(key)
+        if file_chunk is not None:
+            chunk_cache.move_to_end(key)
+            chunk_cache_totals['hits'] += 1
+            if byte_range:
+                file_chunk = file_chunk[byte_range[0]:byte_range[1]]
+            chunk_cache_totals['bytes_served'] += len(file_chunk)
+            future = Future()
+            future.set_result(file_chunk)
+            return future
+
+        chunk_cache_totals['misses'] += 1
+        flight = chunk_cache_flights.get(key)
+        if flight is not None:
+            chunk_cache_totals['coalesced'] += 1
+            return piece_of(flight['future'], byte_range)
+
+        if byte_range and not stored_info.get('codec'):
+            return fetch_executor.submit(read, byte_range)
+
+        flight = chunk_cache_flights[key] = {'future': Future(), 'valid': True}
+        flight['future'].set_running_or_notify_cancel()
+
+    def fetch():
+        file_chunk = None
+        try:
+            file_chunk = read(None)
+        except Exception as e:
+            with chunk_cache_lock:
+                chunk_cache_flights.pop(key, None)
+            flight['future'].set_exception(e)
+            return
+
+        with chunk_cache_lock:
+            chunk_cache_flights.pop(key, None)
+            if file_chunk is not None:
+                chunk_cache_totals['bytes_fetched'] += len(file_chunk)
+                if flight['valid']:
+                    admit_cached_chunk(key, file_chunk)
+        flight['future'].set_result(file_chunk)
+
+    fetch_executor.submit(fetch)
+    return piece_of(flight['future'], byte_range)
+
+
+@app.route('/chunk_cache_stats', methods=['GET'])
+def chunk_cache_stats():
+    # Hit ratio, bytes served and evictions of the hot chunk cache, for sizing it
+    with chunk_cache_lock:
+        lookups = chunk_cache_totals['hits'] + chunk_cache_totals['misses']
+        stats = {
+            'budget_bytes': chunk_cache_bytes,
+            'max_item_bytes': chunk_cache_max_item,
+            'admission': chunk_cache_admission,
+            'chunks': len(chunk_cache),
+            'fetches_in_progress': len(chunk_cache_flights),
+            'hit_ratio': round(chunk_cache_totals['hits'] / lookups, 4) if lookups else None,
+        }
+        stats.update((name, value) for name, value in chunk_cache_totals.items()
+                     if name != 'sketch_reads')
+    return jsonify(stats)
+
+
+def fetch_chunks_in_order(data_id, entry, window=None, pieces=None):
+    # arguments data_id(str), entry(dict) - the file's chunk map entry, window(int),
+    # pieces(list of (chunk_info, byte_range or None)) - by default every whole chunk
+    # Generator which keeps up to `window` chunk fetches in flight and yields the
+    # chunks in chunk_id order, buffering the ones that arrive early
+
+    window = max(1, window or fetch_window)
+    pieces = iter(pieces if pieces is not None else [
+                  (chunk_info, None) for chunk_info in entry['chunks']])
+    # Reorder buffer: futures in chunk order, the head is always the next chunk to yield
+    in_flight = deque()
+
+    def submit_next():
+        chunk_info, byte_range = next(pieces, (None, None))
+        if chunk_info is not None:
+            stored_id, stored_info, stored_entry = resolve_chunk(data_id, entry, chunk_info)
+            if stored_info is None:
+                raise IOError(f"Stored copy of chunk {chunk_info['chunk_id']} of {data_id} is missing")
+            if 'ec' in stored_info:
+                def read(chunk_range):
+                    return fetch_ec_chunk(stored_info, chunk_range)
+            else:
+                locations = chunk_locations_of(stored_entry, stored_info)
+
+                def read(chunk_range):
+                    return fetch_chunk_with_fallback(
+                        stored_id, stored_info['chunk_id'], locations, chunk_range,
+                        stored_info.get('checksum'), stored_info.get('codec'))
+            in_flight.append((chunk_info, read_chunk_cached(
+                stored_id, stored_info, byte_range, read)))
+
+    try:
+        for _ in range(window):
+            submit_next()
+
+        while in_flight:
+            chunk_info, future = in_flight.popleft()
+            file_chunk = future.result()
+
+            if file_chunk is None:
+                raise IOError(f"Failed to fetch chunk {
+                              chunk_info['chunk_id']} of {data_id}")
+
+            # Refill the window before handing the chunk out, so the DataNodes keep
+            # working while the client consumes it
+            submit_next()
+            yield file_chunk
+    finally:
+        # Stop queued fetches if the download failed or the client went away
+        for _, future in in_flight:
+            future.cancel()
+
+
+def file_size_of(entry):
+    # Size of a file from its chunk sizes, None for files stored before they were recorded
+    if not all('size' in chunk_info for chunk_info in entry['chunks']):
+        return None
+    return sum(chunk_info['size'] for chunk_info in entry['chunks'])
+
+
+def chunk_pieces(entry, start, stop):
+    # arguments entry(dict) - the file's chunk map entry, start(int), stop(int)
+    # Maps bytes start to stop - 1 of the file onto its chunks. Returns a list of
+    # (chunk_info, (start, stop) within the chunk) covering only the chunks needed
+
+    pieces = []
+    chunk_start = 0
+    for chunk_info in entry['chunks']:
+        chunk_stop = chunk_start + chunk_info['size']
+        if chunk_stop > start and chunk_start < stop:
+            pieces.append((chunk_info, (max(start, chunk_start) - chunk_start,
+                                        min(stop, chunk_stop) - chunk_start)))
+        if chunk_stop >= stop:
+            break
+        chunk_start = chunk_stop
+    return pieces
+
+
+def stream_file(data_id, entry, file_name, byte_range=None, file_size=None):
+    # arguments data_id(str), entry(dict), file_name(str), byte_range((start, stop) or None),
+    # file_size(int or None)
+    # Streams the whole file, or bytes start to stop - 1 of it as a 206 response
+
+    if byte_range:
+        chunk_stream = fetch_chunks_in_order(
+            data_id, entry, pieces=chunk_pieces(entry, *byte_range))
+    else:
+        chunk_stream = fetch_chunks_in_order(data_id, entry)
+
+    # Wait for the first chunk before committing to a 200, so that a file whose
+    # DataNodes are all unreachable still gets a proper error response
+    try:
+        first_chunk = next(chunk_stream, b'')
+    except IOError as e:
+        print(e)
+        chunk_stream.close()
+        # Return an error response if failed to fetch the file data
+        return jsonify({'error': 'Failed to fetch file data'}), 500
+
+    def generate():
+        try:
+            yield first_chunk
+            # A failure from here on aborts the response instead of silently
+            # sending a file with a hole in it
+            yield from chunk_stream
+        finally:
+            chunk_stream.close()
+
+    headers = {'Content-Disposition': f'attachment; filename="{
+        secure_filename(file_name) or data_id}"'}
+    if file_size is not None:
+        headers['Accept-Ranges'] = 'bytes'
+        headers['Content-Length'] = str(
+            byte_range[1] - byte_range[0] if byte_range else file_size)
+    if byte_range:
+        headers['Content-Range'] = f"bytes {byte_range[0]}-{byte_range[1] - 1}/{file_size}"
+
+    # Stream the chunks to the client as they arrive from the DataNodes
+    return Response(
+        stream_with_context(generate()),
+        status=206 if byte_range else 200,
+        mimetype='application/octet-stream',
+        headers=headers
+    )
+
+
 @app.route('/get_file', methods=['POST'])
 def get_file():
+    # Supports a single HTTP Range, e.g. "Range: bytes=0-1023" or "bytes=-4096"
 
     # Retrieve file_name and directory_path from the request
     file_name = request.form.get('file_name')
     directory_path = request.form.get('directory_path', '/')
 
     # Validate and retrieve file_id based on file_name and directory_path
-    file_metadata = files_collection.find_one(
-        {'name': file_name, 'directory_path': directory_path}, {'_id': 0, 'id': 1})
+    data_id = lookup_file_id(file_name, directory_path)
 
-    if not file_metadata:
+    if not data_id:
         return jsonify({'error': 'File not found'}), 404
 
-    data_id = file_metadata['id']
-
-    # Retrieve chunks' metadata from MongoDB
-    chunks_metadata = list(chunks_collection.find(
-        {'file_id': data_id}, {'_id': 0}))
+    # Retrieve chunks' metadata from the chunk map
+    entry = get_chunk_map(data_id)
 
-    if not chunks_metadata:
+    if not entry['chunks']:
         return jsonify({'error': 'Invalid data_id or no chunks found'}), 400
 
-    file_data = b""
+    file_size = file_size_of(entry)
+    byte_range = None
 
-    # Iterate through chunks and fetch their content from DataNodes
-    for chunk_info in sorted(chunks_metadata, key=lambda x: x['chunk_id']):
-        datanode_address = chunk_info['datanode_address']
-        chunk_id = chunk_info['chunk_id']
+    # Several ranges, or files without chunk sizes, get the whole file as allowed by HTTP
+    if request.range and len(request.range.ranges) == 1 and file_size is not None:
+        byte_range = request.range.range_for_length(file_size)
+        if byte_range is None:
+            return Response(status=416, headers={'Content-Range': f"bytes */{file_size}"})
 
-        file_chunk = fetch_chunk_from_datanode(
-            datanode_address, data_id, chunk_id)
+    return stream_file(data_id, entry, file_name, byte_range, file_size)
 
-        if file_chunk is not None:
-            file_data += file_chunk
-        else:
-            # Handle cases where the initial fetch fails
-            replication_entry = replication_collection.find_one(
-                {'data_id': data_id, 'chunk_id': chunk_id})
-            if replication_entry and replication_entry['status'] == 'success':
-                # If replication was successful, attempt to fetch the chunk again'
-                datanode_address = replication_entry['datanode_address']
-                data_id = replication_entry['data_id']
-                chunk_id = replication_entry['chunk_id']
-
-                file_chunk_retry = fetch_chunk_from_datanode(
-                    datanode_address, data_id, chunk_id)
-                if file_chunk_retry is not None:
-                    file_data += file_chunk_retry
-                else:
-                    print(f"Retry failed for chunk {chunk_id}")
-            else:
-                print(f"Replication failed for chunk {chunk_id}")
 
-        # datanode_download_endpoint = f"{datanode_address}/read_file/{data_id}/{chunk_id}"
+@app.route('/read_range', methods=['GET', 'POST'])
+def read_range():
+    # Reads length bytes of a file starting at offset, fetching only the chunks and
+    # the bytes within them that the range covers. length defaults to the rest of the file
 
-    if not file_data:
-        # Return an error response if failed to fetch the file data
-        return jsonify({'error': 'Failed to fetch file data'}), 500
+    file_name = request.values.get('file_name')
+    directory_path = request.values.get('directory_path', '/')
+
+    try:
+        offset = int(request.values.get('offset', 0))
+        length = request.values.get('length')
+        length = int(length) if length is not None else None
+    except ValueError:
+        return jsonify({'error': 'offset and length must be integers'}), 400
+
+    if offset < 0 or (length is not None and length < 1):
+        return jsonify({'error': 'Invalid offset or length'}), 400
 
-    # Save the stitched file temporarily
-    file_path = f"data/{data_id}_stitched.bin"
-    with open(file_path, 'wb') as file:
-        file.write(file_data)
+    data_id = lookup_file_id(file_name, directory_path)
 
-    # Return the file as an attachment for download
-    return send_file(file_path, as_attachment=True)
+    if not data_id:
+        return jsonify({'error': 'File not found'}), 404
 
+    entry = get_chunk_map(data_id)
+    file_size = file_size_of(entry)
 
-# Function to handle replication for a single chunk
-def replicate_chunk(data_id, chunk_id, chunk_data, active_nodes):
-    # arguments data_id(str), chunk_id(str), chunk_data(bytes), active_nodes(list)
+    if file_size is None:
+        return jsonify({'error': 'Chunk sizes of this file are unknown, use get_file'}), 400
 
-    # Find the index of the original node where the chunk resides
-    original_node_index = active_nodes.index(
-        chunks_location[data_id][chunk_id][0])
+    if offset >= file_size:
+        return jsonify({'error': f"offset is past the end of the file ({file_size} bytes)"}), 416
 
-    # Clear existing replication details for this chunk in MongoDB
-    replication_collection.delete_many(
-        {'data_id': data_id, 'chunk_id': chunk_id})
+    stop = file_size if length is None else min(file_size, offset + length)
 
-    # Loop through the replication attempts based on the replication factor
-    for attempt in range(1, replication_factor):
-        # Calculate the index for the next replica
-        node_index = (original_node_index + attempt) % len(active_nodes)
-        datanode_address = active_nodes[node_index]
-        datanode_upload_endpoint = f"{datanode_address}/write_file/"
+    return stream_file(data_id, entry, file_name, (offset, stop), file_size)
 
-        # Prepare the chunk data to be sent to the DataNode
-        chunk_file = {'file': (f'chunk_{chunk_id}.bin', chunk_data)}
 
-        # Send the chunk to the DataNode for replication
-        response = requests.post(datanode_upload_endpoint, files=chunk_file, data={
-                                 'data_id': data_id, 'chunk_id': chunk_id})
+def get_active_nodes():
+    # Get addresses of active DataNodes
+    return [node for node, is_active in list(active_datanodes.items()) if is_active]
 
-        # Prepare replication entry to be stored in the database
-        replication_entry = {
-            'data_id': data_id,
-            'chunk_id': chunk_id,
-            'datanode_address': datanode_address,
-            'status': 'success' if response.status_code == 200 else 'failure'
-        }
 
-        # Store replication details in MongoDB
-        replication_collection.insert_one(replication_entry)
+# Start of the next round-robin placement, so files do not all start on the same node
+placement_cursor = itertools.count()
 
-        # Update chunks location if replication is successful
-        if response.status_code == 200:
-            with chunks_location_lock:
-                chunks_location[data_id][chunk_id].append(datanode_address)
-        else:
-            print(f"Failed to replicate chunk {
-                  chunk_id} to {datanode_address}")
 
+def placement_load(active_nodes):
+    # arguments active_nodes(list)
+    # Snapshot of each active DataNode's stored bytes, free space and in-flight
+    # requests, from the heartbeats. Placement decisions update it as they go
 
-def start_replication(data_id, file_stream, number_of_chunks, chunk_size, extra_bytes, active_nodes):
-    # arguments data_id(str), file_stream(file-like object), number_of_chunks(int), chunk_size(int), extra_bytes(int), active_nodes(list)
+    with datanode_stats_lock:
+        load = {}
+        for address in active_nodes:
+            stats = datanode_stats.get(address, {})
+            load[address] = {
+                'used': (stats.get('stored_bytes') or 0) + placement_pending_bytes.get(address, 0),
+                'free': (stats.get('capacity') or {}).get('free'),
+                'in_flight': stats.get('in_flight') or 0
+            }
+        return load
+
+
+def place_round_robin(load, count, chunk_size):
+    # The primary goes on the next node in turn and the replicas on the nodes after it
+    nodes = sorted(load)
+    start = next(placement_cursor)
+    return [nodes[(start + offset) % len(nodes)] for offset in range(count)]
+
+
+def place_least_used(load, count, chunk_size):
+    # The nodes storing the fewest bytes, ties broken at random
+    return sorted(load, key=lambda address: (load[address]['used'], random.random()))[:count]
+
+
+def place_least_inflight(load, count, chunk_size):
+    # The nodes serving the fewest requests, then the fewest bytes
+    return sorted(load, key=lambda address: (load[address]['in_flight'],
+                                             load[address]['used'], random.random()))[:count]
+
+
+def place_power_of_two(load, count, chunk_size):
+    # Each replica goes on the less used of two nodes picked at random. Almost as
+    # balanced as least_used, without every upload racing for the same node
+    candidates = list(load)
+    pipeline = []
+    while len(pipeline) < count:
+        picks = random.sample(candidates, min(2, len(candidates)))
+        chosen = min(picks, key=lambda address: load[address]['used'])
+        pipeline.append(chosen)
+        candidates.remove(chosen)
+    return pipeline
+
+
+# Placement strategies by name. Each one returns count distinct DataNodes from load
+placement_strategies = {
+    'round_robin': place_round_robin,
+    'least_used': place_least_used,
+    'least_inflight': place_least_inflight,
+    'power_of_two': place_power_of_two,
+}
+
+
+def place_chunk(load, chunk_size, strategy=None, pending=True, count=None):
+    # arguments load(dict from placement_load), chunk_size(int), strategy(str), count(int)
+    # Returns the replica pipeline of a chunk, count (by default replication_factor)
+    # distinct DataNodes with the primary first, and charges the chunk to those nodes
+
+    place = placement_strategies.get(strategy or placement_strategy, place_power_of_two)
+
+    # Leave nodes with a nearly full disk alone, unless all of them are
+    candidates = {address: node_load for address, node_load in load.items()
+                  if node_load['free'] is None or
+                  node_load['free'] - chunk_size >= placement_min_free_bytes}
+    if not candidates:
+        candidates = load
+
+    pipeline = place(candidates, min(count or replication_factor,
+                     len(candidates)), chunk_size)
+
+    for address in pipeline:
+        load[address]['used'] += chunk_size
+        load[address]['in_flight'] += 1
+        if load[address]['free'] is not None:
+            load[address]['free'] -= chunk_size
+
+    if pending:
+        with datanode_stats_lock:
+            for address in pipeline:
+                placement_pending_bytes[address] = placement_pending_bytes.get(
+                    address, 0) + chunk_size
+
+    return pipeline
+
+
+def placement_balance(load):
+    # Spread of the bytes and chunks over the DataNodes of a placement load
+    used = [node_load['used'] for node_load in load.values()]
+    chunks = [node_load['in_flight'] for node_load in load.values()]
+    mean = sum(used) / len(used)
+    deviation = (sum((value - mean) ** 2 for value in used) / len(used)) ** 0.5
+    return {
+        'bytes_per_node': {address: node_load['used'] for address, node_load in load.items()},
+        'chunks_per_node': {address: node_load['in_flight'] for address, node_load in load.items()},
+        'max_bytes': max(used),
+        'min_bytes': min(used),
+        'max_over_mean': round(max(used) / mean, 4) if mean else None,
+        # Coefficient of variation of the bytes per node, 0 is a perfect balance
+        'cv_bytes': round(deviation / mean, 4) if mean else None,
+        'max_chunks': max(chunks),
+        'min_chunks': min(chunks)
+    }
 
-    replication_threads = []
 
-    for i in range(number_of_chunks):
-        chunk_id = i + 1
+@app.route('/placement_simulation', methods=['POST'])
+def placement_simulation():
+    # Places a mix of files with one or every placement strategy without writing
+    # anything, and reports how balanced the DataNodes end up. Expects a JSON body
+    # {'files': [{'size', 'number_of_chunks', 'count'}], 'strategy', 'nodes', 'start'}
+    # nodes is a number of empty simulated DataNodes, by default the active ones
+    # are used, starting from their current load unless start is 'empty'
 
-        # Move the stream pointer to the start of the chunk
-        file_stream.seek(i * chunk_size)
+    body = request.get_json(silent=True) or {}
+    files = body.get('files') or []
+    strategy = body.get('strategy')
 
-        # Read the chunk data from the stream
-        chunk_data = file_stream.read(
-            chunk_size + (1 if i < extra_bytes else 0))
+    if strategy and strategy not in placement_strategies:
+        return jsonify({'error': f"Unknown strategy, use one of {list(placement_strategies)}"}), 400
 
-        # Start a new thread for replication of the current chunk
-        replication_thread = threading.Thread(
-            target=replicate_chunk,
-            args=(data_id, chunk_id, chunk_data, active_nodes)
-        )
-        replication_threads.append(replication_thread)
-        replication_thread.start()
+    try:
+        file_mix = [(int(file_info['size']), max(1, int(file_info.get('number_of_chunks', 1))),
+                     int(file_info.get('count', 1))) for file_info in files]
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'Invalid file mix'}), 400
+
+    if not file_mix:
+        return jsonify({'error': 'No files to place'}), 400
+
+    if body.get('nodes'):
+        initial_load = {f"simulated-datanode{i+1}": {'used': 0, 'free': None, 'in_flight': 0}
+                        for i in range(int(body['nodes']))}
+    else:
+        initial_load = placement_load(get_active_nodes())
+        if body.get('start') == 'empty':
+            for node_load in initial_load.values():
+                node_load['used'] = 0
+        for node_load in initial_load.values():
+            node_load['in_flight'] = 0
+
+    if not initial_load:
+        return jsonify({'error': 'No DataNodes to place chunks on'}), 503
+
+    results = {}
+    for name in ([strategy] if strategy else placement_strategies):
+        load = {address: dict(node_load)
+                for address, node_load in initial_load.items()}
+        distinct = True
+
+        for size, number_of_chunks, count in file_mix:
+            for _ in range(count):
+                for i in range(number_of_chunks):
+                    chunk_size = size // number_of_chunks + \
+                        (1 if i < size % number_of_chunks else 0)
+                    pipeline = place_chunk(
+                        load, chunk_size, strategy=name, pending=False)
+                    distinct = distinct and len(
+                        set(pipeline)) == len(pipeline)
+
+        results[name] = dict(placement_balance(load), distinct_replicas=distinct)
+
+    return jsonify(results)
+
+
+def write_chunk_pipeline(data_id, chunk_id, chunk_data, pipeline, codec=None):
+    # arguments data_id(str), chunk_id(int), chunk_data(bytes), pipeline(list of DataNode addresses),
+    # codec(str or None) - codec chunk_data is compressed with, kept by the DataNodes
+    # Sends the chunk once to the first DataNode of the pipeline, which stores it and
+    # forwards it to the next one while receiving it, and so on down the chain.
+    # Returns a list of {'address', 'status', 'checksum'} covering every node of the pipeline
+
+    results = []
+    pipeline = list(pipeline)
+
+    while pipeline:
+        head, downstream = pipeline[0], pipeline[1:]
+        try:
+            response = datanode_request(
+                'POST', head, '/write_file/',
+                data=chunk_data,
+                params={'data_id': data_id, 'chunk_id': chunk_id,
+                        'downstream': downstream, 'codec': codec},
+                headers={'Content-Type': 'application/octet-stream'})
+
+            if response.status_code == 200:
+                result = response.json()
+                results.append({'address': head, 'status': 'success',
+                                'checksum': result.get('checksum')})
+                results.extend(result.get('pipeline', []))
+                return results
+            print(f"Failed to upload chunk {chunk_id} to {head}")
+        except requests.exceptions.RequestException:
+            print(f"Failed to connect to {head}")
+
+        # The head of the pipeline failed, start the pipeline again from the next node
+        results.append({'address': head, 'status': 'failure'})
+        pipeline = downstream
+
+    return results
+
+
+def unknown_codec(codec):
+    # True for a codec name that is neither 'none' nor a registered codec
+    return codec is not None and codec != 'none' and codec not in compression_codecs
+
+
+def directory_policy(policies, directory_path, requested, default):
+    # arguments policies(dict of path -> setting), directory_path(str), requested(str or None)
+    # The setting a new file gets: the requested one, else the policy of the directory
+    # or of its nearest ancestor with one, else default
+
+    value = requested
+    with metadata_lock:
+        path = directory_path
+        while value is None:
+            value = policies.get(path)
+            if path == root_directory:
+                break
+            path = parent_path_of(path)[0]
+
+    return value or default
+
+
+def compression_policy(directory_path, requested=None):
+    # arguments directory_path(str), requested(str or None) - codec the upload asked for
+    # Codec of a new file, from directory_compression and default_compression. None
+    # means uncompressed
+    codec = directory_policy(directory_compression, directory_path, requested, default_compression)
+    return None if codec == 'none' else codec
+
+
+def ec_scheme(scheme):
+    # (k, m) of a scheme named 'rs-<k>-<m>', None for 'none'. Raises ValueError for
+    # anything else, and for more than 255 shards, the most GF(2^8) can tell apart
+    if scheme is None or scheme == 'none':
+        return None
+    match = re.fullmatch(r'rs-(\d+)-(\d+)', scheme)
+    if not match:
+        raise ValueError(f"Unknown erasure-coding scheme '{scheme}'")
+    k, m = int(match.group(1)), int(match.group(2))
+    if k < 1 or m < 1 or k + m > 255:
+        raise ValueError(f"Unknown erasure-coding scheme '{scheme}'")
+    return k, m
+
+
+def unknown_ec_scheme(scheme):
+    # True for a scheme name ec_scheme does not accept
+    try:
+        ec_scheme(scheme)
+        return False
+    except ValueError:
+        return True
+
+
+def erasure_coding_policy(directory_path, requested=None):
+    # arguments directory_path(str), requested(str or None) - scheme the upload asked for
+    # Erasure-coding scheme of a new file as (k, m), None when it is replicated
+    return ec_scheme(directory_policy(directory_erasure_coding, directory_path, requested,
+                                      default_erasure_coding))
+
+
+def missing_ec_nodes(scheme):
+    # An error message when there are fewer active DataNodes than shards per chunk,
+    # which would put two shards of a chunk on the same DataNode
+    if scheme is not None and len(get_active_nodes()) < sum(scheme):
+        return f"Erasure coding rs-{scheme[0]}-{scheme[1]} needs {sum(scheme)} active DataNodes"
+    return None
+
+
+def compress_chunk(chunk_data, codec):
+    # arguments chunk_data(bytes), codec(str or None)
+    # Returns (stored bytes, codec). A chunk the codec does not shrink, e.g. media that
+    # is already compressed, is stored as it is and read back without decompressing
+    if codec is None:
+        return chunk_data, None
+    compressed = compression_codecs[codec]['compress'](chunk_data)
+    if len(compressed) >= len(chunk_data):
+        return chunk_data, None
+    return compressed, codec
+
+
+def decompress_chunk(stored_data, codec):
+    # arguments stored_data(bytes), codec(str or None)
+    return compression_codecs[codec]['decompress'](stored_data) if codec else stored_data
+
+
+def build_gf_tables():
+    # Antilog and log tables of GF(2^8) with the polynomial x^8 + x^4 + x^3 + x^2 + 1,
+    # and the 256 x 256 multiplication table built from them. The antilog table is
+    # doubled so that the sum of two logs never needs a modulo
+    exp = np.zeros(510, dtype=np.uint8)
+    log = np.zeros(256, dtype=np.int64)
+    value = 1
+    for power in range(255):
+        exp[power] = value
+        log[value] = power
+        value <<= 1
+        if value & 0x100:
+            value ^= 0x11d
+    exp[255:] = exp[:255]
+
+    mul = np.zeros((256, 256), dtype=np.uint8)
+    mul[1:, 1:] = exp[log[1:, None] + log[None, 1:]]
+    return exp, log, mul
+
+
+gf_exp, gf_log, gf_mul = build_gf_tables()
+
+# Low and high byte of every 16-bit value, for gf_pair_table
+gf_pair_low = (np.arange(65536) & 0xff).astype(np.uint8)
+gf_pair_high = (np.arange(65536) >> 8).astype(np.uint8)
+
+
+def gf_pair_table(coefficient):
+    # Multiplication by a coefficient as a table over pairs of bytes, which halves the
+    # lookups of gf_matmul. Each half of a pair is multiplied on its own
+    products = gf_mul[coefficient]
+    return products[gf_pair_low].astype(np.uint16) | (products[gf_pair_high].astype(np.uint16) << 8)
+
+
+def gf_matmul(matrix, rows):
+    # arguments matrix(r x c array of GF(2^8) elements), rows(c x n array of bytes)
+    # Product over GF(2^8), where adding is XOR. Every coefficient is one vectorized
+    # table lookup over a whole row, two bytes at a time
+
+    width = rows.shape[1]
+    if width % 2:
+        rows = np.hstack([rows, np.zeros((len(rows), 1), dtype=np.uint8)])
+    pairs = np.ascontiguousarray(rows).view(np.uint16)
+
+    out = np.zeros((matrix.shape[0], pairs.shape[1]), dtype=np.uint16)
+    for i in range(matrix.shape[0]):
+        for j in range(matrix.shape[1]):
+            if matrix[i, j] == 1:
+                out[i] ^= pairs[j]
+            elif matrix[i, j]:
+                out[i] ^= np.take(gf_pair_table(matrix[i, j]), pairs[j])
+    return out.view(np.uint8)[:, :width]
+
+
+def gf_invert(matrix):
+    # Inverse of a square matrix over GF(2^8), by Gauss-Jordan elimination
+    size = len(matrix)
+    work = np.hstack([matrix, np.eye(size, dtype=np.uint8)])
+    for column in range(size):
+        pivot = next(row for row in range(column, size) if work[row, column])
+        work[[column, pivot]] = work[[pivot, column]]
+        work[column] = gf_mul[gf_exp[255 - gf_log[work[column, column]]]][work[column]]
+        for row in range(size):
+            if row != column and work[row, column]:
+                work[row] ^= gf_mul[work[row, column]][work[column]]
+    return work[:, size:]
+
+
+def rs_generator(k, m):
+    # Generator matrix of systematic Reed-Solomon RS(k, m): the k x k identity, so the
+    # data shards are the chunk's own bytes, over an m x k Cauchy matrix 1 / (x_i + y_j)
+    # with x_i = k + i and y_j = j. Every k rows of it are invertible
+    x = np.arange(k, k + m)[:, None]
+    y = np.arange(k)[None, :]
+    cauchy = gf_exp[255 - gf_log[x ^ y]]
+    return np.vstack([np.eye(k, dtype=np.uint8), cauchy])
+
+
+def rs_encode(stored_data, k, m):
+    # arguments stored_data(bytes), k(int), m(int)
+    # Cuts the bytes into k data shards of equal size, the last one padded with zeros,
+    # and computes m parity shards over them. Returns the k + m shards
+
+    shard_size = max(1, -(-len(stored_data) // k))
+    data = np.zeros((k, shard_size), dtype=np.uint8)
+    data.reshape(-1)[:len(stored_data)] = np.frombuffer(stored_data, dtype=np.uint8)
+    parity = gf_matmul(rs_generator(k, m)[k:], data)
+    return [row.tobytes() for row in data] + [row.tobytes() for row in parity]
+
+
+def rs_reconstruct(shards, k, m, indices):
+    # arguments shards(dict of shard index -> bytes, at least k of them), k(int), m(int),
+    # indices(list of shard indices)
+    # Rebuilds the shards at indices from k of the given ones, data shards preferred.
+    # Returns them as the rows of an array
+
+    available = sorted(shards)[:k]
+    rows = np.vstack([np.frombuffer(shards[index], dtype=np.uint8) for index in available])
+    generator = rs_generator(k, m)
+
+    # With every data shard at hand there is nothing to solve
+    data = rows if available == list(range(k)) else gf_matmul(gf_invert(generator[available]), rows)
+    if all(index < k for index in indices):
+        return data[indices]
+    return gf_matmul(generator[indices], data)
+
+
+def rs_decode(shards, k, m, size):
+    # The first size bytes of the data shards, rebuilt from any k shards
+    return rs_reconstruct(shards, k, m, list(range(k))).tobytes()[:size]
+
+
+def shard_data_id(data_id):
+    # The data_id the shards of a file's erasure-coded chunks are stored under, so
+    # that they never collide with chunk_ids of the file itself
+    return f"{data_id}-ec"
+
+
+def place_for(load, chunk_size, scheme=None):
+    # arguments load(dict from placement_load), chunk_size(int), scheme((k, m) or None)
+    # The DataNodes of a new chunk: its replica pipeline, or one per shard when it is
+    # erasure coded
+    if scheme is None:
+        return place_chunk(load, chunk_size)
+    k, m = scheme
+    return place_chunk(load, -(-chunk_size // k), count=k + m)
+
+
+def write_shards(data_id, chunk_id, stored_data, nodes, scheme):
+    # arguments data_id(str), chunk_id(int), stored_data(bytes), nodes(list of DataNode
+    # addresses, one per shard), scheme((k, m))
+    # Erasure codes a chunk and writes every shard to its own DataNode, all at once.
+    # Shard i of chunk c is chunk (c - 1) * (k + m) + i + 1 of shard_data_id(data_id).
+    # Returns the chunk's 'ec' layout with a {'address', 'status', 'checksum'} per shard
+
+    k, m = scheme
+    shards = rs_encode(stored_data, k, m)
+    layout = {'k': k, 'm': m, 'data_id': shard_data_id(data_id),
+              'first': (chunk_id - 1) * (k + m) + 1, 'shard_size': len(shards[0])}
+
+    def write_shard(index):
+        if index >= len(nodes):
+            return {'address': None, 'status': 'failure'}
+        return write_chunk_pipeline(layout['data_id'], layout['first'] + index,
+                                    shards[index], [nodes[index]])[0]
+
+    layout['shards'] = list(ec_executor.map(write_shard, range(k + m)))
+    with ec_totals_lock:
+        ec_totals['chunks_encoded'] += 1
+    return layout
+
+
+def store_chunk(data_id, chunk_id, chunk_data, pipeline, codec=None, digest=None, scheme=None):
+    # arguments data_id(str), chunk_id(int), chunk_data(bytes), pipeline(list of DataNode addresses),
+    # codec(str or None) - compression codec of the file, digest(str or None) - SHA-256 of chunk_data,
+    # scheme((k, m) or None) - erasure-coding scheme of the file
+    # Compresses a chunk and writes it down its pipeline. Returns its {'chunk_id', 'size',
+    # 'replicas'} record, plus 'codec' and 'stored_size' when it is stored compressed.
+    # An erasure-coded chunk has no replicas but an 'ec' layout from write_shards, the
+    # compressed bytes are what gets erasure coded
+
+    stored_data, codec = compress_chunk(chunk_data, codec)
+    record = {'chunk_id': chunk_id, 'size': len(chunk_data)}
+    if scheme is None:
+        record['replicas'] = write_chunk_pipeline(data_id, chunk_id, stored_data, pipeline, codec)
+    else:
+        record['replicas'] = []
+        record['ec'] = write_shards(data_id, chunk_id, stored_data, pipeline, scheme)
+    if codec:
+        record['codec'] = codec
+        record['stored_size'] = len(stored_data)
+    if digest:
+        record['digest'] = digest
+    return record
+
+
+def find_duplicate(digest, seen, size):
+    # arguments digest(str), seen(dict) - digest -> {'data_id', 'chunk_id'} of the chunks
+    # the upload itself stores, size(int) - size of the chunk
+    # Returns a ref {'data_id', 'chunk_id'} to a stored chunk with this content, or None.
+    # A reference to another file's chunk is counted right away, so that chunk cannot
+    # be freed before the upload commits; abandon_upload gives it back otherwise
+
+    if not dedup_enabled:
+        return None
+
+    ref = seen.get(digest)
+    if ref is None:
+        # Chunks down to 0 references are about to be freed and are never picked up again
+        ref = chunk_refs_collection.find_one_and_update(
+            {'digest': digest, 'refs': {'$gt': 0}}, {'$inc': {'refs': 1}},
+            projection={'_id': 0, 'data_id': 1, 'chunk_id': 1})
+        if ref is None:
+            return None
+
+    with dedup_totals_lock:
+        dedup_totals['chunks_deduplicated'] += 1
+        dedup_totals['bytes_deduplicated'] += size
+    return {'data_id': ref['data_id'], 'chunk_id': ref['chunk_id']}
 
-    # Wait for all replication threads to finish, else writes to metaData DB will be wrong
-    for thread in replication_threads:
-        thread.join()
+
+def dedup_chunk(chunk_id, chunk_data, seen):
+    # arguments chunk_id(int), chunk_data(bytes), seen(dict) - as for find_duplicate
+    # Returns (digest, record), where record is the chunk record of a duplicate, or None
+    # if the chunk has to be stored
+
+    digest = hashlib.sha256(chunk_data).hexdigest()
+    ref = find_duplicate(digest, seen, len(chunk_data))
+    if ref is None:
+        return digest, None
+    return digest, {'chunk_id': chunk_id, 'size': len(chunk_data), 'digest': digest,
+                    'ref': ref, 'replicas': []}
+
+
+def chunk_stored(record):
+    # True when a DataNode stored the chunk, every shard of it when it is erasure
+    # coded, or it points at a stored copy
+    if 'ec' in record:
+        return all(shard.get('status') == 'success' for shard in record['ec']['shards'])
+    return 'ref' in record or any(
+        replica.get('status') == 'success' for replica in record.get('replicas', []))
+
+
+def abandon_upload(data_id, chunk_records):
+    # Gives back the references a failed upload took on other files' chunks
+    release_chunk_refs([record['ref'] for record in chunk_records
+                        if 'ref' in record and record['ref']['data_id'] != data_id])
 
 
 # Function to split the file and distribute chunks
-def split_file(file_stream, number_of_chunks, data_id):
-    # arguments file_stream(file like object), number_of_chunks(int), data_id(str)
+def split_file(file_stream, number_of_chunks, data_id, codec=None, scheme=None):
+    # arguments file_stream(file like object), number_of_chunks(int), data_id(str),
+    # codec(str or None) - compression codec of the file, scheme((k, m) or None) -
+    # erasure-coding scheme of the file
+    # Returns one {'chunk_id', 'size', 'replicas'} record per chunk
 
     # Calculate file size and determine chunk size
     file_stream.seek(0, os.SEEK_END)
@@ -374,75 +2654,316 @@ def split_file(file_stream, number_of_chunks, data_id):
     chunk_size = file_size // number_of_chunks
     extra_bytes = file_size % number_of_chunks
 
-    # Get addresses of active DataNodes
-    active_nodes = list(
-        filter(lambda node: active_datanodes[node], active_datanodes.keys()))
+    load = placement_load(get_active_nodes())
 
-    # Split the file into chunks and distribute them among DataNodes using Round-Robin
-    for i in range(number_of_chunks):
-        chunk_data = file_stream.read(
-            chunk_size + (1 if i < extra_bytes else 0))
-        node_index = i % len(active_nodes)
-        datanode_address = active_nodes[node_index]
-        datanode_upload_endpoint = f"{datanode_address}/write_file/"
+    chunk_records = []
+    seen = {}
 
-        files = {'file': (f'chunk_{i+1}.bin', io.BytesIO(chunk_data))}
-        response = requests.post(datanode_upload_endpoint, files=files, data={
-                                 'data_id': data_id, 'chunk_id': i+1})
+    # Split the file into chunks and distribute them among DataNodes with the placement
+    # strategy, each chunk is sent once and replicated along its pipeline by the DataNodes.
+    # Chunks that are already stored are not sent at all
+    try:
+        for i in range(number_of_chunks):
+            chunk_data = file_stream.read(
+                chunk_size + (1 if i < extra_bytes else 0))
 
-        if response.status_code == 200:
-            # Update chunks_location with DataNode information
-            with chunks_location_lock:
-                chunks_location.setdefault(data_id, {}).setdefault(
-                    i+1, []).append(datanode_address)
-        else:
-            print(f"Failed to upload chunk {i+1} to {datanode_address}")
+            digest, record = dedup_chunk(i+1, chunk_data, seen)
+            if record is None:
+                record = store_chunk(data_id, i+1, chunk_data,
+                                     place_for(load, len(chunk_data), scheme), codec, digest, scheme)
+                seen[digest] = {'data_id': data_id, 'chunk_id': i+1}
+            chunk_records.append(record)
+    except Exception:
+        # Gives back the references taken so far before the upload fails
+        abandon_upload(data_id, chunk_records)
+        raise
 
-    # Once all chunks have been sent, start the replication process
-    file_stream.seek(0)
-    start_replication(data_id, file_stream, number_of_chunks,
-                      chunk_size, extra_bytes, active_nodes)
+    return chunk_records
 
 
-def check_datanodes_health():
-    while True:
-        # Iterate through each DataNode address
-        for address in datanode_addresses:
-            # print("Checking DataNodes health...", flush=True)
-            try:
-                # Attempt to fetch the DataNode's health status
-                response = requests.get(f"{address}/is_active")
+def probe_datanode(address):
+    # arguments address(str)
+    # Returns (is_up, latency in ms) for a single /is_active probe
+
+    started = time.monotonic()
+    try:
+        # Attempt to fetch the DataNode's health status
+        response = datanode_request(
+            'GET', address, '/is_active', purpose='probe')
+
+        # Check if the DataNode is active based on the response
+        is_up = response.status_code == 200 and response.json().get(
+            'status') != "DataNode is not active"
+    except (requests.exceptions.RequestException, ValueError):
+        is_up = False
+
+    return is_up, (time.monotonic() - started) * 1000
+
 
-                # Check if the DataNode is active based on the response
-                is_active = response.status_code == 200 and response.json().get(
-                    'status') != "DataNode is not active"
+def set_datanode_status(address, is_active):
+    # arguments address(str), is_active(bool)
+    # Records a change of a DataNode's status, in memory and in MongoDB
 
-                print(f"DataNode {address} is {
-                      "active" if is_active else "inactive"}", flush=True)
+    print(f"DataNode {address} is now {
+          "active" if is_active else "inactive"}", flush=True)
 
-                # Update the status of the DataNode in the active_datanodes dictionary
-                active_datanodes[address] = is_active
+    # Update the status of the DataNode in the active_datanodes dictionary
+    active_datanodes[address] = is_active
 
-                # Update the status of the DataNode in the database collection
-                active_datanodes_collection.update_one(
-                    {'address': address},
-                    {'$set': {'status': 'Active' if is_active else 'Inactive'}},
-                    upsert=True
-                )
+    # Update the status of the DataNode in the database collection
+    active_datanodes_collection.update_one(
+        {'address': address},
+        {'$set': {'status': 'Active' if is_active else 'Inactive'}},
+        upsert=True
+    )
+
+    # Every chunk that had a copy on a dead DataNode is one failure closer to being lost
+    if not is_active:
+        threading.Thread(target=enqueue_under_replicated,
+                         args=(address,), daemon=True).start()
+
+
+def record_probe(address, is_up, latency_ms):
+    # arguments address(str), is_up(bool), latency_ms(float)
+    # Updates the probe statistics of a DataNode and its status. A DataNode is only
+    # declared dead after health_failure_threshold probes in a row have failed
+
+    with datanode_health_lock:
+        health = datanode_health.setdefault(address, {
+            'probes': 0, 'failures': 0, 'consecutive_failures': 0,
+            'last_latency_ms': None, 'avg_latency_ms': None, 'last_probe': None})
+        health['probes'] += 1
+        health['last_probe'] = time.time()
+        health['last_latency_ms'] = round(latency_ms, 2)
+
+        if is_up:
+            health['consecutive_failures'] = 0
+            # Exponentially weighted moving average of the probe latency
+            health['avg_latency_ms'] = round(latency_ms if health['avg_latency_ms'] is None else
+                                             0.8 * health['avg_latency_ms'] + 0.2 * latency_ms, 2)
+        else:
+            health['failures'] += 1
+            health['consecutive_failures'] += 1
+
+        consecutive_failures = health['consecutive_failures']
+
+    was_active = active_datanodes.get(address)
+    if is_up:
+        is_active = True
+    elif was_active is None or consecutive_failures >= health_failure_threshold:
+        is_active = False
+    else:
+        # Not dead yet, a single missed probe is often just a slow answer
+        is_active = was_active
 
-            except requests.exceptions.RequestException:
+    # Only touch MongoDB when the status actually changes
+    if is_active != was_active:
+        set_datanode_status(address, is_active)
 
-                # If there's an exception, mark the DataNode as inactive
-                active_datanodes[address] = False
 
-                # Update the status of the DataNode in the database as 'Inactive'
-                active_datanodes_collection.update_one(
-                    {'address': address},
-                    {'$set': {'status': 'Inactive'}},
-                    upsert=True
-                )
-        # Wait for 1 second before checking the health of DataNodes again
-        time.sleep(5)
+def check_datanodes_health():
+    # Probes every DataNode concurrently, once every health_check_interval seconds.
+    # Each probe has its own timeout, so a hung DataNode cannot delay the others
+
+    with ThreadPoolExecutor(max_workers=max(1, len(datanode_addresses))) as probe_executor:
+        while True:
+            cycle_started = time.monotonic()
+
+            # DataNodes sending heartbeats already told us they are alive
+            probes = {address: probe_executor.submit(probe_datanode, address)
+                      for address in list(datanode_addresses) if not heartbeat_is_fresh(address)}
+            for address, probe in probes.items():
+                is_up, latency_ms = probe.result()
+                record_probe(address, is_up, latency_ms)
+
+            time.sleep(max(0, health_check_interval -
+                       (time.monotonic() - cycle_started)))
+
+
+@app.route('/datanode_probe_stats', methods=['GET'])
+def datanode_probe_stats():
+    # Per DataNode probe latency and failure counts
+    with datanode_health_lock:
+        return jsonify({address: dict(health, status='Active' if active_datanodes.get(address) else 'Inactive')
+                        for address, health in datanode_health.items()})
+
+
+def heartbeat_is_fresh(address):
+    with datanode_stats_lock:
+        stats = datanode_stats.get(address)
+        return stats is not None and time.time() - stats['last_heartbeat'] < heartbeat_timeout
+
+
+def cache_set_replica_status(data_id, chunk_id, datanode_address, status):
+    # Changes the status of a replica, if the file's chunk map is in memory
+    with metadata_lock:
+        entry = chunk_map.get(data_id)
+        if entry is not None:
+            for replica in entry['replicas'].get(chunk_id, []):
+                if replica['datanode_address'] == datanode_address:
+                    replica['status'] = status
+
+
+def reconcile_block_report(address, blocks):
+    # arguments address(str), blocks(dict of (data_id, chunk_id) -> size)
+    # Compares a full block report with the chunk placements stored in MongoDB.
+    # Replicas the DataNode no longer has become 'missing', replicas that came back
+    # become 'success' again. A missing primary swaps places with a healthy replica or
+    # is marked 'missing' itself. Files with changes are checked for re-replication.
+    # Returns counts of what did not match
+
+    status_changes = 0
+    known = set()
+    changed = set()
+
+    for replica in replication_collection.find(
+            {'datanode_address': address}, {'_id': 0, 'data_id': 1, 'chunk_id': 1, 'status': 1}):
+        key = (replica['data_id'], str(replica['chunk_id']))
+        known.add(key)
+
+        if key in blocks and replica['status'] == 'missing':
+            status = 'success'
+        elif key not in blocks and replica['status'] == 'success':
+            status = 'missing'
+        else:
+            continue
+
+        # Status changes are rare, a report normally matches the metadata
+        replication_collection.update_one(
+            {'data_id': replica['data_id'], 'chunk_id': replica['chunk_id'],
+             'datanode_address': address},
+            {'$set': {'status': status}})
+        cache_set_replica_status(
+            replica['data_id'], replica['chunk_id'], address, status)
+        status_changes += 1
+        changed.add(replica['data_id'])
+
+    missing = []
+    returned = []
+    for chunk_info in chunks_collection.find(
+            {'datanode_address': address},
+            {'_id': 0, 'file_id': 1, 'chunk_id': 1, 'shard': 1, 'status': 1}):
+        key = (chunk_info['file_id'], str(chunk_info['chunk_id']))
+        known.add(key)
+        if key not in blocks:
+            missing.append(chunk_info)
+        elif chunk_info.get('status') == 'missing' and 'shard' not in chunk_info:
+            returned.append(chunk_info)
+
+    # Primaries are moved once the cursor is done with them
+    missing_primaries = len(missing)
+    for chunk_info in missing:
+        data_id = chunk_info['file_id']
+        entry = get_chunk_map(data_id)
+        primary_info = find_chunk_info(data_id, chunk_info['chunk_id'])
+        if not primary_info or primary_info['datanode_address'] != address:
+            continue
+        # A shard is the only copy of its bytes, it is rebuilt right away
+        if 'shard' in primary_info:
+            lose_shard(data_id, primary_info, address, 'missing')
+            continue
+        if not promote_replica(data_id, entry, primary_info, address, 'missing'):
+            set_primary_status(data_id, primary_info, 'missing')
+        changed.add(data_id)
+
+    for chunk_info in returned:
+        primary_info = find_chunk_info(chunk_info['file_id'], chunk_info['chunk_id'])
+        if primary_info and primary_info['datanode_address'] == address:
+            set_primary_status(chunk_info['file_id'], primary_info, None)
+            status_changes += 1
+            changed.add(chunk_info['file_id'])
+
+    if changed:
+        enqueue_under_replicated(data_ids=changed)
+
+    # Chunks of uploads that are still being written are not orphans yet
+    with pending_uploads_lock:
+        pending = set(pending_uploads)
+    orphans = [key for key in blocks if key not in known and key[0] not in pending]
+
+    if status_changes or missing_primaries or orphans:
+        print(f"Block report of {address}: {status_changes} replica status changes, "
+              f"{missing_primaries} missing primaries, {len(orphans)} orphan chunks", flush=True)
+
+    return {'replica_status_changes': status_changes, 'missing_primaries': missing_primaries,
+            'orphan_chunks': len(orphans)}
+
+
+@app.route('/heartbeat', methods=['POST'])
+def heartbeat():
+    # Receives the periodic heartbeat of a DataNode: its disk capacity and load, the
+    # chunks it stored or removed since the previous heartbeat and, now and then,
+    # the full list of its chunks
+
+    report = request.get_json(silent=True) or {}
+    address = report.get('address')
+    if not address:
+        return jsonify({"error": "DataNode address is required"}), 400
+
+    # Only configured DataNodes are placement and probe targets, a stray sender or a
+    # mistyped DATANODE_ADDRESS must not become one
+    if address not in datanode_addresses:
+        return jsonify({"error": f"Unknown DataNode '{address}'"}), 403
+
+    full_report = report.get('full_report')
+    reconciliation = None
+
+    with datanode_stats_lock:
+        if full_report is not None:
+            datanode_blocks[address] = {
+                (data_id, chunk_id): size for data_id, chunk_id, size in full_report}
+        elif address in datanode_blocks:
+            blocks = datanode_blocks[address]
+            for data_id, chunk_id, size in report.get('added', []):
+                blocks[(data_id, chunk_id)] = size
+            for data_id, chunk_id in report.get('removed', []):
+                blocks.pop((data_id, chunk_id), None)
+
+        # Without a full report since the NameNode started, deltas mean nothing
+        full_report_requested = address not in datanode_blocks
+
+        stats = datanode_stats.setdefault(address, {'heartbeats': 0, 'last_full_report': None,
+                                                    'last_reconciliation': None})
+        stats.update({
+            'uuid': report.get('uuid'),
+            'capacity': report.get('capacity'),
+            'stored_bytes': report.get('stored_bytes'),
+            'in_flight': report.get('in_flight'),
+            'chunks': len(datanode_blocks.get(address, {})),
+            'last_heartbeat': time.time()
+        })
+        stats['heartbeats'] += 1
+        placement_pending_bytes.pop(address, None)
+        blocks = dict(datanode_blocks[address]) if full_report is not None else None
+
+    if blocks is not None:
+        reconciliation = reconcile_block_report(address, blocks)
+        with datanode_stats_lock:
+            datanode_stats[address]['last_full_report'] = time.time()
+            datanode_stats[address]['last_reconciliation'] = reconciliation
+
+    # Chunks the DataNode found corrupt, on a read or while scrubbing
+    for data_id, chunk_id in report.get('corrupt', []):
+        if str(chunk_id).isdigit():
+            report_corrupt_replica(data_id, int(chunk_id), address)
+
+    # A heartbeat is proof of life, just like a successful probe
+    with datanode_health_lock:
+        if address in datanode_health:
+            datanode_health[address]['consecutive_failures'] = 0
+    if not active_datanodes.get(address):
+        set_datanode_status(address, True)
+
+    return jsonify({'full_report_requested': full_report_requested, 'reconciliation': reconciliation})
+
+
+@app.route('/datanode_stats', methods=['GET'])
+def get_datanode_stats():
+    # Capacity, load and chunk count of every DataNode, from their heartbeats
+    with datanode_stats_lock:
+        return jsonify({address: dict(stats, heartbeat_age_s=round(time.time() - stats['last_heartbeat'], 2),
+                                      status='Active' if active_datanodes.get(address) else 'Inactive')
+                        for address, stats in datanode_stats.items()})
 
 
 @app.route('/create_directory', methods=['POST'])
@@ -456,10 +2977,7 @@ def create_directory():
         return jsonify({'error': 'Invalid directory path'}), 400
 
     # Check if the directory already exists
-    existing_directory = directories_collection.find_one(
-        {'path': directory_path})
-
-    if existing_directory:
+    if directory_exists(directory_path):
         # If the directory already exists, return an error response
         return jsonify({'error': f"Directory '{directory_path}' already exists"}), 400
 
@@ -469,7 +2987,11 @@ def create_directory():
             'path': directory_path,
             'content': []  # Initialize an empty list for storing folder content
         }
-        directories_collection.insert_one(directory_data)
+        try:
+            directories_collection.insert_one(directory_data)
+        except pymongo.errors.DuplicateKeyError:
+            # Created by a concurrent request since the check above
+            return jsonify({'error': f"Directory '{directory_path}' already exists"}), 400
 
         # Extract the folder name from the directory_path
         folder_name = directory_path.rsplit('/', 1)[-1]
@@ -483,14 +3005,95 @@ def create_directory():
                 {'path': parent_path},
                 {'$addToSet': {'content': {'folder_name': folder_name}}}
             )
+
+        cache_add_directory(directory_path)
         # Return a success message upon successful directory creation
         return jsonify({"message": f"Directory '{directory_path}' created successfully"}), 200
 
 
+@app.route('/set_compression', methods=['POST'])
+def set_compression():
+    # Sets the compression policy of a directory for the files uploaded into it or its
+    # subdirectories from now on. codec 'none' stores them uncompressed, 'inherit'
+    # drops the directory's own policy so it follows its parent again
+
+    directory_path = request.form.get('directory_path', '/')
+    codec = request.form.get('codec')
+
+    if not directory_path.startswith('/'):
+        directory_path = '/' + directory_path
+
+    if not codec or (codec != 'inherit' and unknown_codec(codec)):
+        return jsonify({'error': f"Unknown compression codec '{codec}'",
+                        'codecs': ['none', 'inherit'] + list(compression_codecs)}), 400
+
+    if not directory_exists(directory_path):
+        return jsonify({'error': 'Invalid directory path'}), 400
+
+    if codec == 'inherit':
+        directories_collection.update_one(
+            {'path': directory_path}, {'$unset': {'compression': ''}})
+        with metadata_lock:
+            directory_compression.pop(directory_path, None)
+    else:
+        # The root directory has no document until it gets a policy
+        directories_collection.update_one(
+            {'path': directory_path}, {'$set': {'compression': codec}},
+            upsert=directory_path == root_directory)
+        with metadata_lock:
+            directory_compression[directory_path] = codec
+
+    return jsonify({'directory_path': directory_path, 'codec': codec,
+                    'effective_codec': compression_policy(directory_path) or 'none'}), 200
+
+
+@app.route('/set_erasure_coding', methods=['POST'])
+def set_erasure_coding():
+    # Sets the erasure-coding policy of a directory for the files uploaded into it or
+    # its subdirectories from now on, e.g. scheme rs-6-3. 'none' replicates them,
+    # 'inherit' drops the directory's own policy so it follows its parent again.
+    # Files already stored keep the layout they were written with
+
+    directory_path = request.form.get('directory_path', '/')
+    scheme = request.form.get('scheme')
+
+    if not directory_path.startswith('/'):
+        directory_path = '/' + directory_path
+
+    if not scheme or (scheme != 'inherit' and unknown_ec_scheme(scheme)):
+        return jsonify({'error': f"Unknown erasure-coding scheme '{scheme}'",
+                        'schemes': ['none', 'inherit', 'rs-<k>-<m>']}), 400
+
+    if not directory_exists(directory_path):
+        return jsonify({'error': 'Invalid directory path'}), 400
+
+    if scheme == 'inherit':
+        directories_collection.update_one(
+            {'path': directory_path}, {'$unset': {'erasure_coding': ''}})
+        with metadata_lock:
+            directory_erasure_coding.pop(directory_path, None)
+    else:
+        # The root directory has no document until it gets a policy
+        directories_collection.update_one(
+            {'path': directory_path}, {'$set': {'erasure_coding': scheme}},
+            upsert=directory_path == root_directory)
+        with metadata_lock:
+            directory_erasure_coding[directory_path] = scheme
+
+    effective = erasure_coding_policy(directory_path)
+    return jsonify({'directory_path': directory_path, 'scheme': scheme,
+                    'effective_scheme': f"rs-{effective[0]}-{effective[1]}" if effective else 'none'}), 200
+
+
 @app.route('/get_directory', methods=['GET'])
 def get_directory():
-    # Retrieve directory information from MongoDB
-    directories_metadata = list(directories_collection.find({}, {'_id': 0}))
+    # Retrieve directory information from the in-memory namespace
+    with metadata_lock:
+        directories_metadata = [{
+            'path': path,
+            'content': [{'folder_name': folder_name} for folder_name in directory['folders']] +
+            [{'file_name': file_name} for file_name in directory['files']]
+        } for path, directory in namespace.items()]
     return jsonify({'directories': directories_metadata})
 
 
@@ -504,19 +3107,15 @@ def list_directory():
     if not directory_path.startswith('/'):
         directory_path = '/' + directory_path
 
-    # Check if the provided directory path exists
-    directory = directories_collection.find_one({'path': directory_path})
-
-    if not directory:
-        return jsonify({'error': 'Invalid directory path'}), 400
+    # Check if the provided directory path exists and fetch its content
+    with metadata_lock:
+        directory = namespace.get(directory_path)
 
-    # Fetch the content of the directory
-    content = directory.get('content')
+        if not directory:
+            return jsonify({'error': 'Invalid directory path'}), 400
 
-    # Extract file names and folder names from the content
-    files = [item['file_name'] for item in content if 'file_name' in item]
-    folders = [item['folder_name']
-               for item in content if 'folder_name' in item]
+        files = list(directory['files'])
+        folders = list(directory['folders'])
 
     return jsonify({'files': files, 'folders': folders})
 
@@ -543,157 +3142,559 @@ def datanode_status():
     return jsonify(status_data)
 
 
-@app.route('/re_replicate', methods=['POST'])
-def re_replicate():
+def find_chunk_info(data_id, chunk_id):
+    # The chunk document of a chunk from the chunk map, {} if the file has no such chunk
+    return next((chunk_info for chunk_info in get_chunk_map(data_id)['chunks']
+                 if chunk_info['chunk_id'] == chunk_id), {})
 
-    file_name = request.form.get('file_name')
-    directory_path = request.form.get('directory_path', '/')
 
-    # Validate and retrieve file_id based on file_name and directory_path
-    file_metadata = files_collection.find_one(
-        {'name': file_name, 'directory_path': directory_path}, {'_id': 0, 'id': 1})
+def report_corrupt_replica(data_id, chunk_id, datanode_address):
+    # arguments data_id(str), chunk_id(int), datanode_address(str)
+    # Takes a corrupt copy of a chunk out of service and queues the chunk for
+    # re-replication. A corrupt primary swaps places with a healthy replica
 
-    if not file_metadata:
-        return jsonify({'error': 'File not found'}), 404
+    print(f"Copy of chunk {chunk_id} of {data_id} on {datanode_address} is corrupt", flush=True)
 
-    data_id = file_metadata['id']
-    failed_nodes = active_datanodes_collection.find({'status': 'Inactive'})
-    failed_nodes = [doc['address'] for doc in failed_nodes]
-
-    if len(failed_nodes) != 0:
-        for address in failed_nodes:
-            failedNode_handled = failedNode_handled_collection.find(
-                {'address': address}, {'_id': 0, 'address': 1})
-            failedNode_handled = [doc['address'] for doc in failedNode_handled]
-
-            if len(failedNode_handled) == 0 or address not in failedNode_handled:
-                failedNode_handled_collection.insert_one({'address': address})
-
-                # DataNode is not active, initiate re-replication for chunks stored on the failed DataNode
-                failed_datanode_chunks_org = list(chunks_collection.find(
-                    {'datanode_address': address, 'file_id': data_id}, {'_id': 0, 'chunk_id': 1}))
-                failed_datanode_chunks_rep = list(replication_collection.find(
-                    {'datanode_address': address, 'data_id': data_id, 'status': 'success'}, {'_id': 0, 'chunk_id': 1}))
-                failed_datanode_chunks = failed_datanode_chunks_org + failed_datanode_chunks_rep
-                active_dn = active_datanodes_collection.find(
-                    {'status': 'Active'})
-                active_dn = [doc['address'] for doc in active_dn]
-
-                for chunk_info in failed_datanode_chunks:
-                    chunk_id = chunk_info['chunk_id']
-
-                    # Trigger re-replication for the chunk
-                    for index in range(len(active_dn)):
-                        chunk_present = chunks_collection.find_one(
-                            {'file_id': data_id, 'chunk_id': chunk_id, 'datanode_address': active_dn[index]})
-                        if chunk_present is None:
-
-                            # Select the next available active DataNode
-                            node_index = (index+1) % len(active_dn)
-                            datanode_address_fetch = active_dn[node_index]
-                            datanode_upload_endpoint = f"{
-                                active_dn[index]}/write_file/"
-
-                            # Fetch the chunk data from another DataNode
-                            chunk_data = fetch_chunk_from_datanode(
-                                datanode_address_fetch, data_id, chunk_id)
-
-                            # If the chunk data is successfully fetched, replicate it to the selected DataNode
-                            if chunk_data is not None:
-
-                                chunk_file = {
-                                    'file': (f'chunk_{chunk_id}.bin', chunk_data)}
-                                response = requests.post(datanode_upload_endpoint, files=chunk_file, data={
-                                    'data_id': data_id, 'chunk_id': chunk_id})
-
-                                replication_entry = {
-                                    'data_id': data_id,
-                                    'chunk_id': chunk_id,
-                                    'datanode_address': active_dn[index],
-                                    'status': 'success' if response.status_code == 200 else 'failure'
-                                }
-
-                                # Store replication details in MongoDB
-                                replication_collection.insert_one(
-                                    replication_entry)
-
-                                if response.status_code == 200:
-                                    print(f"Successful in replicating chunk {chunk_id} to {
-                                          active_dn[index]} from {datanode_address_fetch}")
-                                    break
-                                else:
-                                    print(f"Failed to fetch chunk {
-                                          chunk_id} from {datanode_address_fetch}")
+    entry = get_chunk_map(data_id)
+    chunk_info = next((chunk_info for chunk_info in entry['chunks']
+                       if chunk_info['chunk_id'] == chunk_id), None)
+    if chunk_info is None:
+        return
 
-            else:
-                print(f"Failure Handling done for DataNode {address}")
-                break
+    if 'shard' in chunk_info:
+        lose_shard(data_id, chunk_info, datanode_address, 'corrupt')
+        return
 
+    if chunk_info['datanode_address'] == datanode_address:
+        if not promote_replica(data_id, entry, chunk_info, datanode_address, 'corrupt'):
+            print(f"No healthy copy left of chunk {chunk_id} of {data_id}", flush=True)
+            return
     else:
-        return jsonify({"message": "All DataNodes Active, No Re-Replication Required"}), 200
+        replication_collection.update_many(
+            {'data_id': data_id, 'chunk_id': chunk_id,
+                'datanode_address': datanode_address},
+            {'$set': {'status': 'corrupt'}})
+        cache_set_replica_status(data_id, chunk_id, datanode_address, 'corrupt')
+
+    enqueue_chunk(data_id, chunk_id, len(live_locations(entry, chunk_info)))
+
+
+def promote_replica(data_id, entry, chunk_info, datanode_address, status):
+    # arguments data_id(str), entry(dict) - the file's chunk map entry, chunk_info(dict),
+    # datanode_address(str) - the primary, status('corrupt' or 'missing')
+    # Swaps a primary that lost its copy with a healthy replica. The old primary stays
+    # on record as a replica with the given status. Returns False if the chunk has no
+    # healthy replica
+
+    chunk_id = chunk_info['chunk_id']
+    with metadata_lock:
+        healthy = next((replica for replica in entry['replicas'].get(chunk_id, [])
+                        if replica['status'] == 'success' and
+                        replica['datanode_address'] != datanode_address), None)
+    if healthy is None:
+        return False
+
+    promoted = healthy['datanode_address']
+    chunks_collection.update_one({'file_id': data_id, 'chunk_id': chunk_id},
+                                 {'$set': {'datanode_address': promoted}, '$unset': {'status': ''}})
+    replication_collection.update_one(
+        {'data_id': data_id, 'chunk_id': chunk_id, 'datanode_address': promoted},
+        {'$set': {'datanode_address': datanode_address, 'status': status}})
+    with metadata_lock:
+        chunk_info['datanode_address'] = promoted
+        chunk_info.pop('status', None)
+        healthy['datanode_address'] = datanode_address
+        healthy['status'] = status
+    return True
+
+
+def set_primary_status(data_id, chunk_info, status):
+    # Marks the primary copy of a chunk 'corrupt' or 'missing', or healthy again with
+    # status None
+    if chunk_info.get('status') == status:
+        return
+    update = {'$set': {'status': status}} if status else {'$unset': {'status': ''}}
+    chunks_collection.update_one({'file_id': data_id, 'chunk_id': chunk_info['chunk_id']}, update)
+    with metadata_lock:
+        if status:
+            chunk_info['status'] = status
+        else:
+            chunk_info.pop('status', None)
+
+
+def lose_shard(data_id, chunk_info, datanode_address, status):
+    # arguments data_id(str), chunk_info(dict) - a shard's chunk document,
+    # datanode_address(str), status('corrupt' or 'missing')
+    # A shard has no other copy: once its DataNode no longer has it intact, it is
+    # taken out of service and queued to be rebuilt from the rest of its chunk
+
+    if chunk_info['datanode_address'] == datanode_address:
+        set_primary_status(data_id, chunk_info, status)
+    enqueue_chunk(data_id, chunk_info['chunk_id'], 0)
+
+
+def is_datanode_live(address):
+    # DataNodes that have not been checked yet count as live, so a NameNode that has
+    # just started does not copy every chunk it knows about
+    return active_datanodes.get(address, True)
+
+
+def live_locations(entry, chunk_info):
+    # Distinct live DataNodes holding a copy of the chunk
+    return [address for address in dict.fromkeys(chunk_locations_of(entry, chunk_info))
+            if is_datanode_live(address)]
+
+
+def target_replicas(chunk_info):
+    # Copies a chunk is kept at. A shard of an erasure-coded chunk is stored once, the
+    # parity of its chunk stands in for the copies
+    return 1 if 'shard' in chunk_info else replication_factor
+
+
+def enqueue_chunk(data_id, chunk_id, live_replicas):
+    # Queues one chunk for re-replication unless it already is. Returns True if queued
+    with replication_condition:
+        if (data_id, chunk_id) in replication_queued:
+            return False
+        replication_queued.add((data_id, chunk_id))
+        heapq.heappush(replication_queue, (live_replicas,
+                       next(replication_sequence), data_id, chunk_id))
+        replication_totals['queued'] += 1
+        replication_condition.notify()
+        return True
+
+
+def enqueue_under_replicated(address=None, data_ids=None):
+    # arguments address(str), data_ids(list of str)
+    # Queues the under-replicated chunks that had a copy on the DataNode at address,
+    # of the given files, or of every file when neither is given. Returns the count
+
+    if data_ids is None:
+        query = {'datanode_address': address} if address else {}
+        data_ids = set(chunk_info['file_id'] for chunk_info in chunks_collection.find(
+            query, {'_id': 0, 'file_id': 1}))
+        if address:
+            data_ids.update(replica['data_id'] for replica in replication_collection.find(
+                {'datanode_address': address, 'status': 'success'}, {'_id': 0, 'data_id': 1}))
+    data_ids = list(data_ids)
+
+    queued = 0
+    shard_entries = {}
+    # Reads the chunk placements of the files a batch at a time, a full scan only
+    # needs a few queries and leaves the chunk map cache alone
+    for start in range(0, len(data_ids), 500):
+        entries = load_chunk_map_entries(data_ids[start:start + 500])
+        for data_id, entry in entries.items():
+            for chunk_info in entry['chunks']:
+                # Deduplicated chunks are replicated as the chunk they point at
+                stored_id, stored_info, stored_entry = resolve_chunk(data_id, entry, chunk_info)
+                if stored_info is None:
+                    continue
+
+                # An erasure-coded chunk is checked shard by shard
+                candidates = [stored_info]
+                if 'ec' in stored_info:
+                    stored_id = stored_info['ec']['data_id']
+                    if stored_id not in shard_entries:
+                        shard_entries[stored_id] = load_chunk_map_entries([stored_id])[stored_id]
+                    stored_entry = shard_entries[stored_id]
+                    candidates = [shard_info for shard_info in stripe_shards(
+                        stored_entry, stored_info['ec']['first'],
+                        stored_info['ec']['k'] + stored_info['ec']['m']) if shard_info]
+
+                for candidate in candidates:
+                    live_replicas = len(live_locations(stored_entry, candidate))
+                    if live_replicas < target_replicas(candidate) and \
+                            enqueue_chunk(stored_id, candidate['chunk_id'], live_replicas):
+                        queued += 1
+
+    if queued:
+        print(f"Queued {queued} under-replicated chunks for re-replication", flush=True)
+    return queued
+
+
+def plan_replication(entry, chunk_id):
+    # arguments entry(dict) - chunk map entry of the chunk's file, chunk_id(int)
+    # Picks a source and the targets of a copy of the chunk, among DataNodes that have
+    # a free re-replication slot. Must be called with replication_condition held, so
+    # the caller loads entry beforehand: a chunk map miss goes to MongoDB.
+    # Returns ('done' | 'lost' | 'no_target' | 'busy' | 'copy' | 'reconstruct', source,
+    # targets), where the source of a reconstruction is a list of (chunk_id, address)
+    # of the shards it is rebuilt from
+
+    chunk_info = next((chunk_info for chunk_info in entry['chunks']
+                       if chunk_info['chunk_id'] == chunk_id), None)
+    if chunk_info is None:
+        # The file was deleted in the meantime
+        return 'done', None, []
+
+    def has_slot(address):
+        return replication_node_active.get(address, 0) < replication_node_concurrency
+
+    sources = live_locations(entry, chunk_info)
+    missing = target_replicas(chunk_info) - len(sources)
+    if missing <= 0:
+        return 'done', None, []
+    if not sources and 'shard' in chunk_info:
+        return plan_reconstruction(entry, chunk_info, has_slot)
+    if not sources:
+        return 'lost', None, []
+
+    holders = set(chunk_locations_of(entry, chunk_info))
+    load = {address: node_load for address, node_load in placement_load(get_active_nodes()).items()
+            if address not in holders}
+    if not load:
+        # Every live DataNode already has a copy, the next scan tries again
+        return 'no_target', None, []
+
+    sources = [address for address in sources if has_slot(address)]
+    load = {address: node_load for address, node_load in load.items() if has_slot(address)}
+    if not sources or not load:
+        return 'busy', None, []
+
+    source = min(sources, key=lambda address: replication_node_active.get(address, 0))
+    targets = place_chunk(load, chunk_info.get('size') or 0, count=missing)
+    return 'copy', source, targets
+
+
+def plan_reconstruction(entry, chunk_info, has_slot):
+    # arguments entry(dict) - chunk map entry of the shards, chunk_info(dict) - the lost
+    # shard, has_slot(function of a DataNode address)
+    # Picks k live shards of the same chunk to rebuild a lost shard from, and a DataNode
+    # for it that holds none of the chunk's other shards. Same results as plan_replication
+
+    shard = chunk_info['shard']
+    stripe = [shard_info for shard_info in stripe_shards(
+        entry, shard['first'], shard['k'] + shard['m'])
+        if shard_info is not None and shard_info['chunk_id'] != chunk_info['chunk_id']]
+    sources = [(shard_info['chunk_id'], live_locations(entry, shard_info)[0])
+               for shard_info in stripe if live_locations(entry, shard_info)]
+    if len(sources) < shard['k']:
+        return 'lost', None, []
+
+    # Overwriting a corrupt shard in place is fine, a DataNode with another shard of
+    # the chunk is not
+    holders = set(shard_info['datanode_address'] for shard_info in stripe)
+    load = {address: node_load for address, node_load in placement_load(get_active_nodes()).items()
+            if address not in holders}
+    if not load:
+        return 'no_target', None, []
+
+    sources = [source for source in sources if has_slot(source[1])]
+    load = {address: node_load for address, node_load in load.items() if has_slot(address)}
+    if len(sources) < shard['k'] or not load:
+        return 'busy', None, []
+
+    # The least busy sources, data shards first among equals since they need no solving
+    sources.sort(key=lambda source: replication_node_active.get(source[1], 0))
+    return 'reconstruct', sources[:shard['k']], place_chunk(load, chunk_info['size'], count=1)
+
+
+def throttle_replication(addresses, size):
+    # Holds a copy back until every DataNode taking part in it has the bandwidth
+    # for size more bytes, with replication_node_bandwidth bytes per second per node
+
+    if replication_node_bandwidth <= 0:
+        return
 
-    return jsonify({"message": "Re-replication successful"}), 200
+    with replication_condition:
+        now = time.monotonic()
+        ready_at = now
+        for address in addresses:
+            next_free = max(now, replication_node_next_free.get(address, now)) + \
+                size / replication_node_bandwidth
+            replication_node_next_free[address] = next_free
+            ready_at = max(ready_at, next_free - size / replication_node_bandwidth)
+
+    time.sleep(max(0, ready_at - now))
+
+
+def record_replica(data_id, chunk_id, datanode_address):
+    # Records a successful copy of a chunk, replacing a 'missing' or 'failure' entry
+    # of the same DataNode if there is one
+
+    replication_collection.update_one(
+        {'data_id': data_id, 'chunk_id': chunk_id,
+            'datanode_address': datanode_address},
+        {'$set': {'status': 'success'}},
+        upsert=True)
+
+    with metadata_lock:
+        entry = chunk_map.get(data_id)
+        replicas = entry['replicas'].get(chunk_id, []) if entry is not None else []
+        if any(replica['datanode_address'] == datanode_address for replica in replicas):
+            cache_set_replica_status(data_id, chunk_id, datanode_address, 'success')
+        else:
+            cache_add_replica(data_id, chunk_id, datanode_address, 'success')
 
 
-@app.route('/delete_file', methods=['POST'])
-def delete_file():
+def copy_chunk(data_id, chunk_id, source, targets):
+    # arguments data_id(str), chunk_id(int), source(str), targets(list of str)
+    # Copies a chunk from source to the targets, which pass it down a pipeline
 
-    file_name = request.form.get('file_name')
-    directory_path = request.form.get('directory_path', '/')
+    copied = 0
+    size = 0
+    try:
+        # Compressed chunks are copied as they are stored, with their codec
+        chunk_data = fetch_chunk_from_datanode(source, data_id, chunk_id)
+        chunk_info = find_chunk_info(data_id, chunk_id)
+        checksum = chunk_info.get('checksum')
+        if chunk_data is not None and checksum is not None and zlib.crc32(chunk_data) != checksum:
+            # Never spread a corrupt copy, the chunk is queued again with another source
+            report_corrupt_replica(data_id, chunk_id, source)
+            chunk_data = None
+        if chunk_data is not None:
+            size = len(chunk_data)
+            throttle_replication([source] + targets, size)
+            for result in write_chunk_pipeline(data_id, chunk_id, chunk_data, targets,
+                                               chunk_info.get('codec')):
+                # Chunks stored before checksums were kept have none to compare with
+                if result['status'] == 'success' and \
+                        (checksum is None or result.get('checksum') in (None, checksum)):
+                    record_replica(data_id, chunk_id, result['address'])
+                    copied += 1
+    except Exception as e:
+        print(f"Re-replication of chunk {chunk_id} of {data_id} failed: {e}", flush=True)
+    finally:
+        attempts = finish_replication(data_id, chunk_id, [source] + targets, copied, size)
+
+    if copied:
+        print(f"Re-replicated chunk {chunk_id} of {data_id} from {source} to {copied} DataNodes",
+              flush=True)
+
+    requeue_replication(data_id, chunk_id, attempts)
+
+
+def reconstruct_shard(data_id, chunk_id, sources, targets):
+    # arguments data_id(str), chunk_id(int) - the lost shard, sources(list of (chunk_id,
+    # address)) - k live shards of its chunk, targets(list with one DataNode address)
+    # Rebuilds a lost or corrupt shard from the other shards of its chunk and stores it
+    # on the target, which becomes the shard's location
+
+    rebuilt = 0
+    size = 0
+    addresses = [address for _, address in sources] + targets
+    try:
+        entry = get_chunk_map(data_id)
+        chunk_info = find_chunk_info(data_id, chunk_id)
+        shard = chunk_info['shard']
+        infos = {shard_info['chunk_id']: shard_info for shard_info in entry['chunks']
+                 if shard_info['chunk_id'] in dict(sources)}
+
+        def fetch_source(source):
+            source_id, address = source
+            return fetch_chunk_with_fallback(data_id, source_id, [address],
+                                             checksum=infos[source_id].get('checksum'))
+
+        shards = {}
+        for (source_id, _), shard_data in zip(sources, ec_executor.map(fetch_source, sources)):
+            if shard_data is not None:
+                shards[source_id - shard['first']] = shard_data
+
+        if len(shards) == shard['k']:
+            size = chunk_info['size']
+            throttle_replication(addresses, size)
+            shard_data = rs_reconstruct(shards, shard['k'], shard['m'], [shard['index']])[0].tobytes()
+            result = write_chunk_pipeline(data_id, chunk_id, shard_data, targets)[0]
+            if result['status'] == 'success':
+                record_shard_location(data_id, chunk_info, result['address'], result.get('checksum'))
+                rebuilt = 1
+    except Exception as e:
+        print(f"Reconstruction of shard {chunk_id} of {data_id} failed: {e}", flush=True)
+    finally:
+        attempts = finish_replication(data_id, chunk_id, addresses, rebuilt, size)
+
+    if rebuilt:
+        with ec_totals_lock:
+            ec_totals['shards_reconstructed'] += 1
+        print(f"Reconstructed shard {chunk_id} of {data_id} on {targets[0]}", flush=True)
+
+    requeue_replication(data_id, chunk_id, attempts)
+
+
+def record_shard_location(data_id, chunk_info, datanode_address, checksum):
+    # Moves a rebuilt shard to its new DataNode. The old one stays on record as a
+    # 'replaced' replica, so the garbage collector still deletes what is left there
+
+    previous = chunk_info['datanode_address']
+    update = {'$set': {'datanode_address': datanode_address}, '$unset': {'status': ''}}
+    if checksum is not None:
+        update['$set']['checksum'] = checksum
+
+    def write(session):
+        chunks_collection.update_one({'file_id': data_id, 'chunk_id': chunk_info['chunk_id']},
+                                     update, session=session)
+        if previous != datanode_address:
+            replication_collection.update_one(
+                {'data_id': data_id, 'chunk_id': chunk_info['chunk_id'],
+                 'datanode_address': previous},
+                {'$set': {'status': 'replaced'}}, upsert=True, session=session)
+
+    run_metadata_transaction(write)
+
+    with metadata_lock:
+        chunk_info['datanode_address'] = datanode_address
+        chunk_info.pop('status', None)
+        if checksum is not None:
+            chunk_info['checksum'] = checksum
+
+
+def finish_replication(data_id, chunk_id, addresses, copied, size):
+    # Releases the re-replication slots of a finished copy or reconstruction and
+    # counts it. Returns the number of attempts made at the chunk so far
+    with replication_condition:
+        for address in addresses:
+            replication_node_active[address] -= 1
+        del replication_in_progress[(data_id, chunk_id)]
+        replication_queued.discard((data_id, chunk_id))
+        replication_totals['replicas_created'] += copied
+        replication_totals['bytes_copied'] += copied * size
+        attempts = replication_attempts.get((data_id, chunk_id), 0) + 1
+        replication_attempts[(data_id, chunk_id)] = attempts
+        replication_condition.notify_all()
+    return attempts
+
+
+def requeue_replication(data_id, chunk_id, attempts):
+    # Queue the chunk again if it still lacks replicas, e.g. a target failed or not
+    # enough targets were free
+    entry = get_chunk_map(data_id)
+    chunk_info = next((chunk_info for chunk_info in entry['chunks']
+                       if chunk_info['chunk_id'] == chunk_id), None)
+    if chunk_info is None or len(live_locations(entry, chunk_info)) >= target_replicas(chunk_info):
+        with replication_condition:
+            replication_totals['completed'] += 1
+            replication_attempts.pop((data_id, chunk_id), None)
+    elif attempts >= replication_max_attempts:
+        print(f"Giving up re-replication of chunk {chunk_id} of {data_id}", flush=True)
+        with replication_condition:
+            replication_totals['failed'] += 1
+            replication_attempts.pop((data_id, chunk_id), None)
+    else:
+        enqueue_chunk(data_id, chunk_id, len(live_locations(entry, chunk_info)))
+
+
+def replication_daemon():
+    # Copies the queued chunks, most urgent first, on up to replication_workers
+    # threads. A chunk whose DataNodes are all busy waits while later chunks go ahead
+
+    last_scan = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=max(1, replication_workers)) as replication_executor:
+        while True:
+            # Chunks leave the queue a batch at a time and their chunk maps are loaded
+            # without holding the condition, which heartbeats and enqueues wait on. Busy
+            # chunks are put back once every chunk that could start has been tried
+            busy = []
+            while True:
+                with replication_condition:
+                    batch = []
+                    while replication_queue and \
+                            len(replication_in_progress) + len(batch) < replication_workers:
+                        batch.append(heapq.heappop(replication_queue))
+                if not batch:
+                    break
+
+                try:
+                    entries = {data_id: get_chunk_map(data_id) for _, _, data_id, _ in batch}
+                except pymongo.errors.PyMongoError as e:
+                    print(f"Re-replication cannot read chunk maps: {e}", flush=True)
+                    busy.extend(batch)
+                    break
+
+                with replication_condition:
+                    for live_replicas, sequence, data_id, chunk_id in batch:
+                        outcome, source, targets = plan_replication(
+                            entries[data_id], chunk_id)
+
+                        if outcome in ('copy', 'reconstruct'):
+                            addresses = [source] if outcome == 'copy' else \
+                                [address for _, address in source]
+                            for address in addresses + targets:
+                                replication_node_active[address] = replication_node_active.get(
+                                    address, 0) + 1
+                            replication_in_progress[(data_id, chunk_id)] = {
+                                'data_id': data_id, 'chunk_id': chunk_id, 'source': source,
+                                'targets': targets, 'live_replicas': live_replicas,
+                                'started': time.time()}
+                            replication_executor.submit(
+                                copy_chunk if outcome == 'copy' else reconstruct_shard,
+                                data_id, chunk_id, source, targets)
+                        elif outcome == 'busy':
+                            busy.append((live_replicas, sequence, data_id, chunk_id))
+                        else:
+                            replication_queued.discard((data_id, chunk_id))
+                            replication_totals[{'done': 'completed', 'lost': 'lost',
+                                                'no_target': 'no_target'}[outcome]] += 1
+                            if outcome == 'lost':
+                                print(f"No live replica left of chunk {chunk_id} of {data_id}",
+                                      flush=True)
+
+            with replication_condition:
+                for item in busy:
+                    heapq.heappush(replication_queue, item)
+
+                # Woken up by a new chunk or a finished copy, or to retry busy chunks
+                replication_condition.wait(timeout=1)
+
+            if time.monotonic() - last_scan >= replication_scan_interval:
+                last_scan = time.monotonic()
+                enqueue_under_replicated()
+
+
+@app.route('/replication_status', methods=['GET'])
+def replication_status():
+    # Progress of the re-replication daemon
+    with ec_totals_lock:
+        erasure_coding_totals = dict(ec_totals)
+    with replication_condition:
+        urgency = {}
+        for live_replicas, _, _, _ in replication_queue:
+            urgency[live_replicas] = urgency.get(live_replicas, 0) + 1
+        return jsonify({
+            'queued': len(replication_queue),
+            # Number of queued chunks by their count of live replicas
+            'queued_by_live_replicas': urgency,
+            'in_progress': list(replication_in_progress.values()),
+            'node_active_copies': {address: active for address, active in replication_node_active.items() if active},
+            'totals': replication_totals,
+            'erasure_coding': erasure_coding_totals,
+            'limits': {'workers': replication_workers,
+                       'node_concurrency': replication_node_concurrency,
+                       'node_bandwidth': replication_node_bandwidth}
+        })
 
-    # Validate and retrieve file_id based on file_name and directory_path
-    file_metadata = files_collection.find_one(
-        {'name': file_name, 'directory_path': directory_path}, {'_id': 0, 'id': 1})
 
-    if not file_metadata:
-        return jsonify({'error': 'File not found'}), 404
+@app.route('/re_replicate', methods=['POST'])
+def re_replicate():
+    # Queues the under-replicated chunks of a file ahead of the next scan. The
+    # re-replication daemon copies them, /replication_status shows the progress
 
-    data_id = file_metadata['id']
+    file_name = request.form.get('file_name')
+    directory_path = request.form.get('directory_path', '/')
 
-    # Retrieve chunks' metadata from MongoDB
-    chunks_metadata = list(chunks_collection.find(
-        {'file_id': data_id}, {'_id': 0}))
+    # Validate and retrieve file_id based on file_name and directory_path
+    data_id = lookup_file_id(file_name, directory_path)
 
-    # Check if data_id is provided
     if not data_id:
-        return jsonify({'error': 'Invalid data_id'}), 400
-
-    # Fetch file metadata from MongoDB
-    file_metadata = files_collection.find_one({'id': data_id}, {'_id': 0})
-
-    # Check if the file exists
-    if not file_metadata:
         return jsonify({'error': 'File not found'}), 404
 
-    # Delete file metadata from MongoDB
-    files_collection.delete_one({'id': data_id})
-
-    # Delete chunk locations from MongoDB
-    chunks_collection.delete_many({'file_id': data_id})
+    queued = enqueue_under_replicated(data_ids=[data_id])
 
-    # Delete replication chunks from MongoDB
-    replication_collection.delete_many({'data_id': data_id})
+    if queued == 0:
+        return jsonify({"message": "All chunks fully replicated, No Re-Replication Required"}), 200
 
-    # Remove file from directories collection
-    directory_path = file_metadata['directory_path']
-    directories_collection.update_one(
-        {'path': directory_path},
-        {'$pull': {'content': {'file_name': file_metadata['name']}}}
-    )
+    return jsonify({"message": f"Re-replication queued for {queued} chunks"}), 200
 
-    # Delete chunks from DataNodes
-    for datanode_address in datanode_addresses:
 
-        datanode_delete_endpoint = f"{
-            datanode_address}/delete_chunks/{data_id}"
+@app.route('/delete_file', methods=['POST'])
+def delete_file():
 
-        try:
-            response = requests.post(datanode_delete_endpoint)
+    file_name = request.form.get('file_name')
+    directory_path = request.form.get('directory_path', '/')
 
-            if response.status_code != 200:
-                print(f"Failed to delete from {datanode_address}")
-        except requests.exceptions.RequestException:
-            print(f"Failed to connect to {datanode_address}")
+    if not delete_file_from_datanodes(file_name, directory_path):
+        return jsonify({'error': 'File not found'}), 404
 
     return jsonify({"message": f"File '{file_name}' deleted successfully"}), 200
 
@@ -712,104 +3713,355 @@ def delete_folder():
         directory_path = '/' + directory_path
 
     # Check if the folder exists at the specified path
-    if (directory_path != '/'):
-        folder_path = directory_path + '/' + folder_name
-    else:
-        folder_path = directory_path + folder_name
-    folder_metadata = directories_collection.find_one(
-        {'path': folder_path}, {'_id': 0})
+    folder_path = join_path(directory_path, folder_name)
 
-    if not folder_metadata:
+    if not directory_exists(folder_path):
         return jsonify({'error': 'Folder not found'}), 404
 
-    else:
-        directories_collection.update_one(
-            {'path': directory_path},
-            {'$pull': {'content': {'folder_name': folder_name}}}
-        )
-        deletefolder_path.append(folder_path)
+    directories_collection.update_one(
+        {'path': directory_path},
+        {'$pull': {'content': {'folder_name': folder_name}}}
+    )
 
     # Recursively delete the folder and its contents
-    delete_folder_recursive(folder_path)
+    deletefolder_path = [folder_path]
+    delete_folder_recursive(folder_path, deletefolder_path)
 
     for path in deletefolder_path:
         directories_collection.delete_one({'path': path})
+        cache_remove_directory(path)
 
     return jsonify({"message": f"Folder '{folder_name}' deleted successfully"}), 200
 
 
-def delete_folder_recursive(folder_path):
-    # Retrieve folder information from MongoDB
-    folder_metadata = directories_collection.find_one(
-        {'path': folder_path}, {'_id': 0, 'content': 1})
-
-    if folder_metadata and 'content' in folder_metadata:
-        # Delete contents of the folder (files and subfolders)
-        for item in folder_metadata['content']:
-            if 'file_name' in item:
-                # Delete file from MongoDB and DataNodes
-                file_name = item['file_name']
-                delete_file_from_datanodes(file_name, folder_path)
-
-            elif 'folder_name' in item:
-                # Recursively delete subfolders
-                subfolder_name = item['folder_name']
-                subfolder_path = folder_path + '/' + subfolder_name
-                directories_collection.update_one(
-                    {'path': folder_path},
-                    {'$pull': {'content': {'folder_name': subfolder_name}}}
-                )
-                deletefolder_path.append(subfolder_path)
-                delete_folder_recursive(subfolder_path)
-
-    else:
-        return
+def delete_folder_recursive(folder_path, deletefolder_path):
+    # arguments folder_path(str), deletefolder_path(list) - collects the folders to remove
+    # Retrieve folder information from the namespace
+    with metadata_lock:
+        folder = namespace.get(folder_path)
+        if not folder:
+            return
+        file_names = list(folder['files'])
+        subfolder_names = list(folder['folders'])
+
+    # Delete contents of the folder (files and subfolders)
+    for file_name in file_names:
+        # Delete file from MongoDB and DataNodes
+        delete_file_from_datanodes(file_name, folder_path)
+
+    for subfolder_name in subfolder_names:
+        # Recursively delete subfolders
+        subfolder_path = join_path(folder_path, subfolder_name)
+        directories_collection.update_one(
+            {'path': folder_path},
+            {'$pull': {'content': {'folder_name': subfolder_name}}}
+        )
+        deletefolder_path.append(subfolder_path)
+        delete_folder_recursive(subfolder_path, deletefolder_path)
 
 
 def delete_file_from_datanodes(file_name, folder_path):
     # arguments are of type str
-    # Retrieve file metadata from MongoDB
-    file_metadata = files_collection.find_one(
-        {'name': file_name, 'directory_path': folder_path}, {'_id': 0, 'id': 1})
+    # Removes the file's metadata and drops the references its chunks hold. Chunks
+    # nothing refers to anymore are freed by free_unreferenced, and the garbage
+    # collector deletes them from the DataNodes later. Returns False if there is no
+    # such file
+    data_id = lookup_file_id(file_name, folder_path)
 
-    if file_metadata:
-        data_id = file_metadata['id']
-
-        # Delete file metadata from MongoDB
-        files_collection.delete_one({'id': data_id})
+    if not data_id:
+        # File not found
+        print(f"File not found: {file_name}")
+        return False
 
-        # Delete chunk locations from MongoDB
-        chunks_collection.delete_many({'file_id': data_id})
+    refs = chunk_refs_of(data_id, get_chunk_map(data_id)['chunks'])
 
-        # Delete replication chunks from MongoDB
-        replication_collection.delete_many({'data_id': data_id})
+    def write(session):
+        # Delete file metadata from MongoDB
+        files_collection.delete_one(
+            {'name': file_name, 'directory_path': folder_path}, session=session)
 
         # Remove file from directories collection
-        directory_path = folder_path
-
         directories_collection.update_one(
-            {'path': directory_path},
-            {'$pull': {'content': {'file_name': file_name}}}
+            {'path': folder_path},
+            {'$pull': {'content': {'file_name': file_name}}},
+            session=session
         )
 
-        # Delete chunks from DataNodes
-        for datanode_address in datanode_addresses:
+        released = count_chunk_refs(refs, -1, session)
+
+        # Copies made by copy_file share the chunk documents, they stay while one is
+        # left. Otherwise the file's pointers to other chunks go, and the chunks it
+        # stored itself stay as long as other files point at them
+        if not files_collection.count_documents({'id': data_id}, limit=1, session=session):
+            chunks_collection.delete_many(
+                {'file_id': data_id, 'ref': {'$exists': True}}, session=session)
+            released.add(data_id)
+
+        return free_unreferenced(released, session)
+
+    freed = run_metadata_transaction(write)
+
+    cache_remove_file(file_name, folder_path)
+    forget_freed(freed)
+
+    return True
+
+
+def chunk_refs_of(data_id, chunks):
+    # The references a file holds, one per chunk on the chunk holding its bytes. Chunks
+    # stored before reference counting have none, they go with their data_id
+    return [chunk_info.get('ref') or {'data_id': data_id, 'chunk_id': chunk_info['chunk_id']}
+            for chunk_info in chunks if chunk_info.get('digest')]
+
+
+def count_chunk_refs(refs, change, session=None):
+    # arguments refs(list of {'data_id', 'chunk_id'}), change(int) - 1 or -1, session
+    # Adds change to the reference count of the chunk of every ref, once per ref.
+    # Returns the data_ids of the chunks
+
+    counts = Counter((ref['data_id'], ref['chunk_id']) for ref in refs)
+    for (data_id, chunk_id), count in counts.items():
+        chunk_refs_collection.update_one({'data_id': data_id, 'chunk_id': chunk_id},
+                                         {'$inc': {'refs': change * count}}, session=session)
+    return set(data_id for data_id, _ in counts)
+
+
+def free_unreferenced(data_ids, session=None):
+    # arguments data_ids(iterable of str), session
+    # Frees what neither a file nor a reference uses anymore. A data_id without either
+    # goes whole: its metadata goes and every DataNode holding its chunks gets a
+    # tombstone. A deleted file some of whose chunks other files still point at loses
+    # the chunks down to 0 references one by one. Returns {'data_ids': the freed
+    # data_ids, 'chunks': the freed (data_id, chunk_id)}
+
+    freed = {'data_ids': [], 'chunks': []}
+    for data_id in data_ids:
+        if files_collection.count_documents({'id': data_id}, limit=1, session=session):
+            continue
+        if chunk_refs_collection.count_documents(
+                {'data_id': data_id, 'refs': {'$gt': 0}}, limit=1, session=session):
+            freed['chunks'].extend(free_unreferenced_chunks(data_id, session))
+            continue
+
+        # The shards of the file's erasure-coded chunks go with it
+        stored_ids = [data_id] + sorted(set(
+            chunk_info['ec']['data_id'] for chunk_info in chunks_collection.find(
+                {'file_id': data_id, 'ec': {'$exists': True}}, {'_id': 0, 'ec': 1}, session=session)))
+
+        for stored_id in stored_ids:
+            # Every DataNode that was sent a chunk, failed writes included
+            holders = set(chunk_info['datanode_address'] for chunk_info in chunks_collection.find(
+                {'file_id': stored_id, 'datanode_address': {'$exists': True}},
+                {'_id': 0, 'datanode_address': 1}, session=session))
+            holders.update(replica['datanode_address'] for replica in replication_collection.find(
+                {'data_id': stored_id}, {'_id': 0, 'datanode_address': 1}, session=session))
+
+            # Delete chunk locations and replication chunks from MongoDB
+            removed = chunks_collection.delete_many({'file_id': stored_id}, session=session)
+            replication_collection.delete_many({'data_id': stored_id}, session=session)
+            chunk_refs_collection.delete_many({'data_id': stored_id}, session=session)
+            if not removed.deleted_count:
+                continue
+
+            now = datetime.datetime.now()
+            for address in holders:
+                gc_collection.update_one(
+                    {'data_id': stored_id, 'chunk_id': None, 'datanode_address': address},
+                    {'$setOnInsert': {'deleted_at': now, 'attempts': 0}}, upsert=True, session=session)
+            freed['data_ids'].append(stored_id)
+
+    return freed
+
+
+def free_unreferenced_chunks(data_id, session=None):
+    # arguments data_id(str) - a deleted file, session
+    # Frees the chunks of data_id that are down to 0 references, with the shards of
+    # the erasure-coded ones, and tombstones them on every DataNode holding them.
+    # Returns the freed (data_id, chunk_id)
+
+    chunk_ids = [ref['chunk_id'] for ref in chunk_refs_collection.find(
+        {'data_id': data_id, 'refs': {'$lte': 0}}, {'_id': 0, 'chunk_id': 1}, session=session)]
+    if not chunk_ids:
+        return []
+
+    stored = [(data_id, chunk_ids)]
+    for chunk_info in chunks_collection.find(
+            {'file_id': data_id, 'chunk_id': {'$in': chunk_ids}, 'ec': {'$exists': True}},
+            {'_id': 0, 'ec': 1}, session=session):
+        ec = chunk_info['ec']
+        stored.append((ec['data_id'], list(range(ec['first'], ec['first'] + ec['k'] + ec['m']))))
+
+    freed = []
+    now = datetime.datetime.now()
+    for stored_id, stored_chunk_ids in stored:
+        query = {'chunk_id': {'$in': stored_chunk_ids}}
+        holders = set((chunk_info['chunk_id'], chunk_info['datanode_address'])
+                      for chunk_info in chunks_collection.find(
+                          dict(query, file_id=stored_id, datanode_address={'$exists': True}),
+                          {'_id': 0, 'chunk_id': 1, 'datanode_address': 1}, session=session))
+        holders.update((replica['chunk_id'], replica['datanode_address'])
+                       for replica in replication_collection.find(
+                           dict(query, data_id=stored_id),
+                           {'_id': 0, 'chunk_id': 1, 'datanode_address': 1}, session=session))
+
+        chunks_collection.delete_many(dict(query, file_id=stored_id), session=session)
+        replication_collection.delete_many(dict(query, data_id=stored_id), session=session)
+        for chunk_id, address in holders:
+            gc_collection.update_one(
+                {'data_id': stored_id, 'chunk_id': chunk_id, 'datanode_address': address},
+                {'$setOnInsert': {'deleted_at': now, 'attempts': 0}}, upsert=True, session=session)
+        freed.extend((stored_id, chunk_id) for chunk_id in stored_chunk_ids)
+
+    chunk_refs_collection.delete_many(
+        {'data_id': data_id, 'chunk_id': {'$in': chunk_ids}}, session=session)
+    return freed
+
+
+def forget_freed(freed):
+    # Drops the chunk maps of what free_unreferenced freed and wakes the garbage collector
+    if not freed['data_ids'] and not freed['chunks']:
+        return
+    with metadata_lock:
+        for data_id in freed['data_ids']:
+            chunk_map.pop(data_id, None)
+        # Partly freed files are loaded again without the freed chunks
+        for data_id, _ in freed['chunks']:
+            chunk_map.pop(data_id, None)
+    invalidate_cached_chunks(freed['data_ids'], freed['chunks'])
+    with dedup_totals_lock:
+        dedup_totals['data_ids_freed'] += len(freed['data_ids'])
+        dedup_totals['chunks_freed'] += len(freed['chunks'])
+    gc_wakeup.set()
+
+
+def release_chunk_refs(refs):
+    # arguments refs(list of {'data_id', 'chunk_id'})
+    # Gives back references outside of a file delete, freeing what they kept alive
+    if not refs:
+        return
+
+    def write(session):
+        return free_unreferenced(count_chunk_refs(refs, -1, session), session)
 
-            # Create the endpoint for deleting chunks associated with the file
-            datanode_delete_endpoint = f"{
-                datanode_address}/delete_chunks/{data_id}"
+    forget_freed(run_metadata_transaction(write))
 
-            try:
-                # Send a POST request to the DataNode's delete_chunks endpoint
-                response = requests.post(datanode_delete_endpoint)
 
-                if response.status_code != 200:
-                    print(f"Failed to delete from {datanode_address}")
-            except requests.exceptions.RequestException:
-                print(f"Failed to connect to {datanode_address}")
-    else:
-        # File not found
-        print(f"File not found: {file_name}")
+def bulk_delete_on_datanode(address, data_ids, chunks=()):
+    # arguments address(str), data_ids(list of str), chunks(list of (data_id, chunk_id))
+    # Asks one DataNode to delete the chunks of many files, and single chunks. Returns
+    # the data_ids and the (data_id, chunk_id) it no longer holds, or None if the
+    # DataNode could not be reached
+
+    try:
+        response = datanode_request(
+            'POST', address, '/delete_chunks', json={
+                'data_ids': data_ids,
+                'chunks': [{'data_id': data_id, 'chunk_id': chunk_id} for data_id, chunk_id in chunks]})
+        if response.status_code == 200:
+            result = response.json()
+            # A DataNode that does not know single chunks leaves them for the next round
+            return result.get('deleted', []) + result.get('not_found', []), \
+                [(chunk['data_id'], chunk['chunk_id']) for chunk in
+                 result.get('chunks_deleted', []) + result.get('chunks_not_found', [])]
+        print(f"Failed to delete from {address}")
+    except (requests.exceptions.RequestException, ValueError):
+        print(f"Failed to connect to {address}")
+    return None
+
+
+def collect_garbage():
+    # One garbage collection round: every live DataNode with tombstones gets bulk
+    # deletes of gc_batch_size tombstones, all DataNodes at the same time. Tombstones
+    # of dead DataNodes stay until they come back
+
+    addresses = [address for address in gc_collection.distinct('datanode_address')
+                 if active_datanodes.get(address)]
+
+    def collect_from(address):
+        while True:
+            tombstones = list(gc_collection.find(
+                {'datanode_address': address}, {'data_id': 1, 'chunk_id': 1}).limit(gc_batch_size))
+            if not tombstones:
+                return
+            data_ids = [tombstone['data_id'] for tombstone in tombstones
+                        if tombstone.get('chunk_id') is None]
+            chunks = [(tombstone['data_id'], tombstone['chunk_id']) for tombstone in tombstones
+                      if tombstone.get('chunk_id') is not None]
+
+            result = bulk_delete_on_datanode(address, data_ids, chunks)
+            with gc_totals_lock:
+                gc_totals['requests'] += 1
+                if result is None:
+                    gc_totals['failed_requests'] += 1
+            if result is None:
+                gc_collection.update_many(
+                    {'_id': {'$in': [tombstone['_id'] for tombstone in tombstones]}},
+                    {'$inc': {'attempts': 1}})
+                return
+
+            # A deleted file takes the tombstones of its single chunks along
+            deleted, deleted_chunks = result
+            gc_collection.delete_many(
+                {'datanode_address': address, 'data_id': {'$in': deleted}})
+            for data_id, chunk_id in deleted_chunks:
+                gc_collection.delete_one(
+                    {'datanode_address': address, 'data_id': data_id, 'chunk_id': chunk_id})
+            with gc_totals_lock:
+                gc_totals['data_ids_deleted'] += len(deleted)
+                gc_totals['chunks_deleted'] += len(deleted_chunks)
+            if len(deleted) + len(deleted_chunks) < len(tombstones):
+                # Left for the next round
+                return
+
+    if addresses:
+        with ThreadPoolExecutor(max_workers=len(addresses)) as gc_executor:
+            list(gc_executor.map(collect_from, addresses))
+
+    with gc_totals_lock:
+        gc_totals['rounds'] += 1
+        gc_totals['last_round'] = time.time()
+
+
+def garbage_collector():
+    # Runs a garbage collection round every gc_interval seconds, or right after a
+    # delete, after reclaiming expired allocations
+    while True:
+        gc_wakeup.wait(timeout=gc_interval)
+        gc_wakeup.clear()
+        try:
+            expire_pending_uploads()
+            collect_garbage()
+        except pymongo.errors.PyMongoError as e:
+            print(f"Garbage collection failed: {e}", flush=True)
+
+
+@app.route('/gc_status', methods=['GET'])
+def gc_status():
+    # Tombstones waiting per DataNode and garbage collection totals
+    pending = {address: gc_collection.count_documents({'datanode_address': address})
+               for address in gc_collection.distinct('datanode_address')}
+    with gc_totals_lock:
+        totals = dict(gc_totals)
+    return jsonify({'pending_per_datanode': pending, 'totals': totals})
+
+
+@app.route('/dedup_stats', methods=['GET'])
+def dedup_stats():
+    # Chunks stored under reference counting and the references to them. logical_bytes
+    # counts every file and copy, stored_bytes every chunk once
+    totals = next(chunk_refs_collection.aggregate([{'$group': {
+        '_id': None,
+        'chunks': {'$sum': 1},
+        'references': {'$sum': '$refs'},
+        'stored_bytes': {'$sum': '$size'},
+        'logical_bytes': {'$sum': {'$multiply': ['$size', '$refs']}}
+    }}]), {'chunks': 0, 'references': 0, 'stored_bytes': 0, 'logical_bytes': 0})
+    totals.pop('_id', None)
+    totals['dedup_ratio'] = round(totals['logical_bytes'] / totals['stored_bytes'], 3) \
+        if totals['stored_bytes'] else None
+    with dedup_totals_lock:
+        since_start = dict(dedup_totals)
+    return jsonify({'enabled': bool(dedup_enabled), 'totals': totals, 'since_start': since_start})
 
 
 @app.route('/copy_file', methods=['POST'])
@@ -827,32 +4079,49 @@ def copy_file():
         return jsonify({'error': 'Paths must start with \'/\''}), 400
 
     # Check if the file or folder exists at the original path
-    file_metadata = files_collection.find_one(
-        {'name': file_name, 'directory_path': original_path}, {'_id': 0, 'id': 1})
+    data_id = lookup_file_id(file_name, original_path)
 
-    if not file_metadata:
+    if not data_id:
         return jsonify({'error': 'File not found at the original path'}), 404
 
-    data_id = file_metadata['id']
+    if not directory_exists(destination_path):
+        return jsonify({'error': 'Invalid destination path'}), 400
+
+    if file_exists(file_name, destination_path):
+        return jsonify({'error': f"File '{file_name}' already exists in {destination_path}"}), 409
 
-    # Update the directory_path in the files_collection
-    number_of_chunks = files_collection.find_one(
-        {'id': data_id}, {'_id': 0, 'number_of_chunks': 1})
+    # The copy shares the chunks of the original, only its location differs. It holds
+    # one more reference on each of them
+    chunks = get_chunk_map(data_id)['chunks']
+    refs = chunk_refs_of(data_id, chunks)
     file_data = {
         'id': data_id,
         'name': file_name,
-        'number_of_chunks': number_of_chunks['number_of_chunks'],
+        'number_of_chunks': len(chunks),
         'replication_factor': replication_factor,
         'directory_path': destination_path,
         'upload_time': datetime.datetime.now()
     }
-    files_collection.insert_one(file_data)
+    if all('size' in chunk_info for chunk_info in chunks):
+        file_data['file_size'] = sum(chunk_info['size'] for chunk_info in chunks)
 
-    # Update the directory information in MongoDB
-    directories_collection.update_one(
-        {'path': destination_path},
-        {'$addToSet': {'content': {'file_name': file_name}}}
-    )
+    def write(session):
+        files_collection.insert_one(file_data, session=session)
+        count_chunk_refs(refs, 1, session)
+
+        # Update the directory information in MongoDB
+        directories_collection.update_one(
+            {'path': destination_path},
+            {'$addToSet': {'content': {'file_name': file_name}}},
+            session=session
+        )
+
+    try:
+        run_metadata_transaction(write)
+    except pymongo.errors.DuplicateKeyError:
+        return jsonify({'error': f"File '{file_name}' already exists in {destination_path}"}), 409
+
+    cache_add_file(file_name, destination_path, data_id)
 
     return jsonify({"message": f"File '{file_name}' copied successfully from {original_path} to {destination_path}"}), 200
 
@@ -860,9 +4129,26 @@ def copy_file():
 if __name__ == '__main__':
 
     port = int(os.getenv("PORT"))
+
+    # Make sure every metadata query can use an index before serving requests
+    ensure_indexes()
+
+    # Reads are served from memory from here on
+    load_metadata_cache()
+
     health_thread = threading.Thread(target=check_datanodes_health)
     # This ensures the thread exits when the main process does
     health_thread.daemon = True
     health_thread.start()
 
-    app.run(host='0.0.0.0', port=port, debug=True)
+    replication_thread = threading.Thread(target=replication_daemon)
+    replication_thread.daemon = True
+    replication_thread.start()
+
+    gc_thread = threading.Thread(target=garbage_collector)
+    gc_thread.daemon = True
+    gc_thread.start()
+
+    # The reloader would run a second copy of this module, with its own metadata
+    # cache and background threads, so it stays off
+    app.run(host='0.0.0.0', port=port, debug=True, use_reloader=False)
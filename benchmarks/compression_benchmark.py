@@ -0,0 +1,122 @@
+# Compression benchmark for chunk codecs: compresses sample data chunk by chunk, the
+# way uploads do, and reports the ratio next to the compression and decompression
+# throughput of every codec.
+#
+#   python benchmarks/compression_benchmark.py --chunk-size 4194304 --files data/dummy2.txt
+#
+# Without --files it runs on generated samples: log lines, JSON records and random
+# bytes (incompressible, which uploads store uncompressed). codecs below mirrors
+# compression_codecs in NameNode.py (and cli.py): the same names, each at the level
+# NameNode.py compresses with, plus the levels given with --levels to see what a
+# different setting would trade
+
+import argparse
+import bz2
+import json
+import lzma
+import os
+import random
+import time
+import zlib
+
+# name -> (compress function taking a level or None, decompress function). Kept by
+# hand in step with compression_codecs in NameNode.py, importing it would connect to
+# MongoDB and start the NameNode's thread pools. A level of None is the library
+# default NameNode.py uses
+codecs = {
+    'zlib': (lambda data, level: zlib.compress(data, -1 if level is None else level), zlib.decompress),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+    'bz2': (lambda data, level: bz2.compress(data, 9 if level is None else level), bz2.decompress),
+}
+
+
+def sample_logs(size):
+    rng = random.Random(1)
+    lines = []
+    total = 0
+    while total < size:
+        line = (f"2024-07-13T{rng.randrange(24):02d}:{rng.randrange(60):02d}:{rng.randrange(60):02d} "
+                f"{rng.choice(['INFO', 'INFO', 'INFO', 'WARN', 'ERROR'])} datanode{rng.randrange(1, 8)} "
+                f"{rng.choice(['wrote', 'read', 'forwarded', 'verified'])} chunk {rng.randrange(1, 64)} "
+                f"of {rng.getrandbits(64):016x} in {rng.randrange(1, 900)}ms\n")
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines).encode()[:size]
+
+
+def sample_json(size):
+    rng = random.Random(2)
+    records = []
+    total = 0
+    while total < size:
+        record = json.dumps({'id': rng.getrandbits(48), 'name': f"file-{rng.randrange(10000)}.bin",
+                             'size': rng.randrange(1 << 30), 'replicas': rng.randrange(1, 4),
+                             'tags': rng.sample(['hot', 'cold', 'log', 'media', 'backup'], 2)}) + '\n'
+        records.append(record)
+        total += len(record)
+    return ''.join(records).encode()[:size]
+
+
+def sample_random(size):
+    return os.urandom(size)
+
+
+def split_chunks(data, chunk_size):
+    return [data[start:start + chunk_size] for start in range(0, len(data), chunk_size)]
+
+
+def run_codec(chunks, compress, decompress, level):
+    started = time.perf_counter()
+    compressed = [compress(chunk, level) for chunk in chunks]
+    compress_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    for stored in compressed:
+        decompress(stored)
+    decompress_seconds = time.perf_counter() - started
+
+    original = sum(len(chunk) for chunk in chunks)
+    # A chunk the codec does not shrink is stored as it is
+    stored_size = sum(min(len(stored), len(chunk)) for stored, chunk in zip(compressed, chunks))
+    return {
+        'ratio': original / stored_size,
+        'compress_mb_per_s': original / compress_seconds / (1024 * 1024),
+        'decompress_mb_per_s': original / decompress_seconds / (1024 * 1024),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Ratio against throughput for the chunk compression codecs')
+    parser.add_argument('--files', nargs='*', default=[])
+    parser.add_argument('--size', type=int, default=16 * 1024 * 1024,
+                        help='bytes of each generated sample')
+    parser.add_argument('--chunk-size', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--codecs', default=','.join(codecs))
+    parser.add_argument('--levels', default='zlib:1,zlib:9,lzma:0,bz2:1',
+                        help='extra codec:level pairs to compare with the defaults')
+    args = parser.parse_args()
+
+    samples = [(os.path.basename(path), open(path, 'rb').read()) for path in args.files]
+    if not samples:
+        samples = [('logs', sample_logs(args.size)), ('json', sample_json(args.size)),
+                   ('random', sample_random(args.size))]
+
+    variants = [(name, None) for name in args.codecs.split(',')]
+    for pair in filter(None, args.levels.split(',')):
+        name, level = pair.split(':')
+        variants.append((name, int(level)))
+
+    print(f"{'sample':<14}{'codec':<12}{'ratio':>8}{'comp MB/s':>12}{'decomp MB/s':>13}")
+    for sample_name, data in samples:
+        chunks = split_chunks(data, args.chunk_size)
+        for name, level in variants:
+            compress, decompress = codecs[name]
+            result = run_codec(chunks, compress, decompress, level)
+            label = name if level is None else f"{name}:{level}"
+            print(f"{sample_name:<14}{label:<12}{result['ratio']:>8.2f}"
+                  f"{result['compress_mb_per_s']:>12.1f}{result['decompress_mb_per_s']:>13.1f}")
+
+
+if __name__ == '__main__':
+    main()
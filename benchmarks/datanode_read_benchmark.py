@@ -0,0 +1,129 @@
+# Load benchmark for DataNode chunk reads: starts a DataNode in each serving mode,
+# stores a set of chunks on it and reads them back from many threads at once.
+#
+#   python benchmarks/datanode_read_benchmark.py --concurrency 32 --requests 512
+#
+# Modes are the SERVER_MODE values of DataNode.py: 'dev' is the Flask debug server,
+# 'production' is gunicorn (or Werkzeug's threaded server without gunicorn).
+# --range-size reads that many bytes from a random offset instead of whole chunks
+
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+datanode_script = os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..', 'DataNode', 'DataNode.py')
+
+
+def start_datanode(mode, port, folder):
+    # DataNode.py stores chunks next to itself, so each run gets its own copy
+    shutil.copy(datanode_script, folder)
+    env = dict(os.environ, PORT=str(port), SERVER_MODE=mode,
+               # Nobody listens there, the heartbeats just fail
+               NAMENODE_URL='http://127.0.0.1:9', HEARTBEAT_INTERVAL='60')
+    process = subprocess.Popen([sys.executable, 'DataNode.py'], cwd=folder, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    for _ in range(100):
+        try:
+            requests.get(f"http://127.0.0.1:{port}/is_active", timeout=1)
+            return process
+        except requests.exceptions.RequestException:
+            time.sleep(0.1)
+
+    process.kill()
+    raise RuntimeError(f"DataNode in {mode} mode did not start")
+
+
+def store_chunks(base_url, data_id, count, chunk_size):
+    for chunk_id in range(1, count + 1):
+        response = requests.post(f"{base_url}/write_file/", data=os.urandom(chunk_size),
+                                 params={'data_id': data_id,
+                                         'chunk_id': chunk_id},
+                                 headers={'Content-Type': 'application/octet-stream'})
+        response.raise_for_status()
+
+
+def run_load(base_url, data_id, args):
+    sessions = threading.local()
+
+    def read_chunk(_):
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+
+        headers = None
+        if args.range_size:
+            offset = random.randrange(
+                max(1, args.chunk_size - args.range_size))
+            headers = {
+                'Range': f"bytes={offset}-{offset + args.range_size - 1}"}
+
+        started = time.perf_counter()
+        response = sessions.session.get(
+            f"{base_url}/read_file/{data_id}/{random.randint(1, args.chunks)}", headers=headers)
+        response.raise_for_status()
+        return time.perf_counter() - started, len(response.content)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        # Warm up the connections and the page cache
+        list(executor.map(read_chunk, range(args.concurrency)))
+
+        started = time.perf_counter()
+        results = list(executor.map(read_chunk, range(args.requests)))
+        elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, _ in results)
+    total_bytes = sum(size for _, size in results)
+    return {
+        'requests_per_s': args.requests / elapsed,
+        'mb_per_s': total_bytes / elapsed / (1024 * 1024),
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Concurrent chunk read benchmark for the DataNode')
+    parser.add_argument('--modes', default='dev,production')
+    parser.add_argument('--port', type=int, default=9701)
+    parser.add_argument('--chunks', type=int, default=16)
+    parser.add_argument('--chunk-size', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--range-size', type=int, default=0)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=512)
+    args = parser.parse_args()
+
+    print(f"{args.requests} reads of {args.range_size or args.chunk_size} bytes, "
+          f"{args.concurrency} at a time")
+    print(f"{'mode':<12}{'req/s':>10}{'MB/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+
+    for offset, mode in enumerate(args.modes.split(',')):
+        port = args.port + offset
+        base_url = f"http://127.0.0.1:{port}"
+        folder = tempfile.mkdtemp(prefix=f"datanode-{mode}-")
+        process = start_datanode(mode, port, folder)
+        try:
+            data_id = str(uuid.uuid4())
+            store_chunks(base_url, data_id, args.chunks, args.chunk_size)
+            result = run_load(base_url, data_id, args)
+            print(f"{mode:<12}{result['requests_per_s']:>10.1f}{result['mb_per_s']:>10.1f}"
+                  f"{result['p50_ms']:>10.1f}{result['p99_ms']:>10.1f}")
+        finally:
+            process.terminate()
+            process.wait()
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
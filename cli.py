@@ -5,43 +5,547 @@ from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
 from prompt_toolkit.completion import WordCompleter
 import requests
 import os
+import zlib
+import hashlib
+import lzma
+import bz2
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
 
 
 commands = ["upload_file", "get_file", "get_info", "exit", "create_directory", "move_file", "move_folder",
-            "re_replicate", "delete_file", "get_directory", "list_directory", "datanode_status", "delete_folder", "copy_file"]
+            "re_replicate", "delete_file", "get_directory", "list_directory", "datanode_status", "delete_folder", "copy_file",
+            "upload_file_direct", "get_file_direct", "read_range", "set_compression", "set_erasure_coding"]
 command_completer = WordCompleter(commands)
 
 # NameNode API endpoint
 namenode_url = "http://localhost:8090"
 
+# The NameNode knows DataNodes by their docker-compose service names, which only
+# resolve inside the docker network. The direct data path reaches them through
+# their published ports on this host instead
+datanode_host = os.getenv("YADFS_DATANODE_HOST", "localhost")
+
+# The chunk codecs of the NameNode, for the direct data path where this client
+# compresses and decompresses the chunks itself
+compression_codecs = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress),
+    'bz2': (bz2.compress, bz2.decompress),
+}
+
+
+# Chunks never change once written, so downloaded chunks are kept in a local cache
+# and only the missing ones are transferred when a file is read again. The cache is
+# a directory of one file per chunk, uncompressed, bounded to chunk_cache_bytes and
+# evicted least recently used first. YADFS_CACHE_BYTES=0 turns it off
+chunk_cache_dir = os.getenv("YADFS_CACHE_DIR", os.path.join(
+    os.path.expanduser("~"), ".yadfs", "chunk_cache"))
+chunk_cache_bytes = int(os.getenv("YADFS_CACHE_BYTES", 1024 * 1024 * 1024))
+
+# Cached chunk file name -> size, least recently used first. Loaded from the cache
+# directory on first use, the modification time of a file is its last use
+chunk_cache_index = None
+
+
+def resolve_datanode_url(address):
+    parsed = urlparse(address)
+    return parsed._replace(netloc=f"{datanode_host}:{parsed.port}").geturl()
+
+
+def handle_upload(file_path, chunks, directory_path, compression=None, erasure_coding=None):
+    # compression is a codec name, or None for the directory's compression policy.
+    # erasure_coding is a scheme such as rs-6-3, or None for the directory's policy
+    if not chunks:
+        # No chunk count given: stream the file and let the NameNode cut it into
+        # fixed-size chunks while it arrives
+        with open(file_path, 'rb') as file:
+            response = requests.post(
+                f"{namenode_url}/upload_file_stream",
+                data=file,
+                params={'file_name': os.path.basename(file_path),
+                        'directory_path': directory_path or '/',
+                        'compression': compression or None,
+                        'erasure_coding': erasure_coding or None},
+                headers={'Content-Type': 'application/octet-stream'})
+        indented_json = json.dumps(response.json(), indent=2)
+        print(indented_json)
+        return
 
-def handle_upload(file_path, chunks, directory_path):
     with open(file_path, 'rb') as file:
         # Continue with the file upload
         files = {'file': (os.path.basename(file.name), file)}
         response = requests.post(
             f"{namenode_url}/upload_file",
             files=files,
-            data={'number_of_chunks': chunks, 'directory_path': directory_path})
+            data={'number_of_chunks': chunks, 'directory_path': directory_path,
+                  'compression': compression or None,
+                  'erasure_coding': erasure_coding or None})
     # response = requests.post(f"{namenode_url}/upload_file", files=files, data={'number_of_chunks': chunks})
     indented_json = json.dumps(response.json(), indent=2)
     print(indented_json)
 
 
-def handle_get_file(file_name, directory_path):
-    response = requests.post(
-        f"{namenode_url}/get_file",
-        data={'file_name': file_name, 'directory_path': directory_path}
-    )
+def load_chunk_cache_index():
+    global chunk_cache_index
+
+    if chunk_cache_index is None:
+        os.makedirs(chunk_cache_dir, exist_ok=True)
+        entries = []
+        for entry in os.scandir(chunk_cache_dir):
+            if entry.is_file() and not entry.name.startswith('.tmp-'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        chunk_cache_index = OrderedDict(
+            (name, size) for _, name, size in sorted(entries))
+    return chunk_cache_index
+
+
+def chunk_cache_name(chunk):
+    # A chunk is cached under the data_id and chunk_id it is stored as, so files
+    # sharing a deduplicated chunk share its cache entry, and under its checksum
+    return f"{chunk['data_id']}_{chunk['stored_chunk_id']}_{chunk.get('checksum')}"
+
+
+def chunk_cache_get(chunk):
+    # The cached bytes of a chunk from chunk_locations, or None
+    if chunk_cache_bytes <= 0:
+        return None
+
+    index = load_chunk_cache_index()
+    name = chunk_cache_name(chunk)
+    if name not in index:
+        return None
+
+    path = os.path.join(chunk_cache_dir, name)
+    try:
+        with open(path, 'rb') as cached_file:
+            chunk_data = cached_file.read()
+        os.utime(path)
+    except OSError:
+        index.pop(name, None)
+        return None
+
+    if chunk.get('size') is not None and len(chunk_data) != chunk['size']:
+        # Truncated, e.g. by a full disk
+        index.pop(name, None)
+        os.remove(path)
+        return None
+
+    index.move_to_end(name)
+    return chunk_data
+
+
+def chunk_cache_writer(chunk):
+    # Opens a temporary file for a chunk that is about to be downloaded, None when the
+    # chunk is not cached. chunk_cache_commit puts it in place once it is complete, so
+    # a CLI stopped halfway leaves no torn chunk
+    if chunk_cache_bytes <= 0 or chunk.get('size') is None or chunk['size'] > chunk_cache_bytes:
+        return None
+
+    load_chunk_cache_index()
+    temp_path = os.path.join(chunk_cache_dir, f".tmp-{os.getpid()}-{chunk_cache_name(chunk)}")
+    try:
+        return open(temp_path, 'wb')
+    except OSError as e:
+        print(f"Could not cache chunk {chunk['chunk_id']}: {e}")
+        return None
+
+
+def chunk_cache_discard(cached_file):
+    cached_file.close()
+    try:
+        os.remove(cached_file.name)
+    except OSError:
+        pass
+
+
+def chunk_cache_commit(chunk, cached_file):
+    # Adds a chunk written with chunk_cache_writer to the cache and evicts the least
+    # recently used ones over the bound
+    index = load_chunk_cache_index()
+    name = chunk_cache_name(chunk)
+    try:
+        size = cached_file.tell()
+        cached_file.close()
+        os.replace(cached_file.name, os.path.join(chunk_cache_dir, name))
+    except OSError as e:
+        print(f"Could not cache chunk {chunk['chunk_id']}: {e}")
+        chunk_cache_discard(cached_file)
+        return
+    index[name] = size
+    index.move_to_end(name)
+
+    total = sum(index.values())
+    while total > chunk_cache_bytes and len(index) > 1:
+        evicted, evicted_size = index.popitem(last=False)
+        total -= evicted_size
+        try:
+            os.remove(os.path.join(chunk_cache_dir, evicted))
+        except FileNotFoundError:
+            pass
+
+
+def chunk_cache_put(chunk, chunk_data):
+    # Adds a chunk that is already in memory to the cache
+    cached_file = chunk_cache_writer(dict(chunk, size=len(chunk_data)))
+    if cached_file is None:
+        return
+    try:
+        cached_file.write(chunk_data)
+    except OSError as e:
+        print(f"Could not cache chunk {chunk['chunk_id']}: {e}")
+        chunk_cache_discard(cached_file)
+        return
+    chunk_cache_commit(chunk, cached_file)
+
+
+def fetch_chunks_from_namenode(file_name, directory_path, chunks, offset, output_file):
+    # Reads a run of consecutive chunks through the NameNode with one read_range call,
+    # starting at byte offset of the file. The response is streamed into output_file
+    # and, cut at the chunk boundaries, into the cache as each chunk completes, so
+    # only one block of it is in memory at a time. Returns the bytes read, or None
+    length = sum(chunk['size'] for chunk in chunks)
+    if length == 0:
+        # read_range refuses empty ranges and empty chunks have no bytes to fetch
+        for chunk in chunks:
+            chunk_cache_put(chunk, b'')
+        return 0
+
+    response = requests.get(f"{namenode_url}/read_range", stream=True, params={
+        'file_name': file_name, 'directory_path': directory_path,
+        'offset': offset, 'length': length})
+    if response.status_code != 206:
+        print(response.text)
+        return None
+
+    position = 0
+    remaining = chunks[0]['size']
+    cached_file = chunk_cache_writer(chunks[0])
+    transferred = 0
+    try:
+        for block in response.iter_content(1024 * 1024):
+            while block:
+                piece, block = block[:remaining], block[remaining:]
+                output_file.write(piece)
+                if cached_file is not None:
+                    cached_file.write(piece)
+                remaining -= len(piece)
+                transferred += len(piece)
+
+                # Zero-sized chunks complete along with the one before them
+                while remaining == 0 and position < len(chunks):
+                    if cached_file is not None:
+                        chunk_cache_commit(chunks[position], cached_file)
+                    position += 1
+                    cached_file = None
+                    if position < len(chunks):
+                        remaining = chunks[position]['size']
+                        cached_file = chunk_cache_writer(chunks[position])
+                if position == len(chunks) and block:
+                    print("The NameNode sent more bytes than the chunks hold")
+                    return None
+    except (requests.exceptions.RequestException, OSError) as e:
+        print(f"Download failed: {e}")
+        return None
+    finally:
+        if cached_file is not None:
+            # The response ended inside this chunk
+            chunk_cache_discard(cached_file)
+
+    if transferred != length:
+        print(f"Received {transferred} of {length} bytes")
+        return None
+    return transferred
+
+
+def handle_get_file(file_name, directory_path, output_path=None):
+    # Downloads a file to output_path (by default its name in the working directory).
+    # chunk_locations lists the chunks with their checksums, the ones in the local
+    # chunk cache are not transferred again and every run of missing chunks is read
+    # with a single read_range
+    directory_path = directory_path or '/'
+    output_path = output_path or os.path.basename(file_name)
+
+    response = requests.get(f"{namenode_url}/chunk_locations",
+                            params={'file_name': file_name, 'directory_path': directory_path})
+    if response.status_code != 200:
+        print(response.text)
+        return
+    chunks = response.json()['chunks']
+
+    if any(chunk.get('size') is None for chunk in chunks):
+        # Files stored before chunk sizes were recorded can only be read whole
+        response = requests.post(f"{namenode_url}/get_file", stream=True,
+                                 data={'file_name': file_name, 'directory_path': directory_path})
+        if response.status_code != 200:
+            print(response.text)
+            return
+        with open(output_path, 'wb') as output_file:
+            for block in response.iter_content(1024 * 1024):
+                output_file.write(block)
+        print(f"Saved {file_name} to {output_path}")
+        return
+
+    started = time.monotonic()
+    cached = [chunk_cache_get(chunk) for chunk in chunks]
+    hits = sum(chunk_data is not None for chunk_data in cached)
+    transferred = 0
+
+    with open(output_path, 'wb') as output_file:
+        offset = 0
+        position = 0
+        while position < len(chunks):
+            if cached[position] is not None:
+                output_file.write(cached[position])
+                offset += chunks[position]['size']
+                position += 1
+                continue
+
+            run_end = position
+            while run_end < len(chunks) and cached[run_end] is None:
+                run_end += 1
+            run = chunks[position:run_end]
+
+            received = fetch_chunks_from_namenode(
+                file_name, directory_path, run, offset, output_file)
+            if received is None:
+                print(f"Failed to read chunks {run[0]['chunk_id']} to {run[-1]['chunk_id']}")
+                return
+            transferred += received
+            offset += received
+            position = run_end
+
+    print(f"Saved {file_name} to {output_path}: {hits} of {len(chunks)} chunks from the "
+          f"local cache, {transferred} bytes transferred in {time.monotonic() - started:.2f}s")
+
+
+def handle_read_range(file_name, directory_path, offset, length):
+    # Prints length bytes of the file starting at offset, only those bytes are fetched
+    params = {'file_name': file_name, 'directory_path': directory_path,
+              'offset': offset or 0}
+    if length:
+        params['length'] = length
+    response = requests.get(f"{namenode_url}/read_range", params=params)
     print(response.text)
 
 
-def handle_get_info():
-    response = requests.get(f"{namenode_url}/get_info")
+def write_chunk_direct(data_id, chunk_id, chunk_data, pipeline, codec=None):
+    # Sends the chunk to the first DataNode of its pipeline, which forwards it to the
+    # others. If the head is unreachable the pipeline starts again from the next node.
+    # codec names the compression of chunk_data, if any
+    results = []
+
+    while pipeline:
+        head, downstream = pipeline[0], pipeline[1:]
+        try:
+            response = requests.post(
+                f"{resolve_datanode_url(head)}/write_file/",
+                data=chunk_data,
+                params={'data_id': data_id, 'chunk_id': chunk_id,
+                        'downstream': downstream, 'codec': codec},
+                headers={'Content-Type': 'application/octet-stream'})
+            if response.status_code == 200:
+                result = response.json()
+                results.append({'address': head, 'status': 'success',
+                                'checksum': result.get('checksum')})
+                results.extend(result.get('pipeline', []))
+                return results
+        except requests.exceptions.RequestException:
+            pass
+
+        print(f"Failed to write chunk {chunk_id} to {head}")
+        results.append({'address': head, 'status': 'failure'})
+        pipeline = downstream
+
+    return results
+
+
+def read_file_chunks(file_path, number_of_chunks):
+    # Generator over the chunks of a file cut into number_of_chunks pieces, the first
+    # ones a byte longer when the size does not divide evenly
+    file_size = os.path.getsize(file_path)
+    chunk_size = file_size // number_of_chunks
+    extra_bytes = file_size % number_of_chunks
+
+    with open(file_path, 'rb') as file:
+        for i in range(number_of_chunks):
+            yield file.read(chunk_size + (1 if i < extra_bytes else 0))
+
+
+def handle_upload_direct(file_path, chunks, directory_path, compression=None):
+    number_of_chunks = int(chunks)
+
+    # The NameNode answers chunks it already stores with a ref, those are not sent
+    digests = [hashlib.sha256(chunk_data).hexdigest()
+               for chunk_data in read_file_chunks(file_path, number_of_chunks)]
+
+    response = requests.post(
+        f"{namenode_url}/allocate_chunks",
+        data={'file_name': os.path.basename(file_path),
+              'number_of_chunks': number_of_chunks,
+              'directory_path': directory_path,
+              'file_size': os.path.getsize(file_path),
+              'compression': compression or None,
+              'digest': digests})
+    if response.status_code != 200:
+        print(response.text)
+        return
+
+    allocation = response.json()
+    data_id = allocation['data_id']
+    # The codec picked by the NameNode from the request and the directory's policy
+    codec = allocation.get('compression')
+
+    # Write every chunk straight to its DataNodes, the NameNode never sees the data
+    chunk_records = []
+    for chunk_data, placement, digest in zip(read_file_chunks(file_path, number_of_chunks),
+                                             allocation['chunks'], digests):
+        record = {'chunk_id': placement['chunk_id'], 'size': len(chunk_data)}
+        if 'ref' in placement:
+            chunk_records.append(record)
+            continue
+        record['digest'] = digest
+
+        # Chunks the codec does not shrink are stored as they are
+        stored_data = compression_codecs[codec][0](chunk_data) if codec else chunk_data
+        if len(stored_data) < len(chunk_data):
+            record['codec'] = codec
+            record['stored_size'] = len(stored_data)
+        else:
+            stored_data = chunk_data
+
+        record['replicas'] = write_chunk_direct(
+            data_id, placement['chunk_id'], stored_data, placement['pipeline'],
+            record.get('codec'))
+        chunk_records.append(record)
+
+    response = requests.post(f"{namenode_url}/commit_file",
+                             json={'data_id': data_id, 'chunks': chunk_records})
+    indented_json = json.dumps(response.json(), indent=2)
+    print(indented_json)
+
+
+def read_ec_chunk_direct(chunk):
+    # The stored bytes of an erasure-coded chunk from its data shards, None if one of
+    # them cannot be read intact. Rebuilding a chunk from its parity is left to the NameNode
+    ec = chunk['ec']
+    shards = []
+    for shard in ec['data_shards']:
+        shard_data = None
+        for address in (shard or {}).get('locations', []):
+            try:
+                response = requests.get(
+                    f"{resolve_datanode_url(address)}/read_file/{shard['data_id']}/{shard['chunk_id']}",
+                    headers={'Accept-Encoding': 'identity'})
+            except requests.exceptions.RequestException:
+                continue
+            if response.status_code == 200 and (shard.get('checksum') is None or
+                                                zlib.crc32(response.content) == shard['checksum']):
+                shard_data = response.content
+                break
+        if shard_data is None:
+            return None
+        shards.append(shard_data)
+    return b''.join(shards)[:chunk['stored_size']]
+
+
+def handle_get_file_direct(file_name, directory_path, output_path):
+    response = requests.get(f"{namenode_url}/chunk_locations",
+                            params={'file_name': file_name, 'directory_path': directory_path})
+    if response.status_code != 200:
+        print(response.text)
+        return
+
+    locations = response.json()
+
+    # Read every chunk straight from the first DataNode that has an intact copy, unless
+    # it is in the local chunk cache. Compressed chunks come as they are stored and are
+    # decompressed here
+    with open(output_path, 'wb') as output_file:
+        offset = 0
+        for chunk in locations['chunks']:
+            offset += chunk['size']
+            chunk_data = chunk_cache_get(chunk)
+            if chunk_data is not None:
+                output_file.write(chunk_data)
+                continue
+
+            if 'ec' in chunk:
+                stored_data = read_ec_chunk_direct(chunk)
+                if stored_data is None:
+                    # A data shard is lost, the NameNode rebuilds the chunk from the parity
+                    response = requests.get(f"{namenode_url}/read_range", params={
+                        'file_name': file_name, 'directory_path': directory_path,
+                        'offset': offset - chunk['size'], 'length': chunk['size']})
+                    if response.status_code != 206:
+                        print(f"Failed to read chunk {chunk['chunk_id']}")
+                        return
+                    chunk_data = response.content
+                elif chunk.get('codec'):
+                    chunk_data = compression_codecs[chunk['codec']][1](stored_data)
+                else:
+                    chunk_data = stored_data
+            else:
+                for address in chunk['locations']:
+                    try:
+                        # A deduplicated chunk is read from the file that stored it
+                        chunk_response = requests.get(
+                            f"{resolve_datanode_url(address)}/read_file/{chunk['data_id']}/{chunk['stored_chunk_id']}",
+                            headers={'Accept-Encoding': 'identity'})
+                    except requests.exceptions.RequestException:
+                        continue
+                    if chunk_response.status_code != 200:
+                        continue
+                    if chunk.get('checksum') is not None and \
+                            zlib.crc32(chunk_response.content) != chunk['checksum']:
+                        print(f"Chunk {chunk['chunk_id']} on {address} is corrupt, trying the next copy")
+                        continue
+                    if chunk.get('codec'):
+                        chunk_data = compression_codecs[chunk['codec']][1](chunk_response.content)
+                    else:
+                        chunk_data = chunk_response.content
+                    break
+                else:
+                    print(f"Failed to read chunk {chunk['chunk_id']}")
+                    return
+
+            output_file.write(chunk_data)
+            chunk_cache_put(chunk, chunk_data)
+
+    print(f"Saved {file_name} to {output_path}")
+
+
+def handle_set_compression(directory_path, codec):
+    response = requests.post(f"{namenode_url}/set_compression",
+                             data={'directory_path': directory_path, 'codec': codec})
+    indented_json = json.dumps(response.json(), indent=2)
+    print(indented_json)
+
+
+def handle_set_erasure_coding(directory_path, scheme):
+    response = requests.post(f"{namenode_url}/set_erasure_coding",
+                             data={'directory_path': directory_path, 'scheme': scheme})
     indented_json = json.dumps(response.json(), indent=2)
     print(indented_json)
 
 
+def handle_get_info(path=None, prefix=None):
+    params = {'path': path or None, 'prefix': prefix or None}
+
+    # get_info is paginated, follow the cursor until the last page
+    while True:
+        response = requests.get(f"{namenode_url}/get_info", params=params)
+        page = response.json()
+        indented_json = json.dumps(page, indent=2)
+        print(indented_json)
+
+        if response.status_code != 200 or not page.get('next_cursor'):
+            break
+        params['cursor'] = page['next_cursor']
+
+
 def handle_get_directory():
     response = requests.get(f"{namenode_url}/get_directory")
     indented_json = json.dumps(response.json(), indent=2)
@@ -121,17 +625,57 @@ def main():
         if user_input.lower() == 'exit':
             break
         elif user_input.lower() == 'upload_file':
+            file_path = input("Enter the path to the file to upload: ")
+            chunks = input(
+                "Enter number of chunks (optional, press Enter for fixed-size chunks): ")
+            directory_path = input("Enter the directory path: ")
+            compression = input(
+                "Enter the compression codec (optional, press Enter for the directory's policy): ")
+            erasure_coding = input(
+                "Enter the erasure-coding scheme, e.g. rs-6-3 (optional, press Enter for the directory's policy): ")
+            handle_upload(file_path, chunks, directory_path, compression, erasure_coding)
+        elif user_input.lower() == 'upload_file_direct':
             file_path = input("Enter the path to the file to upload: ")
             chunks = input("Enter number of chunks: ")
             directory_path = input("Enter the directory path: ")
-            handle_upload(file_path, chunks, directory_path)
+            compression = input(
+                "Enter the compression codec (optional, press Enter for the directory's policy): ")
+            handle_upload_direct(file_path, chunks, directory_path, compression)
+        elif user_input.lower() == 'get_file_direct':
+            file_name = input("Enter the file name to download: ")
+            directory_path = input(
+                "Enter the directory path (optional, press Enter to use '/'): ") or '/'
+            output_path = input("Enter the path to save the file to: ")
+            handle_get_file_direct(file_name, directory_path, output_path)
         elif user_input.lower() == 'get_info':
-            handle_get_info()
+            path = input(
+                "Enter the directory path (optional, press Enter for all): ")
+            prefix = input(
+                "Enter the file name prefix (optional, press Enter for all): ")
+            handle_get_info(path, prefix)
         elif user_input.lower() == 'get_file':
             file_name = input("Enter the file name to download: ")
             directory_path = input(
                 "Enter the directory path (optional, press Enter to use '/'): ")
-            handle_get_file(file_name, directory_path)
+            output_path = input(
+                "Enter the path to save the file to (optional, press Enter for the file name): ")
+            handle_get_file(file_name, directory_path, output_path)
+        elif user_input.lower() == 'read_range':
+            file_name = input("Enter the file name to read: ")
+            directory_path = input(
+                "Enter the directory path (optional, press Enter to use '/'): ") or '/'
+            offset = input("Enter the byte offset (optional, press Enter for 0): ")
+            length = input(
+                "Enter the number of bytes (optional, press Enter for the rest of the file): ")
+            handle_read_range(file_name, directory_path, offset, length)
+        elif user_input.lower() == "set_compression":
+            directory_path = input("Enter directory path: ")
+            codec = input("Enter the codec (zlib, lzma, bz2, none or inherit): ")
+            handle_set_compression(directory_path, codec)
+        elif user_input.lower() == "set_erasure_coding":
+            directory_path = input("Enter directory path: ")
+            scheme = input("Enter the scheme (rs-<data shards>-<parity shards>, none or inherit): ")
+            handle_set_erasure_coding(directory_path, scheme)
         elif user_input.lower() == "create_directory":
             directory_path = input("Enter directory path: ")
             handle_create_directory(directory_path)
@@ -0,0 +1,44 @@
+import os
+
+import cli
+
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.text = str(body)
+
+    def json(self):
+        return self.body
+
+
+def test_get_file_of_empty_file(tmp_path, monkeypatch):
+    # An empty file uploaded as two chunks: both are empty, nothing is read through
+    # read_range, and both end up in the local chunk cache
+    chunks = [{'chunk_id': chunk_id, 'data_id': 'empty', 'stored_chunk_id': chunk_id,
+               'size': 0, 'checksum': 0} for chunk_id in (1, 2)]
+    requested = []
+
+    def fake_get(url, **kwargs):
+        requested.append(url)
+        if url.endswith('/chunk_locations'):
+            return FakeResponse(200, {'chunks': chunks})
+        return FakeResponse(400, {'error': 'Invalid range'})
+
+    monkeypatch.setattr(cli.requests, 'get', fake_get)
+    monkeypatch.setattr(cli, 'chunk_cache_dir', str(tmp_path / 'cache'))
+    monkeypatch.setattr(cli, 'chunk_cache_index', None)
+
+    output_path = tmp_path / 'empty.txt'
+    cli.handle_get_file('empty.txt', '/', str(output_path))
+
+    assert output_path.read_bytes() == b''
+    assert not any(url.endswith('/read_range') for url in requested)
+    assert sorted(os.listdir(tmp_path / 'cache')) == ['empty_1_0', 'empty_2_0']
+
+    # A second read is served from the cache
+    requested.clear()
+    cli.handle_get_file('empty.txt', '/', str(output_path))
+    assert output_path.read_bytes() == b''
+    assert requested == [f"{cli.namenode_url}/chunk_locations"]